@@ -1,31 +1,90 @@
 import streamlit as st
-import requests
-import fitz  # PyMuPDF
-import os
-import markdown
 from datetime import datetime, timedelta, timezone
 import re
-import uuid
 import base64
 import bcrypt
 import time
 import random
 import smtplib
-import razorpay
 import logging
-from xhtml2pdf import pisa
-from PIL import Image
+import os
+import functools
+import hashlib
+import tempfile
 from email.mime.text import MIMEText
-from docx import Document
-from docx.shared import Inches, Pt, RGBColor
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.oxml.ns import qn
-from io import BytesIO
-from supabase import create_client, Client
+# PDF/Word/image/payment/database libraries (xhtml2pdf + reportlab,
+# PyMuPDF, python-docx, PIL, razorpay, supabase) are imported where they're
+# first used, so a fresh process shows the login form without loading them.
+# To see what module import still costs:
+#   python -X importtime -c "import engine" 2>&1 | sort -t'|' -k2 -n | tail
+from metrics import timed, traced, begin_rerun, end_rerun, current_rerun_scope, snapshot, prometheus_text, start_metrics_server
+from profiler import start_profile, mark_section, stop_profile
+from ratelimit import RateLimiter, RateLimited, MemoryBucketStore, RedisBucketStore, configure_rate_limit
+from model_registry import ModelRegistry, configure_model_registry, key_fingerprint, DEFAULT_REGISTRY_PATH
+from context_cache import ContextCache, configure_context_cache, DEFAULT_TTL
+from transcripts import SQLiteTranscriptCache, configure_transcript_cache
+from usage import usage_context, configure_usage, SQLiteUsageSink, SupabaseUsageSink, daily_usage, usage_by_config
+from history import (HISTORY_COLUMNS, save_paper_to, unpack_papers, rebuild_revisions,
+                     SupabaseHistoryIndex, SQLiteHistoryIndex)
+from question_bank import QuestionBank
+from engine import (
+    StoredLogo, BATCH_FORMATS, VARIANT_SET_LABELS, GeminiCacheClient, book_context,
+    list_generation_models, generate_gemini_content, digitize_pages, generate_structured_paper, generate_structured_sections,
+    requested_section_marks, structured_paper_to_blocks, paper_language as content_language, read_pdf_pages,
+    build_question_prompt, build_paper_prompt, split_blocks,
+    regenerate_questions, replace_question_block, generate_paper_variants, create_a4_html, html_to_pdf,
+    create_word_docx, safe_file_stem, build_papers_zip,
+)
 
 # --- LOGGING CONFIGURATION ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# --- PER-RERUN METRICS ---
+# Every interaction re-executes this script top to bottom; begin/end_rerun
+# bracket one execution so its total time and Supabase/Gemini call counts
+# land in metrics.py. Use stop_script()/rerun_script() instead of
+# st.stop()/st.rerun() so early exits are recorded too (and an active
+# rerun profile is closed).
+begin_rerun()
+
+def finish_rerun():
+    end_rerun()
+    profile = stop_profile()
+    if profile:
+        st.session_state.last_profile = profile
+
+def stop_script():
+    finish_rerun()
+    st.stop()
+
+def rerun_script(scope="app"):
+    # scope="fragment" is only valid during a fragment's own rerun; if the
+    # click arrived as part of a full-app rerun, rerun the app instead.
+    if scope == "fragment" and not (current_rerun_scope() or "").startswith("fragment:"):
+        scope = "app"
+    finish_rerun()
+    st.rerun(scope=scope)
+
+def isolated_section(name):
+    """Runs a tab (or other region) as an st.fragment: widget interactions
+    inside it rerun only that function, not the whole script. A rerun that
+    starts inside the fragment is recorded in metrics as its own scope."""
+    def decorator(fn):
+        @st.fragment
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            mark_section(name)
+            fragment_rerun = current_rerun_scope() is None
+            if fragment_rerun:
+                begin_rerun(scope=f"fragment:{name}")
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                if fragment_rerun:
+                    end_rerun()
+        return wrapper
+    return decorator
+
 # --- Page Config ---
 st.set_page_config(page_title="PaperBanao - AI Question Paper", page_icon="📝", layout="centered")
 
@@ -36,11 +95,53 @@ SERVER_API_KEY = st.secrets["GEMINI_API_KEY"]
 SUPABASE_URL = st.secrets["SUPABASE_URL"]
 SUPABASE_KEY = st.secrets["SUPABASE_KEY"]
 
+# ==========================================
+# --- 📈 METRICS (admin only) ---
+# ==========================================
+# ?metrics=<METRICS_TOKEN> shows the in-process metrics as JSON
+# (add &format=prometheus for Prometheus text). Setting METRICS_PORT also
+# serves /metrics for a Prometheus scraper from a background thread.
+@st.cache_resource
+def init_metrics_server(port):
+    try:
+        return start_metrics_server(port)
+    except OSError as e:
+        logging.error(f"[Metrics Server Error] {e}")
+        return None
+
+if st.secrets.get("METRICS_PORT"):
+    init_metrics_server(int(st.secrets["METRICS_PORT"]))
+
+METRICS_TOKEN = st.secrets.get("METRICS_TOKEN")
+if METRICS_TOKEN and st.query_params.get("metrics") == METRICS_TOKEN:
+    st.title("📈 PaperBanao Metrics")
+    if st.query_params.get("format") == "prometheus":
+        st.code(prometheus_text(), language="text")
+    else:
+        st.json(snapshot())
+    stop_script()
+
+# ==========================================
+# --- 🔬 RERUN PROFILING (admin only) ---
+# ==========================================
+# ?profile=<PROFILE_TOKEN> samples exactly one rerun (the param is removed
+# so the next interaction runs normally) and offers the collapsed stacks
+# for a flamegraph in the sidebar. mark_section() calls below label the
+# samples by the part of the script they came from.
+PROFILE_TOKEN = st.secrets.get("PROFILE_TOKEN")
+if PROFILE_TOKEN and st.query_params.get("profile") == PROFILE_TOKEN:
+    del st.query_params["profile"]
+    start_profile(__file__)
+
 # ==========================================
 # --- INITIALIZE SUPABASE CLIENT ---
 # ==========================================
+# Created on first use, not at the top of every run: the supabase client
+# stack is one of the slowest imports and the login form doesn't need it
+# until someone actually submits.
 @st.cache_resource
-def init_supabase():
+def get_supabase():
+    from supabase import create_client
     try:
         return create_client(SUPABASE_URL, SUPABASE_KEY)
     except Exception as e:
@@ -48,23 +149,114 @@ def init_supabase():
         st.error("Database Connection Error. Please contact support.")
         return None
 
-supabase: Client = init_supabase()
+# ==========================================
+# --- 🪙 TOKEN USAGE (per Gemini call) ---
+# ==========================================
+# Every Gemini call's tokens/latency/model is recorded (batched, off the
+# request path) to the USAGE_TABLE Supabase table when that secret is set,
+# else to a local SQLite file. ?usage=<METRICS_TOKEN> shows the aggregates.
+# Started after login (or on the usage page), so the login form never
+# waits on the supabase import for it.
+@st.cache_resource
+def init_usage_recorder():
+    try:
+        if st.secrets.get("USAGE_TABLE") and get_supabase() is not None:
+            return configure_usage(SupabaseUsageSink(get_supabase(), st.secrets["USAGE_TABLE"]))
+        return configure_usage(SQLiteUsageSink(st.secrets.get("USAGE_DB_PATH", "paperbanao_usage.db")))
+    except Exception as e:
+        logging.error(f"[Usage Init Error] {e}")
+        return None
+
+# ==========================================
+# --- 🔎 HISTORY SEARCH ---
+# ==========================================
+# Cloud History search runs in Postgres (search_papers(), see history.py).
+# Set HISTORY_SEARCH_DB to a local file to use the SQLite FTS5 stand-in;
+# a new one is filled from the papers already saved.
+@st.cache_resource
+def init_history_search():
+    try:
+        if st.secrets.get("HISTORY_SEARCH_DB"):
+            index = SQLiteHistoryIndex(st.secrets["HISTORY_SEARCH_DB"])
+            try:
+                index.backfill(get_supabase())
+            except Exception as e:
+                logging.error(f"[History Backfill Error] {e}")
+            return index
+        return SupabaseHistoryIndex(get_supabase())
+    except Exception as e:
+        logging.error(f"[History Search Init Error] {e}")
+        return None
+
+# ==========================================
+# --- ♻️ QUESTION BANK ---
+# ==========================================
+# Every saved paper's questions go into the teacher's bank (see
+# question_bank.py) so later papers can reuse them without a Gemini call.
+# Banking marks them used, so it happens on Save History, not on generate:
+# a discarded paper mustn't hold its questions back for 90 days.
+@st.cache_resource
+def init_question_bank():
+    try:
+        return QuestionBank(st.secrets.get("QUESTION_BANK_DB", "paperbanao_bank.db"))
+    except Exception as e:
+        logging.error(f"[Question Bank Init Error] {e}")
+        return None
 
-class StoredLogo(BytesIO):
-    def __init__(self, data: bytes, mimetype: str):
-        super().__init__(data)
-        self.type = mimetype
+def bank_paper(username, blocks, meta):
+    # Banking is best-effort: a failure here must never cost the teacher their paper.
+    try:
+        bank = init_question_bank()
+        if bank is not None and meta:
+            bank.add_paper(username, blocks, meta)
+    except Exception as e:
+        logging.error(f"[Question Bank Error] {e}")
 
-# --- INITIALIZE RAZORPAY CLIENT ---
+# ==========================================
+# --- 🚦 RATE LIMIT (shared server key) ---
+# ==========================================
+# Calls on SERVER_API_KEY take a token from the user's bucket and a global
+# one, waiting briefly (fairly, round-robin per user) when the key is busy.
+# Set REDIS_URL to share the buckets between app processes.
 @st.cache_resource
-def init_razorpay():
+def init_rate_limiter():
+    store = MemoryBucketStore()
+    if st.secrets.get("REDIS_URL"):
+        try:
+            import redis
+            store = RedisBucketStore(redis.Redis.from_url(st.secrets["REDIS_URL"]))
+        except Exception as e:
+            logging.error(f"[Rate Limit Store Error] falling back to in-process buckets: {e}")
+    limiter = RateLimiter(
+        store,
+        user_per_min=float(st.secrets.get("RATE_LIMIT_USER_PER_MIN", 6)), user_burst=int(st.secrets.get("RATE_LIMIT_USER_BURST", 3)),
+        global_per_min=float(st.secrets.get("RATE_LIMIT_GLOBAL_PER_MIN", 60)), global_burst=int(st.secrets.get("RATE_LIMIT_GLOBAL_BURST", 10)),
+        max_wait=float(st.secrets.get("RATE_LIMIT_MAX_WAIT", 20)), fair=bool(st.secrets.get("RATE_LIMIT_FAIR_QUEUE", True)))
+    configure_rate_limit(limiter, [SERVER_API_KEY])
+    return limiter
+
+init_rate_limiter()
+
+if METRICS_TOKEN and st.query_params.get("usage") == METRICS_TOKEN:
+    init_usage_recorder()
+    st.title("🪙 Gemini Token Usage")
+    usage_days = st.number_input("Days", min_value=1, max_value=90, value=7)
+    st.subheader("Per user, per day")
+    st.dataframe(daily_usage(days=usage_days), use_container_width=True)
+    st.subheader("By feature and paper configuration (most prompt tokens first)")
+    st.dataframe(usage_by_config(days=usage_days), use_container_width=True)
+    stop_script()
+
+# --- INITIALIZE RAZORPAY CLIENT (on first payment action) ---
+@st.cache_resource
+def get_razorpay():
     try:
+        import razorpay
         return razorpay.Client(auth=(st.secrets["RAZORPAY_KEY_ID"], st.secrets["RAZORPAY_KEY_SECRET"]))
     except Exception as e:
         logging.error(f"[Razorpay Init Error] {e}")
         return None
 
-razorpay_client = init_razorpay()
 APP_URL = "https://paperbanao-web.streamlit.app/"
 PRO_PRICE_INR = 99
 PRO_DURATION_DAYS = 30
@@ -79,22 +271,22 @@ def verify_password(password, stored_hash):
             return bcrypt.checkpw(password.encode(), stored_hash.encode())
         except ValueError:
             return False
-    import hashlib
     legacy_hash = hashlib.sha256(password.encode()).hexdigest()
     return legacy_hash == stored_hash
 
+@traced("supabase.create_user")
 def create_user(username, password, email):
     username = username.strip()
     email = email.strip().lower()
     try:
-        existing = supabase.table("users").select("username").ilike("username", username).execute()
+        existing = get_supabase().table("users").select("username").ilike("username", username).execute()
         if existing.data:
             return False, "Username already exists. Choose another."
-        existing_email = supabase.table("users").select("username").ilike("email", email).execute()
+        existing_email = get_supabase().table("users").select("username").ilike("email", email).execute()
         if existing_email.data:
             return False, "An account with this email already exists."
         data = {"username": username, "password": hash_password(password), "email": email, "papers_generated": 0, "is_pro": False}
-        supabase.table("users").insert(data).execute()
+        get_supabase().table("users").insert(data).execute()
         return True, "Account created successfully! Please Login."
     except Exception as e:
         logging.error(f"[Signup Error] {e}")
@@ -102,10 +294,11 @@ def create_user(username, password, email):
             return False, f"DEBUG: {e}"
         return False, "Something went wrong creating your account. Please try again."
 
+@traced("supabase.authenticate_user")
 def authenticate_user(username, password):
     username = username.strip()
     try:
-        res = supabase.table("users").select("*").eq("username", username).execute()
+        res = get_supabase().table("users").select("*").eq("username", username).execute()
     except Exception as e:
         logging.error(f"[Auth Error] {e}")
         st.error("Login is temporarily unavailable. Please try again shortly.")
@@ -117,14 +310,15 @@ def authenticate_user(username, password):
         return None
     if not (user["password"].startswith("$2b$") or user["password"].startswith("$2a$")):
         try:
-            supabase.table("users").update({"password": hash_password(password)}).eq("username", username).execute()
+            get_supabase().table("users").update({"password": hash_password(password)}).eq("username", username).execute()
         except Exception as e:
             logging.error(f"[Password Upgrade Error] {e}")
     return user
 
+@traced("supabase.get_user_data")
 def get_user_data(username):
     try:
-        res = supabase.table("users").select("papers_generated, is_pro, email, pro_expires_at").eq("username", username).execute()
+        res = get_supabase().table("users").select("papers_generated, is_pro, email, pro_expires_at").eq("username", username).execute()
         if len(res.data) > 0:
             row = res.data[0]
             expires_at = row.get("pro_expires_at")
@@ -144,23 +338,62 @@ def get_user_data(username):
         logging.error(f"[get_user_data Error] {e}")
     return {"papers_generated": 0, "is_pro": False, "email": None, "pro_expires_at": None}
 
+@traced("supabase.update_paper_count")
 def update_paper_count(username):
     try:
         current_count = get_user_data(username)["papers_generated"]
-        supabase.table("users").update({"papers_generated": current_count + 1}).eq("username", username).execute()
+        get_supabase().table("users").update({"papers_generated": current_count + 1}).eq("username", username).execute()
     except Exception as e:
         logging.error(f"[update_paper_count Error] {e}")
 
+@traced("supabase.save_paper")
+def save_paper(username, subject, board, content, paper_id=None):
+    """Saves to Cloud History and returns the paper's id; raises on failure.
+    With paper_id the save becomes that paper's next revision (see
+    history.save_paper_to(), including when the id that comes back differs)."""
+    paper_id, row = save_paper_to(get_supabase(), username, datetime.now().strftime("%Y-%m-%d"), subject, board, content, paper_id)
+    if paper_id is not None and row is not None:
+        index_saved_paper(paper_id, row)
+    return paper_id
+
+def index_saved_paper(paper_id, row):
+    # A missed index update only hides the paper from search; never fail the save over it.
+    try:
+        index = init_history_search()
+        if index is not None:
+            index.add(paper_id, row)
+    except Exception as e:
+        logging.error(f"[History Index Error] {e}")
+
+@traced("supabase.search_history")
+def search_history(username, query, board=None, date_from=None, date_to=None):
+    """Matching papers as [{"id", "subject", "board", "date", "snippet"}]; raises on failure."""
+    index = init_history_search()
+    if index is None:
+        raise RuntimeError("History search is not configured.")
+    return index.search(username, query, board, date_from, date_to)
+
+@traced("supabase.load_revisions")
+def load_revisions(paper_id, username, head_content):
+    """Older revisions of a saved paper as [(rev, created_at, content)], newest first."""
+    res = get_supabase().table("paper_revisions").select("rev, created_at, delta").eq("paper_id", paper_id).eq("username", username).execute()
+    return rebuild_revisions(head_content, res.data or [])
+
+@traced("supabase.delete_paper")
 def delete_paper(paper_id, username):
     try:
-        supabase.table("papers").delete().eq("id", paper_id).eq("username", username).execute()
+        get_supabase().table("papers").delete().eq("id", paper_id).eq("username", username).execute()
+        index = init_history_search()
+        if index is not None:
+            index.remove(paper_id, username)
     except Exception as e:
         logging.error(f"[delete_paper Error] {e}")
         st.error("Couldn't delete that paper. Please try again.")
 
+@traced("supabase.get_institution_defaults")
 def get_institution_defaults(username):
     try:
-        res = supabase.table("users").select(
+        res = get_supabase().table("users").select(
             "default_inst_name, default_inst_address, default_inst_contact, "
             "default_teacher_name, default_paper_language, default_board_format, "
             "default_logo_base64, default_logo_mimetype"
@@ -171,6 +404,7 @@ def get_institution_defaults(username):
         logging.error(f"[get_institution_defaults Error] {e}")
     return {}
 
+@traced("supabase.save_institution_defaults")
 def save_institution_defaults(username, inst_name, inst_address, inst_contact, teacher_name,
                                paper_language, board_format, logo_bytes=None, logo_mimetype=None):
     try:
@@ -185,7 +419,7 @@ def save_institution_defaults(username, inst_name, inst_address, inst_contact, t
         if logo_bytes is not None:
             update_data["default_logo_base64"] = base64.b64encode(logo_bytes).decode()
             update_data["default_logo_mimetype"] = logo_mimetype
-        supabase.table("users").update(update_data).eq("username", username).execute()
+        get_supabase().table("users").update(update_data).eq("username", username).execute()
         return True
     except Exception as e:
         logging.error(f"[save_institution_defaults Error] {e}")
@@ -198,31 +432,34 @@ def save_institution_defaults(username, inst_name, inst_address, inst_contact, t
 # reused by everyone after that.
 CLASS_OPTIONS = [f"Class {i}" for i in range(1, 13)]
 
+@traced("supabase.get_subjects_for_class")
 def get_subjects_for_class(class_name):
     try:
-        res = supabase.table("curriculum").select("subject_name").eq("class_name", class_name).execute()
+        res = get_supabase().table("curriculum").select("subject_name").eq("class_name", class_name).execute()
         return sorted(set(r["subject_name"] for r in res.data))
     except Exception as e:
         logging.error(f"[get_subjects_for_class Error] {e}")
         return []
 
+@traced("supabase.get_chapters")
 def get_chapters(class_name, subject_name):
     try:
-        res = supabase.table("curriculum").select("chapters").eq("class_name", class_name).eq("subject_name", subject_name).execute()
+        res = get_supabase().table("curriculum").select("chapters").eq("class_name", class_name).eq("subject_name", subject_name).execute()
         if res.data:
             return [c.strip() for c in res.data[0]["chapters"].split(",") if c.strip()]
     except Exception as e:
         logging.error(f"[get_chapters Error] {e}")
     return []
 
+@traced("supabase.save_chapters")
 def save_chapters(class_name, subject_name, chapters_list):
     try:
         chapters_str = ", ".join(sorted(set(c.strip() for c in chapters_list if c.strip())))
-        existing = supabase.table("curriculum").select("id").eq("class_name", class_name).eq("subject_name", subject_name).execute()
+        existing = get_supabase().table("curriculum").select("id").eq("class_name", class_name).eq("subject_name", subject_name).execute()
         if existing.data:
-            supabase.table("curriculum").update({"chapters": chapters_str, "updated_at": datetime.now(timezone.utc).isoformat()}).eq("id", existing.data[0]["id"]).execute()
+            get_supabase().table("curriculum").update({"chapters": chapters_str, "updated_at": datetime.now(timezone.utc).isoformat()}).eq("id", existing.data[0]["id"]).execute()
         else:
-            supabase.table("curriculum").insert({"class_name": class_name, "subject_name": subject_name, "chapters": chapters_str}).execute()
+            get_supabase().table("curriculum").insert({"class_name": class_name, "subject_name": subject_name, "chapters": chapters_str}).execute()
         return True
     except Exception as e:
         logging.error(f"[save_chapters Error] {e}")
@@ -252,11 +489,12 @@ def send_otp_email(to_email, otp):
         logging.error(f"[Email Send Error] {e}")
         return False
 
+@traced("supabase.request_password_reset")
 def request_password_reset(identifier):
     identifier = identifier.strip()
     generic_msg = "If that account exists, a reset code has been sent to its registered email."
     try:
-        res = supabase.table("users").select("username, email") \
+        res = get_supabase().table("users").select("username, email") \
             .or_(f"username.eq.{identifier},email.eq.{identifier.lower()}").execute()
     except Exception as e:
         logging.error(f"[Reset Lookup Error] {e}")
@@ -274,7 +512,7 @@ def request_password_reset(identifier):
     expires_at = (datetime.now(timezone.utc) + timedelta(minutes=10)).isoformat()
 
     try:
-        supabase.table("users").update({
+        get_supabase().table("users").update({
             "reset_otp": otp_hash,
             "reset_otp_expires": expires_at
         }).eq("username", user["username"]).execute()
@@ -287,10 +525,11 @@ def request_password_reset(identifier):
     else:
         return False, "Couldn't send the reset email right now. Please try again shortly."
 
+@traced("supabase.verify_and_reset_password")
 def verify_and_reset_password(identifier, otp, new_password):
     identifier = identifier.strip()
     try:
-        res = supabase.table("users").select("username, reset_otp, reset_otp_expires") \
+        res = get_supabase().table("users").select("username, reset_otp, reset_otp_expires") \
             .or_(f"username.eq.{identifier},email.eq.{identifier.lower()}").execute()
     except Exception as e:
         logging.error(f"[Reset Verify Error] {e}")
@@ -313,7 +552,7 @@ def verify_and_reset_password(identifier, otp, new_password):
         return False, "Incorrect code."
 
     try:
-        supabase.table("users").update({
+        get_supabase().table("users").update({
             "password": hash_password(new_password),
             "reset_otp": None,
             "reset_otp_expires": None
@@ -325,7 +564,9 @@ def verify_and_reset_password(identifier, otp, new_password):
     return True, "Password updated! Please login with your new password."
 
 # --- RAZORPAY: PAYMENT LINK + VERIFICATION ---
+@traced("payments.create_pro_payment_link")
 def create_pro_payment_link(username, email):
+    razorpay_client = get_razorpay()
     if not razorpay_client:
         return None, "Payment system isn't configured right now."
     try:
@@ -347,15 +588,20 @@ def create_pro_payment_link(username, email):
         logging.error(f"[Payment Link Error] {e}")
         return None, "Couldn't create the payment link. Please try again."
 
+@traced("payments.process_payment_callback")
 def process_payment_callback(params):
     required = ["razorpay_payment_link_id", "razorpay_payment_link_reference_id",
                 "razorpay_payment_link_status", "razorpay_payment_id", "razorpay_signature"]
     if not all(k in params for k in required):
         return False, None
 
+    from razorpay.errors import SignatureVerificationError
+    razorpay_client = get_razorpay()
+    if not razorpay_client:
+        return False, "Payment system isn't configured right now."
     try:
         razorpay_client.utility.verify_payment_link_signature(params)
-    except razorpay.errors.SignatureVerificationError as e:
+    except SignatureVerificationError as e:
         logging.error(f"[Payment Signature Error] {e}")
         return False, "Payment verification failed. If money was deducted, please contact support."
 
@@ -365,7 +611,7 @@ def process_payment_callback(params):
     payment_id = params["razorpay_payment_id"]
 
     try:
-        existing = supabase.table("payments").select("payment_id").eq("payment_id", payment_id).execute()
+        existing = get_supabase().table("payments").select("payment_id").eq("payment_id", payment_id).execute()
         if existing.data:
             return True, "Payment already processed."
     except Exception as e:
@@ -383,7 +629,7 @@ def process_payment_callback(params):
         return False, "Couldn't identify the account for this payment. Please contact support."
 
     try:
-        user_res = supabase.table("users").select("pro_expires_at").eq("username", username).execute()
+        user_res = get_supabase().table("users").select("pro_expires_at").eq("username", username).execute()
         now = datetime.now(timezone.utc)
         current_expiry = None
         if user_res.data and user_res.data[0].get("pro_expires_at"):
@@ -391,12 +637,12 @@ def process_payment_callback(params):
         start_from = current_expiry if (current_expiry and current_expiry > now) else now
         new_expiry = start_from + timedelta(days=PRO_DURATION_DAYS)
 
-        supabase.table("users").update({
+        get_supabase().table("users").update({
             "is_pro": True,
             "pro_expires_at": new_expiry.isoformat()
         }).eq("username", username).execute()
 
-        supabase.table("payments").insert({
+        get_supabase().table("payments").insert({
             "payment_id": payment_id,
             "username": username,
             "amount_inr": PRO_PRICE_INR
@@ -407,6 +653,35 @@ def process_payment_callback(params):
 
     return True, f"Payment successful! Pro is active until {new_expiry.strftime('%d %b %Y')}."
 
+# ==========================================
+# --- 📦 ZIP DOWNLOADS ---
+# ==========================================
+# Built ZIPs stay in a temporary file (its path in session state) until
+# they're downloaded, instead of as bytes in memory for the whole session.
+def new_zip_path():
+    fd, path = tempfile.mkstemp(prefix="paperbanao_", suffix=".zip")
+    os.close(fd)
+    return path
+
+def discard_zip(state_key):
+    path = st.session_state.pop(state_key, None)
+    if path:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def render_zip_download(state_key, label, file_name, key=None):
+    path = st.session_state.get(state_key)
+    if not path:
+        return
+    if not os.path.exists(path):
+        st.session_state.pop(state_key, None)
+        return
+    with open(path, "rb") as f:
+        st.download_button(label, f, file_name, "application/zip", key=key, use_container_width=True,
+                           on_click=discard_zip, args=(state_key,))
+
 # --- INITIALIZE SESSION STATE ---
 if "logged_in" not in st.session_state: st.session_state.logged_in = False
 if "username" not in st.session_state: st.session_state.username = ""
@@ -421,13 +696,14 @@ if "login_locked_until" not in st.session_state: st.session_state.login_locked_u
 # ==========================================
 # --- 🔐 LOGIN & SIGNUP UI ---
 # ==========================================
+mark_section("login")
 if not st.session_state.logged_in:
     st.markdown("<h1 style='text-align: center;'>📝 PaperBanao AI (Cloud)</h1>", unsafe_allow_html=True)
     st.markdown("<p style='text-align: center;'>Generate precise question papers in seconds.</p>", unsafe_allow_html=True)
     
-    if not supabase:
+    if not SUPABASE_URL or not SUPABASE_KEY:
         st.error("⚠️ SYSTEM ADMIN: Please configure 'SUPABASE_URL' and 'SUPABASE_KEY' in the code to enable Login.")
-        st.stop()
+        stop_script()
         
     st.markdown("---")
     t_login, t_signup, t_forgot = st.tabs(["Login", "Sign Up (Free Trial)", "Forgot Password"])
@@ -445,7 +721,7 @@ if not st.session_state.logged_in:
                 st.session_state.logged_in = True
                 st.session_state.username = user["username"]
                 st.session_state.login_attempts = 0
-                st.rerun()
+                rerun_script()
             else:
                 st.session_state.login_attempts += 1
                 if st.session_state.login_attempts >= 5:
@@ -495,7 +771,7 @@ if not st.session_state.logged_in:
                         st.session_state.reset_otp_sent = True
                         st.session_state.reset_identifier = f_id
                         st.success(msg)
-                        st.rerun()
+                        rerun_script()
                     else:
                         st.error(msg)
         else:
@@ -515,13 +791,15 @@ if not st.session_state.logged_in:
                         st.error(msg)
             if fc2.button("Start Over", use_container_width=True):
                 st.session_state.reset_otp_sent = False
-                st.rerun()
-    st.stop()
+                rerun_script()
+    stop_script()
 
 # ==========================================
 # --- APP LOGIC (IF LOGGED IN) ---
 # ==========================================
 
+init_usage_recorder()
+mark_section("header")
 qp = st.query_params
 if "razorpay_payment_id" in qp:
     ok, msg = process_payment_callback(dict(qp))
@@ -549,12 +827,17 @@ with col_logout:
         st.session_state.blocks = []
         st.session_state.blocks_saved = True
         st.session_state.confirm_overwrite = False
+        for k in ("history_id", "bseb_history_id", "digi_history_id", "bank_meta", "bseb_bank_meta", "paper_context", "pdf_extract"):
+            st.session_state.pop(k, None)
         if "inst_defaults" in st.session_state: del st.session_state["inst_defaults"]
-        st.rerun()
+        for k in [k for k in st.session_state if k == "batch_zip" or k.endswith("sets_zip")]:
+            discard_zip(k)
+        rerun_script()
 
 # ==========================================
 # --- SIDEBAR & SETTINGS ---
 # ==========================================
+mark_section("sidebar")
 st.sidebar.header("💳 Your Account")
 if is_pro:
     expiry_str = datetime.fromisoformat(pro_expires_at).strftime("%d %b %Y")
@@ -587,36 +870,44 @@ user_api_key = st.sidebar.text_input("Your Gemini API Key (Optional)", type="pas
 
 if user_api_key:
     st.sidebar.success("✅ Personal API Key Active!")
+structured_output = st.sidebar.toggle("🧩 Structured Output (JSON)", value=False,
+    help="Ask the AI for a structured paper instead of plain text. Fixes badly formatted questions on their own instead of regenerating the whole paper.")
 
 st.sidebar.markdown("---")
-st.sidebar.header("🏫 Institute Details")
 
 if "inst_defaults" not in st.session_state:
     st.session_state.inst_defaults = get_institution_defaults(st.session_state.username)
 _d = st.session_state.inst_defaults
 
-inst_logo_upload = st.sidebar.file_uploader("Upload Logo", type=["png", "jpg", "jpeg"], help="Leave empty to keep your saved default logo")
-inst_name = st.sidebar.text_input("Institute Name", value=_d.get("default_inst_name") or "My Success Academy")
-exam_time = st.sidebar.text_input("Exam Time", value="2 Hours")
+# One form for all paper settings: typing in these fields doesn't rerun the
+# app (and re-render every export) until "Apply" or "Save" is clicked.
+with st.sidebar.form("paper_settings"):
+    st.header("🏫 Institute Details")
+    inst_logo_upload = st.file_uploader("Upload Logo", type=["png", "jpg", "jpeg"], help="Leave empty to keep your saved default logo")
+    inst_name = st.text_input("Institute Name", value=_d.get("default_inst_name") or "My Success Academy")
+    exam_time = st.text_input("Exam Time", value="2 Hours")
 
-st.sidebar.markdown("---")
-st.sidebar.header("🏢 Footer Details")
-teacher_name = st.sidebar.text_input("Teacher Name", value=_d.get("default_teacher_name") or "Mr. Suraj")
-inst_address = st.sidebar.text_input("Institute Address", value=_d.get("default_inst_address") or "NH-22 Education Lane, City")
-inst_contact = st.sidebar.text_input("Contact Number", value=_d.get("default_inst_contact") or "+91 9310038172")
+    st.markdown("---")
+    st.header("🏢 Footer Details")
+    teacher_name = st.text_input("Teacher Name", value=_d.get("default_teacher_name") or "Mr. Suraj")
+    inst_address = st.text_input("Institute Address", value=_d.get("default_inst_address") or "NH-22 Education Lane, City")
+    inst_contact = st.text_input("Contact Number", value=_d.get("default_inst_contact") or "+91 9310038172")
 
-st.sidebar.markdown("---")
-st.sidebar.header("📜 Formatting")
-_board_options = ["Standard", "BSEB (Bihar Board)", "CBSE", "ICSE"]
-_lang_options = ["English", "Hindi", "Bilingual"]
-board_format = st.sidebar.selectbox("Board Pattern", _board_options,
-    index=_board_options.index(_d["default_board_format"]) if _d.get("default_board_format") in _board_options else 0)
-paper_language = st.sidebar.selectbox("Paper Language", _lang_options,
-    index=_lang_options.index(_d["default_paper_language"]) if _d.get("default_paper_language") in _lang_options else 0)
-include_answer_key = st.sidebar.toggle("Include Answer Key", value=True)
-is_two_column = st.sidebar.toggle("📄 Two-Column Format", value=True)
-
-if st.sidebar.button("💾 Save these as my Default", use_container_width=True):
+    st.markdown("---")
+    st.header("📜 Formatting")
+    _board_options = ["Standard", "BSEB (Bihar Board)", "CBSE", "ICSE"]
+    _lang_options = ["English", "Hindi", "Bilingual"]
+    board_format = st.selectbox("Board Pattern", _board_options,
+        index=_board_options.index(_d["default_board_format"]) if _d.get("default_board_format") in _board_options else 0)
+    paper_language = st.selectbox("Paper Language", _lang_options,
+        index=_lang_options.index(_d["default_paper_language"]) if _d.get("default_paper_language") in _lang_options else 0)
+    include_answer_key = st.toggle("Include Answer Key", value=True)
+    is_two_column = st.toggle("📄 Two-Column Format", value=True)
+
+    st.form_submit_button("✅ Apply Changes", use_container_width=True)
+    save_defaults_clicked = st.form_submit_button("💾 Save these as my Default", use_container_width=True)
+
+if save_defaults_clicked:
     logo_bytes, logo_mimetype = None, None
     if inst_logo_upload is not None:
         inst_logo_upload.seek(0)
@@ -642,80 +933,46 @@ else:
 # ==========================================
 # --- HTTP REQUESTS: GEMINI API CALLS ---
 # ==========================================
+mark_section("model_discovery")
 active_api_key = user_api_key if user_api_key.strip() != "" else SERVER_API_KEY
 
-@st.cache_data(ttl=3600, show_spinner=False)
-def get_working_model_name(api_key):
-    url = f"https://generativelanguage.googleapis.com/v1beta/models?key={api_key}"
-    try:
-        res = requests.get(url, timeout=30)
-        if res.status_code == 200:
-            models = [m['name'] for m in res.json().get('models', []) if 'generateContent' in m.get('supportedGenerationMethods', [])]
-            flash_models = [m for m in models if '1.5-flash' in m]
-            return flash_models[0].replace('models/', '') if flash_models else models[0].replace('models/', '')
-        return "gemini-1.5-flash"
-    except Exception as e:
-        logging.error(f"[Model Fetch Error] {e}")
-        return "gemini-1.5-flash"
+# The registry answers from disk/memory (no models-listing round trip on
+# the page load) and refreshes stale listings in the background; it picks
+# the fastest model that has been answering without errors.
+@st.cache_resource
+def init_model_registry():
+    return configure_model_registry(ModelRegistry(list_generation_models, st.secrets.get("MODEL_REGISTRY_PATH", DEFAULT_REGISTRY_PATH)))
+
+# Picked once per session so a paper and its regenerations share a model,
+# and with it the book's context cache; picked again only when the key
+# changes or the model starts failing.
+model_registry = init_model_registry()
+if (st.session_state.get("model_key") != key_fingerprint(active_api_key)
+        or not model_registry.usable(active_api_key, st.session_state.get("working_model"))):
+    st.session_state.working_model = model_registry.pick(active_api_key)
+    st.session_state.model_key = key_fingerprint(active_api_key)
+working_model_name = st.session_state.working_model
+
+# PDF Extract's book text is uploaded to Gemini once (cachedContents) and
+# referenced by retries and regenerations instead of being re-sent.
+@st.cache_resource
+def init_context_cache():
+    return configure_context_cache(ContextCache(GeminiCacheClient(), float(st.secrets.get("CONTEXT_CACHE_TTL", DEFAULT_TTL))))
 
-working_model_name = get_working_model_name(active_api_key)
+init_context_cache()
 
-def generate_gemini_content(prompt, api_key, model_name="gemini-1.5-flash", images=None):
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={api_key}"
-    headers = {'Content-Type': 'application/json'}
-    
-    parts = [{"text": prompt}]
-    
-    if images:
-        for img in images:
-            buffered = BytesIO()
-            # PNGs (and some other formats) can be in RGBA/P/LA mode, which
-            # the JPEG encoder can't write (it has no alpha channel support).
-            # Converting to RGB first prevents a crash on transparent PNGs.
-            if img.mode != "RGB":
-                img = img.convert("RGB")
-            img.save(buffered, format="JPEG")
-            img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-            parts.append({
-                "inline_data": {
-                    "mime_type": "image/jpeg",
-                    "data": img_str
-                }
-            })
-            
-    payload = {"contents": [{"parts": parts}]}
-    
-    # Timeout prevents the app from hanging forever for a user if the
-    # Gemini API stalls or the network drops mid-request.
-    response = requests.post(url, headers=headers, json=payload, timeout=90)
-    if response.status_code == 200:
-        data = response.json()
-        try:
-            return data['candidates'][0]['content']['parts'][0]['text']
-        except (KeyError, IndexError):
-            logging.error("Unexpected response format from Gemini API.")
-            raise Exception("Unexpected response format from Gemini API.")
-    else:
-        try:
-            error_msg = response.json().get('error', {}).get('message', 'Unknown error')
-        except ValueError:
-            error_msg = response.text[:200]
-        logging.error(f"Gemini API Error {response.status_code}: {error_msg}")
-        raise Exception(f"API Error {response.status_code}: {error_msg}")
-
-# --- Helper Functions ---
-def extract_text_from_pdf(uploaded_file, start_page, end_page):
+# Scanned PDF pages are transcribed by Gemini once per file and page. The
+# cache is in memory unless TRANSCRIPT_CACHE_DB names a SQLite file.
+@st.cache_resource
+def init_transcript_cache():
     try:
-        doc = fitz.open(stream=uploaded_file.read(), filetype="pdf")
-        start_index = max(0, start_page - 1) 
-        end_index = min(len(doc), end_page)
-        text = ""
-        for i in range(start_index, end_index):
-            text += doc[i].get_text("text") + "\n"
-        return text
+        if st.secrets.get("TRANSCRIPT_CACHE_DB"):
+            return configure_transcript_cache(SQLiteTranscriptCache(st.secrets["TRANSCRIPT_CACHE_DB"]))
     except Exception as e:
-        logging.error(f"[PDF Extraction Error] {e}")
-        return ""
+        logging.error(f"[Transcript Cache Init Error] {e}")
+    return None
+
+init_transcript_cache()
 
 def render_question_config(key_prefix=""):
     """Renders the Type/Count/Marks/Difficulty grid (MCQ, FIB, True/False,
@@ -764,408 +1021,115 @@ def render_question_config(key_prefix=""):
     return (mcq_c, mcq_d, mcq_m, fib_c, fib_d, fib_m, tf_c, tf_d, tf_m,
             short_c, short_d, short_m, long_c, long_d, long_m, total_q, total_m)
 
-def build_question_prompt(mcq_c, mcq_d, mcq_m, fib_c, fib_d, fib_m, tf_c, tf_d, tf_m, short_c, short_d, short_m, long_c, long_d, long_m, include_answers, selected_language, subject):
-    reqs = []
-    if mcq_c > 0: reqs.append(f"## Multiple Choice Questions [{mcq_m} Mark(s) Each]\n- {mcq_c} MCQs (Difficulty: {mcq_d}).")
-    if fib_c > 0: reqs.append(f"## Fill in the Blanks [{fib_m} Mark(s) Each]\n- {fib_c} FIBs (Difficulty: {fib_d}). MUST include 4 options (A, B, C, D) on a new line for each blank.")
-    if tf_c > 0:  reqs.append(f"## True / False [{tf_m} Mark(s) Each]\n- {tf_c} True/False questions (Difficulty: {tf_d}). MUST include exactly 2 options: (A) True  (B) False on a new line.")
-    if short_c > 0: reqs.append(f"## Short Answer Questions [{short_m} Mark(s) Each]\n- {short_c} Short Qs (Difficulty: {short_d}).")
-    if long_c > 0:  reqs.append(f"## Long Answer Questions [{long_m} Mark(s) Each]\n- {long_c} Long Qs (Difficulty: {long_d}).")
-    
-    if selected_language == "English":
-        lang_instruction = "LANGUAGE RULE: Generate the ENTIRE paper and answers strictly in the English language."
-    elif selected_language == "Hindi":
-        lang_instruction = "LANGUAGE RULE: Generate the paper in simple Hindi. Avoid tough academic Hindi words. Provide English terms in brackets for technical words. Example: 'अंश [Numerator]'."
-    else:
-        lang_instruction = "LANGUAGE RULE: Generate the paper in Hinglish (a mix of simple Hindi and English). Provide English terms in brackets for technical words."
-    
-    base_prompt = "\n\n".join(reqs) + f"\n\n{lang_instruction}\n\n" + f"""CRITICAL FORMATTING:
-1. STRICTLY adhere to the subject: **{subject}**. Do NOT generate general knowledge questions.
-2. CONTINUOUS NUMBERING: Number ALL questions continuously from start to finish (e.g., **Q1.**, **Q2.**, **Q3.**, etc.) across ALL sections. Do NOT restart numbering at 1 for a new section. 
-3. OPTIONS ON NEW LINE: For MCQs, FIBs, and T/F, ALWAYS place the options on a NEW LINE directly below the question text. Do NOT place options on the same line as the question.
-   Correct Example:
-   **Q1.** What is the value of x?
-   (A) 1   (B) 2   (C) 3   (D) 4
-4. MARKS IN HEADERS: Include the marks per question in the section headers as provided above.
-5. DETAILED ANSWERS: In the Answer Key, provide detailed, step-by-step explanations for Short and Long answer questions, proportional to their marks (e.g., 5-mark questions need a long, detailed explanation). Ensure answer numbers match the continuous question numbers.
-6. DELIMITER: Separate EVERY single Question, Section Header, and the Answer Key with the delimiter `|||` on a new line. Do not group multiple questions together.
-7. MATH: USE UNICODE SYMBOLS ONLY (θ, π, √, ²). NO LaTeX. Write fractions as a/b.
-8. DO NOT generate any Title, Institute Name, Time, or Marks at the very top. Start directly with the first section header.
-    """
-    
-    if include_answers: return base_prompt + "\nAdd '# ANSWER KEY' at end, also separated by `|||`. Ensure numbering in answers exactly matches the continuous numbering of the questions."
-    return base_prompt
-
-def extract_question_number(text):
-    """Pulls the question number out of a block like '**Q3.** ...' or '3. ...'
-    so we can find the matching Answer Key entry for a regenerated question."""
-    m = re.search(r'Q\.?\s*(\d+)', text, re.IGNORECASE)
-    if m:
-        return m.group(1)
-    m2 = re.match(r'\s*\**\s*(\d+)\.', text)
-    if m2:
-        return m2.group(1)
-    return None
-
-def regenerate_single_question(old_text, api_key, model_name, subject, topics):
-    """Regenerates one question, staying on-topic, and also returns a fresh
-    answer/solution for it so the Answer Key can be kept in sync."""
-    topic_context = topics.strip() if topics and topics.strip() else subject
-    prompt = (
-        f"You are regenerating ONE question from a {subject} exam paper. "
-        f"The paper's topics are: {topic_context}. Stay strictly within this subject and these topics — "
-        f"do not drift into unrelated topics.\n\n"
-        f"The original question being replaced was:\n{old_text}\n\n"
-        "Write a NEW question of the same type, difficulty, and marks as the original, strictly on the same "
-        "subject/topics. Keep the same question number label if the original had one (e.g. 'Q3.'). "
-        "Use Unicode math symbols (θ, π, √, ²) instead of LaTeX.\n\n"
-        "Then on a new line write the exact delimiter @@@ANSWER@@@ followed by the correct answer/solution for "
-        "THIS NEW question — a brief correct option letter for MCQ/True-False/Fill-in-the-blank, or a full "
-        "step-by-step explanation for Short/Long answer questions.\n\n"
-        "Output ONLY the question text, then @@@ANSWER@@@, then the answer. No extra commentary."
-    )
-    resp_text = generate_gemini_content(prompt, api_key, model_name)
-    if "@@@ANSWER@@@" in resp_text:
-        q_part, a_part = resp_text.split("@@@ANSWER@@@", 1)
-        return q_part.strip(), a_part.strip()
-    return resp_text.strip(), None
-
-def clean_math_for_word(text):
-    text = re.sub(r'\\frac\{([^}]+)\}\{([^}]+)\}', r'(\1)/(\2)', text)
-    text = re.sub(r'\\\((.*?)\\\)', r'\1', text)
-    text = re.sub(r'\\\[(.*?)\\\]', r'\1', text)
-    latex_map = {r'\pi': 'π', r'\theta': 'θ', r'\sqrt': '√', r'\times': '×', r'\div': '÷', '$': '', '^2': '²', '^3': '³'}
-    for k, v in latex_map.items(): text = text.replace(k, v)
-    text = text.replace('☐', '[ ]').replace('☑', '[x]').replace('•', '-').replace('◦', '-')
-    text = text.replace('\u200b', '').replace('\u2022', '-').replace('\u25cf', '-').replace('\u25cb', '-')
-    return text.strip()
-
-# 🌟 HTML RENDERER 🌟
-def create_a4_html(md_content, i_name, i_address, i_contact, t_name, inst_logo=None, is_2_col=False, sub="Subject", grade="Class", total_m="Marks", exam_time="Time", topics=""):
-    md_content = clean_math_for_word(md_content)
-    
-    md_content = re.sub(r"^#.*?\*\*\*", "", md_content, count=1, flags=re.DOTALL).strip()
-    md_content = re.sub(r"^\*\*Subject:\*\*.*?\n", "", md_content, flags=re.MULTILINE)
-    md_content = re.sub(r"^\*\*Class:\*\*.*?\n", "", md_content, flags=re.MULTILINE)
-    md_content = re.sub(r"^\*\*Marks:\*\*.*?\n", "", md_content, flags=re.MULTILINE)
-    md_content = re.sub(r"^\*\*Time:\*\*.*?\n", "", md_content, flags=re.MULTILINE)
-    
-    md_content = re.sub(r"^\d+\.\s", "**Q.** ", md_content, flags=re.MULTILINE)
-    md_content = md_content.strip()
-    
-    logo_html_inline = ""
-    logo_footer = ""
-    if inst_logo:
-        inst_logo.seek(0)
-        b64 = base64.b64encode(inst_logo.getvalue()).decode()
-        logo_html_inline = f"<td style='width: 1%; padding-right: 15px; vertical-align: middle;'><img src='data:{inst_logo.type};base64,{b64}' style='max-height: 55px;'/></td>"
-        logo_footer = f"<img src='data:{inst_logo.type};base64,{b64}' style='height: 18px; vertical-align: middle; margin-right: 8px;'/>"
-    
-    main_heading_text = topics.strip().upper() if topics.strip() != "" else sub.upper()
-    
-    custom_header = f"""
-    <div style='border-bottom: 2px solid black; padding-bottom: 10px; margin-bottom: 10px; width: 100%;'>
-        <table style='width: 100%; border-collapse: collapse; border: none; margin-bottom: 10px;'>
-            <tr>
-                <td style='text-align: center; vertical-align: middle; border: none;'>
-                    <table style='margin: 0 auto;'>
-                        <tr>
-                            {logo_html_inline}
-                            <td style='vertical-align: middle;'>
-                                <h1 style='margin: 0; font-size: 24px; font-family: "Noto Sans", "Nirmala UI", "Times New Roman", serif; font-weight: 900; text-transform: uppercase; white-space: nowrap;'>{i_name}</h1>
-                            </td>
-                        </tr>
-                    </table>
-                </td>
-            </tr>
-        </table>
-        <table style='width: 100%; font-weight: bold; font-size: 13px; border: none;'>
-            <tr>
-                <td style='text-align: left; vertical-align: bottom; width: 33%; border: none;'>Class : {grade}<br>Time : {exam_time}</td>
-                <td style='text-align: center; vertical-align: middle; width: 34%; border: none;'>
-                    <div style='border: 2px solid black; border-radius: 12px; display: inline-block; padding: 4px 25px; font-weight: bold; font-size: 14px; background: white;'>
-                        EXAMINATION
-                    </div>
-                </td>
-                <td style='text-align: right; vertical-align: bottom; width: 33%; border: none;'>Sub.: {sub}<br>Marks: {total_m}</td>
-            </tr>
-        </table>
-    </div>
-    <div style='border-top: 1px solid black; border-bottom: 3px solid black; padding: 2px 0; margin-bottom: 15px;'>
-        <div style='background-color: black; color: white; padding: 5px; text-align: center; font-weight: bold; font-size: 15px; text-transform: uppercase; letter-spacing: 1px;'>
-            Multiple Choice Questions & Theory
-        </div>
-    </div>
-    <h2 style='text-align: center; text-decoration: underline; text-transform: uppercase; margin-top: 0; margin-bottom: 15px; font-size: 18px;'>{main_heading_text}</h2>
-    """
-
-    ans_split_marker = "|||ANSWER_KEY_SPLIT|||"
-    md_content = re.sub(r'(?im)^#+\s*Answer Key.*$', ans_split_marker, md_content)
-    
-    if ans_split_marker in md_content:
-        q_part, a_part = md_content.split(ans_split_marker)
-        final_inner_html = f"""
-        {custom_header}
-        <div class="content-body">{markdown.markdown(q_part.strip())}</div>
-        <div style="page-break-before: always; width: 100%;"></div>
-        {custom_header}
-        <h2 style="text-align: center; text-decoration: underline; margin-bottom: 15px;">ANSWER KEY</h2>
-        <div class="content-body">{markdown.markdown(a_part.strip())}</div>
-        """
-    else:
-        final_inner_html = f"""
-        {custom_header}
-        <div class="content-body">{markdown.markdown(md_content.strip())}</div>
-        """
-    
-    col_style = "column-count: 2; column-gap: 15mm; column-rule: 1px solid #000; font-size: 14px;" if is_2_col else "font-size: 16px;"
-
-    return f"""<!DOCTYPE html><html><head><meta charset="UTF-8"><style>
-    body {{ background: #f0f0f0; font-family: 'Noto Sans', 'Nirmala UI', 'Times New Roman', serif; margin: 0; padding: 20px; display: flex; justify-content: center; }} 
-    .a4-page {{ background: white; width: 210mm; min-height: 297mm; padding: 20px; box-shadow: 0 0 10px rgba(0,0,0,0.2); box-sizing: border-box; position: relative; overflow: hidden; }} 
-    .watermark {{ position: fixed; top: 50%; left: 50%; transform: translate(-50%, -50%) rotate(-45deg); font-size: 85px; color: rgba(0, 0, 0, 0.06); z-index: -9999; pointer-events: none; white-space: nowrap; font-weight: bold; text-transform: uppercase; }}
-    table {{ width: 100%; border-collapse: collapse; border: none; position: relative; z-index: 1; }}
-    td {{ border: none; padding: 0; }}
-    @media print {{ 
-        @page {{ size: A4; margin: 0; }} 
-        body {{ background: white; padding: 0; margin: 0; display: block; }} 
-        .a4-page {{ box-shadow: none; width: 100%; min-height: auto; padding: 10mm; margin: 0; page-break-after: always; }} 
-        .watermark {{ color: rgba(0, 0, 0, 0.06) !important; -webkit-print-color-adjust: exact; print-color-adjust: exact; }}
-        tfoot {{ display: table-footer-group; }}
-    }} 
-    h1, h2, h3 {{ text-align: center; column-span: all; }} 
-    h2 {{ font-size: 16px; border-bottom: 1px dashed #ccc; padding-bottom: 5px; }}
-    .content-body {{ {col_style} position: relative; z-index: 1; text-align: justify; }} 
-    .content-body p {{ margin-bottom: 8px; margin-top: 4px; }}
-    .footer-content {{ text-align: center; margin-top: 20px; padding-top: 10px; border-top: 2px dashed #bbb; font-size: 13px; color: #444; position: relative; z-index: 1; background: white; }}
-    </style></head><body><div class="a4-page">
-    <div class="watermark">{i_name}</div>
-    <table>
-        <thead><tr><td></td></tr></thead>
-        <tbody><tr><td>{final_inner_html}</td></tr></tbody>
-        <tfoot><tr><td>
-            <div class="footer-content">
-                {logo_footer}<strong>{i_name}</strong> | 📍 {i_address} | 📞 {i_contact} | 👨‍🏫 <strong>{t_name}</strong>
-            </div>
-        </td></tr></tfoot>
-    </table>
-    </div></body></html>"""
-
-def html_to_pdf(html_string):
-    try:
-        buf = BytesIO()
-        result = pisa.CreatePDF(html_string, dest=buf)
-        if result.err:
-            return None
-        return buf.getvalue()
-    except Exception as e:
-        logging.error(f"[PDF Generation Error] {e}")
-        return None
-
-# 🌟 WORD RENDERER 🌟
-def create_word_docx(md_content, i_name, i_address, i_contact, t_name, inst_logo=None, is_2_col=False, sub="Subject", grade="Class", total_m="Marks", exam_time="Time", topics=""):
-    doc = Document()
-    
-    md_content = re.sub(r"^#.*?\*\*\*", "", md_content, count=1, flags=re.DOTALL).strip()
-    md_content = re.sub(r"^\*\*Subject:\*\*.*?\n", "", md_content, flags=re.MULTILINE)
-    md_content = re.sub(r"^\*\*Class:\*\*.*?\n", "", md_content, flags=re.MULTILINE)
-    md_content = re.sub(r"^\*\*Marks:\*\*.*?\n", "", md_content, flags=re.MULTILINE)
-    md_content = re.sub(r"^\*\*Time:\*\*.*?\n", "", md_content, flags=re.MULTILINE)
-    md_content = re.sub(r"^\d+\.\s", "**Q.** ", md_content, flags=re.MULTILINE)
-    md_content = md_content.strip()
-        
-    md_content = md_content.replace('\r', '')
-    
-    style = doc.styles['Normal']
-    font = style.font
-    font.name = 'Arial' 
-    font.size = Pt(11)
-    
-    rFonts = style.element.rPr.rFonts
-    if rFonts is not None:
-        rFonts.set(qn('w:cs'), 'Noto Sans Devanagari') 
-        rFonts.set(qn('w:ascii'), 'Arial')
-        rFonts.set(qn('w:hAnsi'), 'Arial')
-    style_lang = style.element.rPr.find(qn('w:lang'))
-    if style_lang is None:
-        style_lang = style.element.rPr.makeelement(qn('w:lang'), {})
-        style.element.rPr.append(style_lang)
-    style_lang.set(qn('w:bidi'), 'hi-IN')
-    
-    for i in range(3):
-        try:
-            h_style = doc.styles[f'Heading {i}']
-            h_style.font.name = 'Arial'
-            if h_style.element.rPr.rFonts is not None:
-                h_style.element.rPr.rFonts.set(qn('w:cs'), 'Noto Sans Devanagari')
-                h_style.element.rPr.rFonts.set(qn('w:ascii'), 'Arial')
-                h_style.element.rPr.rFonts.set(qn('w:hAnsi'), 'Arial')
-            h_style.font.color.rgb = RGBColor(0, 0, 0)
-            if i == 0:
-                h_style.font.size = Pt(16)
-                h_style.font.bold = True
-            elif i == 1:
-                h_style.font.size = Pt(12)
-                h_style.font.bold = True
-            elif i == 2:
-                h_style.font.size = Pt(11)
-                h_style.font.bold = True
-        except KeyError: pass
-
-    if is_2_col:
-        for section in doc.sections:
-            section.top_margin = section.bottom_margin = section.left_margin = section.right_margin = Inches(0.4)
-
-    def apply_cs_font(run):
-        rpr = run._r.get_or_add_rPr()
-        rfonts = rpr.find(qn('w:rFonts'))
-        if rfonts is None:
-            rfonts = rpr.makeelement(qn('w:rFonts'), {})
-            rpr.append(rfonts)
-        rfonts.set(qn('w:cs'), 'Noto Sans Devanagari')
-        rfonts.set(qn('w:ascii'), 'Arial')
-        rfonts.set(qn('w:hAnsi'), 'Arial')
-        # Without an explicit language tag, Word doesn't reliably classify
-        # Devanagari text as "complex script" and may render it with the
-        # ascii font (Arial, no Devanagari glyphs = tofu boxes) regardless
-        # of the w:cs font specified above. This tag is what makes Word
-        # actually route the text correctly.
-        lang = rpr.find(qn('w:lang'))
-        if lang is None:
-            lang = rpr.makeelement(qn('w:lang'), {})
-            rpr.append(lang)
-        lang.set(qn('w:bidi'), 'hi-IN')
-
-    def insert_chate_header():
-        title_table = doc.add_table(rows=1, cols=1)
-        p1 = title_table.cell(0,0).paragraphs[0]
-        p1.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        
-        if inst_logo is not None:
-            try:
-                inst_logo.seek(0)
-                r_logo = p1.add_run()
-                r_logo.add_picture(inst_logo, height=Inches(0.38))
-                p1.add_run("   ") 
-            except Exception: pass
-            
-        r1 = p1.add_run(i_name.upper())
-        r1.bold = True
-        r1.font.size = Pt(18)
-        apply_cs_font(r1)
-        
-        details_table = doc.add_table(rows=1, cols=3)
-        details_table.autofit = False
-        for cell in details_table.columns[0].cells: cell.width = Inches(2.0)
-        for cell in details_table.columns[1].cells: cell.width = Inches(3.0)
-        for cell in details_table.columns[2].cells: cell.width = Inches(2.0)
-
-        p3 = details_table.cell(0,0).paragraphs[0]
-        p3.alignment = WD_ALIGN_PARAGRAPH.LEFT
-        r3 = p3.add_run(f"Class : {grade}\nTime : {exam_time}")
-        r3.bold = True
-        r3.font.size = Pt(10)
-        apply_cs_font(r3)
-
-        p4 = details_table.cell(0,1).paragraphs[0]
-        p4.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        r4 = p4.add_run("\n[ EXAMINATION ]")
-        r4.bold = True
-        r4.font.size = Pt(12)
-        apply_cs_font(r4)
-
-        p2 = details_table.cell(0,2).paragraphs[0]
-        p2.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-        r2 = p2.add_run(f"Sub.: {sub}\nMarks: {total_m}")
-        r2.bold = True
-        r2.font.size = Pt(10)
-        apply_cs_font(r2)
-        
-        doc.add_paragraph("__________________________________________________________________________").alignment = WD_ALIGN_PARAGRAPH.CENTER
-        pt = doc.add_paragraph("MULTIPLE CHOICE QUESTIONS & THEORY")
-        pt.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        pt.runs[0].bold = True
-        apply_cs_font(pt.runs[0])
-        
-        main_heading_text = topics.strip().upper() if topics.strip() != "" else sub.upper()
-        ptopics = doc.add_paragraph(main_heading_text)
-        ptopics.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        ptopics.runs[0].underline = True
-        ptopics.runs[0].font.size = Pt(14)
-        ptopics.runs[0].bold = True
-        apply_cs_font(ptopics.runs[0])
-        doc.add_paragraph() 
-
-    insert_chate_header()
-
-    if is_2_col:
-        new_section = doc.add_section(0) 
-        sectPr = new_section._sectPr
-        cols = sectPr.xpath('./w:cols')[0]
-        cols.set(qn('w:num'), '2')
-        cols.set(qn('w:space'), '720') 
-
-    for line in md_content.split('\n'):
-        line_clean = line.strip()
-        if not line_clean: continue
-        line_clean = clean_math_for_word(line_clean)
-        
-        if "Answer Key" in line_clean or "ANSWER KEY" in line_clean:
-            doc.add_page_break() 
-            insert_chate_header() 
-            doc.add_heading("Answer Key", level=1)
-            continue
-            
-        if line_clean.startswith('# '): 
-            doc.add_heading(line_clean.replace('# ', ''), level=1)
-        elif line_clean.startswith('## '): 
-            doc.add_heading(line_clean.replace('## ', ''), level=2)
-        else:
-            p = doc.add_paragraph()
-            p.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY 
-            parts = re.split(r'\*\*(.*?)\*\*', line_clean)
-            for i, part in enumerate(parts):
-                run = p.add_run(part)
-                if i % 2 == 1: run.bold = True
-                apply_cs_font(run)
-                
-    if doc.sections:
-        footer = doc.sections[0].footer
-        footer_para = footer.paragraphs[0] if footer.paragraphs else footer.add_paragraph()
-        footer_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        
-        if inst_logo is not None:
-            try:
-                inst_logo.seek(0)
-                run_logo = footer_para.add_run()
-                run_logo.add_picture(inst_logo, height=Inches(0.18))
-                footer_para.add_run("  ") 
-            except Exception: pass
-            
-        run_name = footer_para.add_run(f"{i_name}  |  ")
-        run_name.font.size = Pt(10)
-        run_name.font.bold = True
-        run_name.font.color.rgb = RGBColor(100, 100, 100)
-        apply_cs_font(run_name)
-        
-        run_rest = footer_para.add_run(f"📍 {i_address}  |  📞 {i_contact}  |  👨‍🏫 {t_name}")
-        run_rest.font.size = Pt(10)
-        run_rest.font.color.rgb = RGBColor(100, 100, 100)
-        apply_cs_font(run_rest)
-            
-    bio = BytesIO()
-    doc.save(bio)
-    return bio.getvalue()
+def render_variant_sets(blocks, key_prefix, sub, grade, total_m, topics):
+    """Renders the 'Shuffled Sets' expander under a generated paper. All sets
+    are built locally from `blocks` and rendered in one batch into a ZIP."""
+    with st.expander("🔀 Shuffled Sets (Set A/B/C)", expanded=False):
+        st.caption("Builds shuffled copies of this paper to limit copying: question order changes within each section, MCQ options are re-lettered, and the Answer Key is updated to match. No extra credits used.")
+        vc1, vc2 = st.columns(2)
+        n_sets = vc1.number_input("Number of sets", 2, len(VARIANT_SET_LABELS), 3, key=f"{key_prefix}n_sets")
+        set_formats = vc2.multiselect("Formats", BATCH_FORMATS, default=BATCH_FORMATS, key=f"{key_prefix}set_formats")
+        zip_key = f"{key_prefix}sets_zip"
+        if st.button("🔀 Build Sets", key=f"{key_prefix}build_sets", use_container_width=True):
+            if not set_formats:
+                st.error("Please select at least one format.")
+            else:
+                with st.spinner(f"Building {n_sets} sets..."):
+                    try:
+                        variants = generate_paper_variants(blocks, n_sets)
+                        set_papers = [{
+                            'id': label, 'subject': f"{sub} ({label})", 'class': grade, 'marks': total_m, 'topics': topics,
+                            'file_stem': f"{safe_file_stem(sub)}_{label.replace(' ', '_')}",
+                            'content': "\n\n".join(b['text'] for b in v_blocks)
+                        } for label, v_blocks in variants]
+                        discard_zip(zip_key)
+                        st.session_state[zip_key], sets_missing = build_papers_zip(
+                            set_papers, set_formats, inst_name, inst_address, inst_contact, teacher_name, inst_logo, is_two_column, exam_time, new_zip_path())
+                        if sets_missing:
+                            st.warning(f"{len(sets_missing)} file(s) couldn't be rendered and were skipped: {', '.join(sets_missing)}")
+                    except Exception as e:
+                        logging.error(f"[Shuffled Sets Error] {e}")
+                        discard_zip(zip_key)
+                        st.error("Couldn't build the shuffled sets. Please try again.")
+        render_zip_download(zip_key, "⬇️ Download Sets (ZIP)", f"{safe_file_stem(sub)}_Sets.zip", key=f"{key_prefix}sets_dl")
+
+def render_blocks_form(blocks_key, saved_key, widget_prefix):
+    """All block text areas live in one form, so typing never reruns the
+    tab; every change is committed together when 'Apply Edits' is clicked.
+    Returns how many blocks changed on this submit."""
+    blocks = st.session_state[blocks_key]
+    with st.form(f"{widget_prefix}form"):
+        new_texts = [st.text_area(f"Question {i+1}", b['text'], height=100, key=f"{widget_prefix}{b['id']}")
+                     for i, b in enumerate(blocks)]
+        submitted = st.form_submit_button("💾 Apply Edits", use_container_width=True)
+    if not submitted:
+        return 0
+    changed = 0
+    for b, new_text in zip(blocks, new_texts):
+        if new_text != b['text']:
+            b['text'] = new_text
+            changed += 1
+    if changed:
+        st.session_state[saved_key] = False
+        st.success(f"Applied {changed} edit(s).")
+    return changed
+
+def render_regenerate_picker(blocks_key, saved_key, key_prefix, subject, topics, context=None):
+    """Multi-select regeneration: the picked questions are rewritten
+    concurrently and every question/answer-key update is applied in one
+    state commit, followed by a single rerun."""
+    blocks = st.session_state[blocks_key]
+    note = st.session_state.pop(f"{key_prefix}regen_note", None)
+    if note:
+        st.warning(note)
+    st.caption("Regenerating a question also updates its matching Answer Key entry, if one exists.")
+    regen_col, regen_btn_col = st.columns([5, 1])
+    picked = regen_col.multiselect("Questions to regenerate", range(len(blocks)), key=f"{key_prefix}regen_pick", label_visibility="collapsed",
+                                   placeholder="Pick one or more questions to regenerate",
+                                   format_func=lambda i, blocks=blocks: f"{i+1}. {blocks[i]['text'][:70]}")
+    if regen_btn_col.button("🔄 Regenerate", key=f"{key_prefix}regen_btn", disabled=not picked, help="Ask AI to write fresh versions of the picked questions (and their answer key entries, if present)"):
+        with st.spinner(f"Regenerating {len(picked)} question(s)..."), usage_context(st.session_state.username, f"{key_prefix or 'create_'}regenerate", {"questions": len(picked)}):
+            results, failed = regenerate_questions(blocks, sorted(picked), active_api_key, working_model_name, subject, topics, context)
+        if not results:
+            st.error("Couldn't regenerate the selected question(s). Please try again.")
+            return
+        for i, (new_q_text, new_answer_text) in results.items():
+            replace_question_block(blocks, i, new_q_text, new_answer_text)
+        st.session_state[saved_key] = False
+        del st.session_state[f"{key_prefix}regen_pick"]
+        if failed:
+            st.session_state[f"{key_prefix}regen_note"] = f"Couldn't regenerate question(s) {', '.join(str(i + 1) for i in sorted(failed))}. The rest were updated."
+        rerun_script(scope="fragment")
+
+def render_downloads(cache_key, paper_md, sub, grade, total_m, topics):
+    """Returns (html, word, pdf) for the current paper. The three renders are
+    kept in session state and reused until the paper or any header setting
+    actually changes, so unrelated reruns of the tab don't re-export."""
+    logo_sig = hashlib.sha1(inst_logo.getvalue()).hexdigest() if inst_logo is not None else None
+    sig = hashlib.sha1(repr((paper_md, inst_name, inst_address, inst_contact, teacher_name, logo_sig,
+                             is_two_column, sub, grade, total_m, exam_time, topics)).encode()).hexdigest()
+    cached = st.session_state.get(cache_key)
+    if cached and cached["sig"] == sig:
+        return cached["html"], cached["word"], cached["pdf"]
+    html = create_a4_html(paper_md, inst_name, inst_address, inst_contact, teacher_name, inst_logo, is_two_column, sub, grade, total_m, exam_time, topics)
+    word = create_word_docx(paper_md, inst_name, inst_address, inst_contact, teacher_name, inst_logo, is_two_column, sub, grade, total_m, exam_time, topics)
+    pdf = html_to_pdf(html)
+    st.session_state[cache_key] = {"sig": sig, "html": html, "word": word, "pdf": pdf}
+    return html, word, pdf
 
 # ==========================================
 # --- MAIN LAYOUT ---
 # ==========================================
+if "flash_msg" in st.session_state:
+    st.toast(st.session_state.pop("flash_msg"), icon="✅")
+
 tab_create, tab_bseb, tab_digitize, tab_history = st.tabs(["🏠 Create Paper", "🎓 BSEB Board", "📷 Digitize Handwritten", "🗂️ Cloud History"])
 
-with tab_create:
+@isolated_section("tab_create")
+def render_create_tab():
     if not is_pro and papers_used >= FREE_LIMIT:
         st.error("Free Trial Expired! Please Upgrade.")
-        st.stop()
+        return
         
     st.markdown("### 1. Source")
     source = st.radio("Method:", ["⚡ Quick", "📄 PDF Extract"], horizontal=True, label_visibility="collapsed")
@@ -1191,24 +1155,40 @@ with tab_create:
         end_p = c4.number_input("End Page", min_value=1, value=5)
         
         if up_pdf is not None:
-            pdf_text = extract_text_from_pdf(up_pdf, start_p, end_p)
+            # Read once per file and page range; scanned pages only go to Gemini the first time.
+            extract_key = (up_pdf.file_id, start_p, end_p)
+            extracted = st.session_state.get("pdf_extract")
+            if not extracted or extracted["key"] != extract_key:
+                with st.spinner("Reading the PDF (scanned pages take a little longer)..."), usage_context(st.session_state.username, "pdf_transcribe", {"pages": end_p - start_p + 1}):
+                    text, unread = read_pdf_pages(up_pdf.getvalue(), start_p, end_p, active_api_key, working_model_name)
+                extracted = st.session_state.pdf_extract = {"key": extract_key, "text": text, "unread": unread}
+            pdf_text = extracted["text"]
             st.success(f"Extracted {len(pdf_text)} characters from pages {start_p} to {end_p}.")
+            if extracted["unread"]:
+                st.warning(f"⚠️ Couldn't read scanned page(s) {', '.join(map(str, extracted['unread']))}, so the paper won't cover them.")
+                if st.button("🔄 Retry Unread Pages"):
+                    st.session_state.pop("pdf_extract", None)
+                    rerun_script()
 
     st.markdown("---")
     st.markdown("### 2. Counts & Marks")
+    question_config = render_question_config()
     (mcq_c, mcq_d, mcq_m, fib_c, fib_d, fib_m, tf_c, tf_d, tf_m,
-     short_c, short_d, short_m, long_c, long_d, long_m, total_q, total_m) = render_question_config()
+     short_c, short_d, short_m, long_c, long_d, long_m, total_q, total_m) = question_config
 
     if "blocks_saved" not in st.session_state: st.session_state.blocks_saved = True
     if "confirm_overwrite" not in st.session_state: st.session_state.confirm_overwrite = False
 
+    use_bank = st.toggle("♻️ Reuse questions from my Question Bank", key="use_bank",
+                         help="Questions from your earlier papers are reused first (never ones used in the last 90 days); "
+                              "only the rest are written by AI. A paper made entirely from the bank doesn't use a credit.")
     generate_clicked = st.button("🚀 Generate Paper", use_container_width=True)
 
     if generate_clicked and st.session_state.blocks and not st.session_state.blocks_saved and not st.session_state.confirm_overwrite:
         st.warning("You have an unsaved paper above (not saved to Cloud History yet). Generating a new one will replace it.")
         if st.button("Generate anyway (discard current paper)", use_container_width=True):
             st.session_state.confirm_overwrite = True
-            st.rerun()
+            rerun_script(scope="fragment")
         generate_clicked = False
 
     if generate_clicked and (not st.session_state.blocks or st.session_state.blocks_saved or st.session_state.confirm_overwrite):
@@ -1222,82 +1202,92 @@ with tab_create:
             st.session_state.current_class = grade
             st.session_state.current_marks = str(total_m)
 
-            q_reqs = build_question_prompt(
-                mcq_c, mcq_d, mcq_m, fib_c, fib_d, fib_m, tf_c, tf_d, tf_m, short_c, short_d, short_m, long_c, long_d, long_m, include_answer_key, paper_language, sub
-            )
-
-            if source == "📄 PDF Extract" and pdf_text != "":
-                prompt = f"Subject: {sub}\nClass: {grade}\nTopics: {syl}\n\n{q_reqs}\n\nIMPORTANT: Start directly with the questions. DO NOT generate any Title, Institute Name, Time, or Marks at the top.\n\nCREATE QUESTIONS STRICTLY FROM THE FOLLOWING TEXT EXTRACTED FROM A BOOK:\n\n{pdf_text}"
-            else:
-                prompt = f"Subject: {sub}\nClass: {grade}\nTopics: {syl}\n\n{q_reqs}\n\nIMPORTANT: Start directly with the questions. DO NOT generate any Title, Institute Name, Time, or Marks at the top."
-
-            with st.spinner("Generating Paper..."):
+            bank_meta = {"class": grade, "subject": sub, "chapter": syl, "language": paper_language,
+                         "difficulty": {"mcq": mcq_d, "fib": fib_d, "tf": tf_d, "short": short_d, "long": long_d}}
+            bank = init_question_bank() if use_bank else None
+            bank_sections, shortfall = [], {}
+            if bank is not None:
                 try:
-                    resp_text = generate_gemini_content(prompt, active_api_key, working_model_name)
-                    blocks = resp_text.split("|||")
-                    st.session_state.blocks = [{'id': str(uuid.uuid4()), 'text': b.strip()} for b in blocks if b.strip()]
+                    wanted = {"mcq": (mcq_c, mcq_m, mcq_d), "fib": (fib_c, fib_m, fib_d), "tf": (tf_c, tf_m, tf_d),
+                              "short": (short_c, short_m, short_d), "long": (long_c, long_m, long_d)}
+                    bank_sections, shortfall = bank.assemble(
+                        st.session_state.username, grade, sub, wanted, chapter=syl, language=paper_language, include_answers=include_answer_key)
+                except Exception as e:
+                    logging.error(f"[Question Bank Error] {e}")
+                    bank = None
+            # With the bank on, only the shortfall goes to Gemini (as JSON, to
+            # merge by section and check against recently used questions).
+            count = (lambda kind, n: shortfall.get(kind, 0)) if bank is not None else (lambda kind, n: n)
+            context = book_context(pdf_text) if source == "📄 PDF Extract" else None
+            section_marks = requested_section_marks(question_config)
+
+            def paper_prompt(need):
+                q_reqs = build_question_prompt(
+                    need("mcq", mcq_c), mcq_d, mcq_m, need("fib", fib_c), fib_d, fib_m, need("tf", tf_c), tf_d, tf_m,
+                    need("short", short_c), short_d, short_m, need("long", long_c), long_d, long_m,
+                    include_answer_key, paper_language, sub, structured_output or bank is not None
+                )
+                return build_paper_prompt(q_reqs, sub, grade, syl, pdf_text if source == "📄 PDF Extract" else "", book_in_context=True)
+
+            usage_config = {"mcq": count("mcq", mcq_c), "fib": count("fib", fib_c), "tf": count("tf", tf_c), "short": count("short", short_c),
+                            "long": count("long", long_c), "language": paper_language,
+                            "answer_key": include_answer_key, "structured": structured_output or bank is not None,
+                            "pdf_pages": end_p - start_p + 1 if source == "📄 PDF Extract" and pdf_text else 0,
+                            "bank_questions": sum(len(sec["questions"]) for sec in bank_sections)}
+            with st.spinner("Generating Paper..."), usage_context(st.session_state.username, "create", usage_config):
+                try:
+                    missing = {}
+                    if bank is not None:
+                        generate = lambda need: generate_structured_sections(
+                            paper_prompt(lambda kind, n: need.get(kind, 0)), active_api_key, working_model_name, sub, include_answer_key, context,
+                            {kind: section_marks[kind] for kind in need})
+                        sections, missing = bank.fill_shortfall(st.session_state.username, bank_sections, shortfall, generate)
+                        if not sections:
+                            st.warning("⚠️ Every question written repeated one from your last 90 days of papers. Try other topics, or turn off the Question Bank.")
+                            stop_script()
+                        st.session_state.blocks = structured_paper_to_blocks(sections, include_answer_key)
+                    elif structured_output:
+                        st.session_state.blocks = generate_structured_paper(paper_prompt(count), active_api_key, working_model_name, sub, include_answer_key, context, section_marks)
+                    else:
+                        resp_text = generate_gemini_content(paper_prompt(count), active_api_key, working_model_name, context=context)
+                        st.session_state.blocks = split_blocks(resp_text)
                     st.session_state.blocks_saved = False
+                    st.session_state.paper_context = context
+                    st.session_state.history_id = None
+                    st.session_state.bank_meta = bank_meta
                     st.session_state.file_name = f"{sub}_Paper"
-                    update_paper_count(st.session_state.username)
-                    st.rerun()
+                    if not bank_sections or shortfall:
+                        update_paper_count(st.session_state.username)
+                    if missing:
+                        st.session_state.flash_msg = (f"{sum(missing.values())} question(s) couldn't be written without repeating "
+                                                      "your last 90 days of papers, so this paper is shorter.")
+                    elif bank_sections:
+                        st.session_state.flash_msg = f"{usage_config['bank_questions']} question(s) reused from your Question Bank."
+                    rerun_script()
                 except Exception as e:
                     error_msg = str(e).lower()
                     logging.error(f"[Generation Error] {e}") 
-                    if "429" in error_msg or "quota" in error_msg:
+                    if isinstance(e, RateLimited):
+                        st.warning(f"⏳ Lots of teachers are generating right now. Please try again in {e.retry_after:.0f} seconds, or add your own API key in Advanced Settings.")
+                    elif "429" in error_msg or "quota" in error_msg:
                         st.error("🚨 The daily generation limit has been reached! Try again later or add your own API key in Advanced Settings.")
                     else:
                         st.error("Something went wrong generating the paper. Please try again.")
 
+    mark_section("tab_create.editor_and_exports")
     if st.session_state.blocks:
         st.markdown("---")
         with st.expander("🛠️ Edit Questions", expanded=False):
-            st.caption("Regenerating a question also updates its matching Answer Key entry, if one exists.")
-            for i, b in enumerate(st.session_state.blocks):
-                edit_col, regen_col = st.columns([5, 1])
-                new_text = edit_col.text_area(f"Question {i+1}", b['text'], height=100, key=f"block_text_{b['id']}")
-                if new_text != st.session_state.blocks[i]['text']:
-                    st.session_state.blocks[i]['text'] = new_text
-                    st.session_state.blocks_saved = False
-                if regen_col.button("🔄 Regenerate", key=f"regen_{b['id']}", help="Ask AI to write a fresh version of this question (and its answer key entry, if present)"):
-                    with st.spinner("Regenerating..."):
-                        try:
-                            old_number = extract_question_number(b['text'])
-                            new_q_text, new_answer_text = regenerate_single_question(b['text'], active_api_key, working_model_name, sub, syl)
-                            st.session_state.blocks[i]['text'] = new_q_text
-                            st.session_state.blocks[i]['id'] = str(uuid.uuid4())
-
-                            # Keep the Answer Key in sync: find the matching answer
-                            # entry (by question number) and update it too, so the
-                            # solution doesn't stay pointing at the old question.
-                            if new_answer_text and old_number:
-                                ans_key_idx = None
-                                for j, blk in enumerate(st.session_state.blocks):
-                                    if "ANSWER KEY" in blk['text'].upper():
-                                        ans_key_idx = j
-                                        break
-                                if ans_key_idx is not None:
-                                    for j in range(ans_key_idx + 1, len(st.session_state.blocks)):
-                                        blk_number = extract_question_number(st.session_state.blocks[j]['text'])
-                                        if blk_number == old_number:
-                                            st.session_state.blocks[j]['text'] = f"**Q{old_number}.** {new_answer_text}"
-                                            st.session_state.blocks[j]['id'] = str(uuid.uuid4())
-                                            break
-
-                            st.session_state.blocks_saved = False
-                            st.rerun()
-                        except Exception as e:
-                            logging.error(f"[Regenerate Error] {e}")
-                            st.error("Couldn't regenerate this question. Please try again.")
+            render_blocks_form("blocks", "blocks_saved", "block_text_")
+            render_regenerate_picker("blocks", "blocks_saved", "", sub, syl, st.session_state.get("paper_context"))
         
         paper_md = "\n\n".join([b['text'] for b in st.session_state.blocks])
         
-        f_html = create_a4_html(paper_md, inst_name, inst_address, inst_contact, teacher_name, inst_logo, is_two_column, st.session_state.current_subject, st.session_state.current_class, st.session_state.current_marks, exam_time, syl)
-        f_word = create_word_docx(paper_md, inst_name, inst_address, inst_contact, teacher_name, inst_logo, is_two_column, st.session_state.current_subject, st.session_state.current_class, st.session_state.current_marks, exam_time, syl)
+        f_html, f_word, f_pdf = render_downloads("create_downloads", paper_md, st.session_state.current_subject, st.session_state.current_class, st.session_state.current_marks, syl)
         
         c1, c2, c3, c4 = st.columns(4)
         c1.download_button("🖨️ HTML", f_html, f"{st.session_state.current_subject}.html", "text/html")
         c2.download_button("📄 Word", f_word, f"{st.session_state.current_subject}.docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document")
-        f_pdf = html_to_pdf(f_html)
         if f_pdf:
             c3.download_button("📕 PDF", f_pdf, f"{st.session_state.current_subject}.pdf", "application/pdf")
         else:
@@ -1305,19 +1295,26 @@ with tab_create:
         if paper_language in ("Hindi", "Bilingual"):
             st.caption("💡 Hindi text in the Word file needs the free 'Noto Sans Devanagari' font installed on the computer opening it (one-time setup). It's not needed for the PDF.")
         if c4.button("☁️ Save History"):
-            data = {"username": st.session_state.username, "date": datetime.now().strftime("%Y-%m-%d"), "subject": st.session_state.current_subject, "board": board_format, "content": paper_md}
             try:
-                supabase.table("papers").insert(data).execute()
+                st.session_state.history_id = save_paper(st.session_state.username, st.session_state.current_subject, board_format, paper_md, st.session_state.get("history_id"))
                 st.session_state.blocks_saved = True
-                st.success("Saved!")
+                bank_paper(st.session_state.username, st.session_state.blocks, st.session_state.get("bank_meta"))
+                # Full rerun so the Cloud History tab (its own fragment) shows the new paper.
+                st.session_state.flash_msg = "Saved to Cloud History!"
+                rerun_script()
             except Exception as e:
                 logging.error(f"[Save History Error] {e}")
                 st.error("Couldn't save to Cloud History. Please try again.")
+        render_variant_sets(st.session_state.blocks, "", st.session_state.current_subject, st.session_state.current_class, st.session_state.current_marks, syl)
 
-with tab_bseb:
+with tab_create:
+    render_create_tab()
+
+@isolated_section("tab_bseb")
+def render_bseb_tab():
     if not is_pro and papers_used >= FREE_LIMIT:
         st.error("Free Trial Expired! Please Upgrade.")
-        st.stop()
+        return
 
     st.markdown("### 🎓 Bihar Board (BSEB) Paper Builder")
     st.caption("Pick class, subject(s), and chapters from your saved syllabus list — then set question types and marks. Tip: set Board Pattern to 'BSEB (Bihar Board)' in the sidebar for BSEB-style formatting.")
@@ -1347,7 +1344,7 @@ with tab_bseb:
                 new_list = existing_chapters + [c.strip() for c in add_chapters_text.split(",") if c.strip()]
                 if save_chapters(bseb_class, subj, new_list):
                     st.success(f"Saved! Chapters for {bseb_class} - {subj} updated.")
-                    st.rerun()
+                    rerun_script(scope="fragment")
                 else:
                     st.error("Couldn't save chapters. Please try again.")
             bseb_all_chapters.extend([f"{subj}: {c}" for c in chosen_chapters])
@@ -1364,8 +1361,9 @@ with tab_bseb:
 
     st.markdown("---")
     st.markdown("#### 4. Counts & Marks")
+    bseb_question_config = render_question_config(key_prefix="bseb_")
     (b_mcq_c, b_mcq_d, b_mcq_m, b_fib_c, b_fib_d, b_fib_m, b_tf_c, b_tf_d, b_tf_m,
-     b_short_c, b_short_d, b_short_m, b_long_c, b_long_d, b_long_m, b_total_q, b_total_m) = render_question_config(key_prefix="bseb_")
+     b_short_c, b_short_d, b_short_m, b_long_c, b_long_d, b_long_m, b_total_q, b_total_m) = bseb_question_config
 
     if "bseb_blocks" not in st.session_state: st.session_state.bseb_blocks = []
     if "bseb_blocks_saved" not in st.session_state: st.session_state.bseb_blocks_saved = True
@@ -1385,73 +1383,50 @@ with tab_bseb:
             b_q_reqs = build_question_prompt(
                 b_mcq_c, b_mcq_d, b_mcq_m, b_fib_c, b_fib_d, b_fib_m, b_tf_c, b_tf_d, b_tf_m,
                 b_short_c, b_short_d, b_short_m, b_long_c, b_long_d, b_long_m,
-                include_answer_key, paper_language, bseb_sub
-            )
-            b_prompt = (
-                f"Subject: {bseb_sub}\nClass: {bseb_class}\nBoard: Bihar Board (BSEB)\nTopics: {bseb_syl}\n\n{b_q_reqs}\n\n"
-                "IMPORTANT: Start directly with the questions. DO NOT generate any Title, Institute Name, Time, or Marks at the top."
+                include_answer_key, paper_language, bseb_sub, structured_output
             )
+            b_prompt = build_paper_prompt(b_q_reqs, bseb_sub, bseb_class, bseb_syl, board="Bihar Board (BSEB)")
 
-            with st.spinner("Generating BSEB Paper..."):
+            usage_config = {"mcq": b_mcq_c, "fib": b_fib_c, "tf": b_tf_c, "short": b_short_c, "long": b_long_c, "language": paper_language,
+                            "answer_key": include_answer_key, "structured": structured_output}
+            with st.spinner("Generating BSEB Paper..."), usage_context(st.session_state.username, "bseb", usage_config):
                 try:
-                    resp_text = generate_gemini_content(b_prompt, active_api_key, working_model_name)
-                    b_blocks = resp_text.split("|||")
-                    st.session_state.bseb_blocks = [{'id': str(uuid.uuid4()), 'text': b.strip()} for b in b_blocks if b.strip()]
+                    if structured_output:
+                        st.session_state.bseb_blocks = generate_structured_paper(b_prompt, active_api_key, working_model_name, bseb_sub, include_answer_key,
+                                                                                  marks=requested_section_marks(bseb_question_config))
+                    else:
+                        resp_text = generate_gemini_content(b_prompt, active_api_key, working_model_name)
+                        st.session_state.bseb_blocks = split_blocks(resp_text)
                     st.session_state.bseb_blocks_saved = False
+                    st.session_state.bseb_history_id = None
+                    st.session_state.bseb_bank_meta = {
+                        "class": bseb_class, "subject": bseb_sub, "chapter": bseb_syl, "language": paper_language,
+                        "difficulty": {"mcq": b_mcq_d, "fib": b_fib_d, "tf": b_tf_d, "short": b_short_d, "long": b_long_d}}
                     update_paper_count(st.session_state.username)
-                    st.rerun()
+                    rerun_script()
                 except Exception as e:
                     error_msg = str(e).lower()
                     logging.error(f"[BSEB Generation Error] {e}")
-                    if "429" in error_msg or "quota" in error_msg:
+                    if isinstance(e, RateLimited):
+                        st.warning(f"⏳ Lots of teachers are generating right now. Please try again in {e.retry_after:.0f} seconds, or add your own API key in Advanced Settings.")
+                    elif "429" in error_msg or "quota" in error_msg:
                         st.error("🚨 The daily generation limit has been reached! Try again later or add your own API key in Advanced Settings.")
                     else:
                         st.error("Something went wrong generating the paper. Please try again.")
 
+    mark_section("tab_bseb.editor_and_exports")
     if st.session_state.bseb_blocks:
         st.markdown("---")
         with st.expander("🛠️ Edit Questions", expanded=False):
-            st.caption("Regenerating a question also updates its matching Answer Key entry, if one exists.")
-            for i, b in enumerate(st.session_state.bseb_blocks):
-                edit_col, regen_col = st.columns([5, 1])
-                new_text = edit_col.text_area(f"Question {i+1}", b['text'], height=100, key=f"bseb_block_text_{b['id']}")
-                if new_text != st.session_state.bseb_blocks[i]['text']:
-                    st.session_state.bseb_blocks[i]['text'] = new_text
-                    st.session_state.bseb_blocks_saved = False
-                if regen_col.button("🔄 Regenerate", key=f"bseb_regen_{b['id']}", help="Ask AI to write a fresh version of this question (and its answer key entry, if present)"):
-                    with st.spinner("Regenerating..."):
-                        try:
-                            old_number = extract_question_number(b['text'])
-                            new_q_text, new_answer_text = regenerate_single_question(b['text'], active_api_key, working_model_name, bseb_sub, bseb_syl)
-                            st.session_state.bseb_blocks[i]['text'] = new_q_text
-                            st.session_state.bseb_blocks[i]['id'] = str(uuid.uuid4())
-                            if new_answer_text and old_number:
-                                ans_key_idx = None
-                                for j, blk in enumerate(st.session_state.bseb_blocks):
-                                    if "ANSWER KEY" in blk['text'].upper():
-                                        ans_key_idx = j
-                                        break
-                                if ans_key_idx is not None:
-                                    for j in range(ans_key_idx + 1, len(st.session_state.bseb_blocks)):
-                                        blk_number = extract_question_number(st.session_state.bseb_blocks[j]['text'])
-                                        if blk_number == old_number:
-                                            st.session_state.bseb_blocks[j]['text'] = f"**Q{old_number}.** {new_answer_text}"
-                                            st.session_state.bseb_blocks[j]['id'] = str(uuid.uuid4())
-                                            break
-                            st.session_state.bseb_blocks_saved = False
-                            st.rerun()
-                        except Exception as e:
-                            logging.error(f"[BSEB Regenerate Error] {e}")
-                            st.error("Couldn't regenerate this question. Please try again.")
+            render_blocks_form("bseb_blocks", "bseb_blocks_saved", "bseb_block_text_")
+            render_regenerate_picker("bseb_blocks", "bseb_blocks_saved", "bseb_", bseb_sub, bseb_syl)
 
         bseb_paper_md = "\n\n".join([b['text'] for b in st.session_state.bseb_blocks])
-        bseb_html = create_a4_html(bseb_paper_md, inst_name, inst_address, inst_contact, teacher_name, inst_logo, is_two_column, bseb_sub, bseb_class, str(b_total_m), exam_time, bseb_syl)
-        bseb_word = create_word_docx(bseb_paper_md, inst_name, inst_address, inst_contact, teacher_name, inst_logo, is_two_column, bseb_sub, bseb_class, str(b_total_m), exam_time, bseb_syl)
+        bseb_html, bseb_word, bseb_pdf = render_downloads("bseb_downloads", bseb_paper_md, bseb_sub, bseb_class, str(b_total_m), bseb_syl)
 
         bc1, bc2, bc3, bc4 = st.columns(4)
         bc1.download_button("🖨️ HTML", bseb_html, f"{bseb_sub or 'BSEB'}_Paper.html", "text/html")
         bc2.download_button("📄 Word", bseb_word, f"{bseb_sub or 'BSEB'}_Paper.docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document")
-        bseb_pdf = html_to_pdf(bseb_html)
         if bseb_pdf:
             bc3.download_button("📕 PDF", bseb_pdf, f"{bseb_sub or 'BSEB'}_Paper.pdf", "application/pdf")
         else:
@@ -1459,16 +1434,23 @@ with tab_bseb:
         if paper_language in ("Hindi", "Bilingual"):
             st.caption("💡 Hindi text in the Word file needs the free 'Noto Sans Devanagari' font installed on the computer opening it (one-time setup). It's not needed for the PDF.")
         if bc4.button("☁️ Save History", key="bseb_save_history"):
-            data = {"username": st.session_state.username, "date": datetime.now().strftime("%Y-%m-%d"), "subject": bseb_sub or "BSEB Paper", "board": "BSEB", "content": bseb_paper_md}
             try:
-                supabase.table("papers").insert(data).execute()
+                st.session_state.bseb_history_id = save_paper(st.session_state.username, bseb_sub or "BSEB Paper", "BSEB", bseb_paper_md, st.session_state.get("bseb_history_id"))
                 st.session_state.bseb_blocks_saved = True
-                st.success("Saved!")
+                bank_paper(st.session_state.username, st.session_state.bseb_blocks, st.session_state.get("bseb_bank_meta"))
+                # Full rerun so the Cloud History tab (its own fragment) shows the new paper.
+                st.session_state.flash_msg = "Saved to Cloud History!"
+                rerun_script()
             except Exception as e:
                 logging.error(f"[BSEB Save History Error] {e}")
                 st.error("Couldn't save to Cloud History. Please try again.")
+        render_variant_sets(st.session_state.bseb_blocks, "bseb_", bseb_sub or "BSEB", bseb_class, str(b_total_m), bseb_syl)
 
-with tab_digitize:
+with tab_bseb:
+    render_bseb_tab()
+
+@isolated_section("tab_digitize")
+def render_digitize_tab():
     st.markdown("### 📷 Digitize a Handwritten Paper")
     st.caption("Upload photos of a handwritten or scanned question paper — we'll read it and turn it into a clean, formatted digital paper using your saved institute details.")
 
@@ -1486,80 +1468,132 @@ with tab_digitize:
         elif not is_pro and papers_used >= FREE_LIMIT:
             st.error("⚠️ Free Trial Expired! Upgrade to Pro from the sidebar to keep generating/digitizing papers.")
         else:
-            with st.spinner("Reading your paper... this can take a moment for multiple pages."):
+            with st.spinner("Reading your paper... this can take a moment for multiple pages."), usage_context(st.session_state.username, "digitize", {"pages": len(digi_images)}):
                 try:
-                    digi_prompt = (
-                        "You are digitizing a handwritten or scanned question paper from the attached image(s). "
-                        "Transcribe it faithfully — preserve the original question numbering, order, sections, and "
-                        "marks exactly as written. Do not invent new questions, do not change the meaning, and do not "
-                        "add a title, institute name, header, or footer. Only fix obvious spelling/OCR mistakes. "
-                        "Separate each distinct question with the delimiter ||| on its own line."
-                    )
-                    images = [Image.open(f) for f in digi_images]
-                    resp_text = generate_gemini_content(digi_prompt, active_api_key, working_model_name, images=images)
-                    d_blocks = resp_text.split("|||")
-                    st.session_state.digi_blocks = [{'id': str(uuid.uuid4()), 'text': b.strip()} for b in d_blocks if b.strip()]
+                    # Pages read before (same photo bytes) come from the transcript cache.
+                    st.session_state.digi_blocks, sent = digitize_pages([f.getvalue() for f in digi_images], active_api_key, working_model_name)
                     st.session_state.digi_saved = False
-                    update_paper_count(st.session_state.username)
-                    st.rerun()
+                    st.session_state.digi_history_id = None
+                    # Identical photos cost neither quota nor a credit.
+                    if sent:
+                        update_paper_count(st.session_state.username)
+                    rerun_script()
                 except Exception as e:
                     error_msg = str(e).lower()
                     logging.error(f"[Digitize Error] {e}")
-                    if "429" in error_msg or "quota" in error_msg:
+                    if isinstance(e, RateLimited):
+                        st.warning(f"⏳ Lots of teachers are generating right now. Please try again in {e.retry_after:.0f} seconds, or add your own API key in Advanced Settings.")
+                    elif "429" in error_msg or "quota" in error_msg:
                         st.error("🚨 The daily generation limit has been reached! Try again later or add your own API key in Advanced Settings.")
                     else:
                         st.error("Couldn't read that paper. Try clearer/well-lit photos, or fewer pages at once.")
 
+    mark_section("tab_digitize.editor_and_exports")
     if st.session_state.digi_blocks:
         st.markdown("---")
         st.success(f"Read {len(st.session_state.digi_blocks)} question(s). Review and fix anything the OCR missed below.")
         with st.expander("🛠️ Review & Edit", expanded=True):
-            for i, b in enumerate(st.session_state.digi_blocks):
-                new_text = st.text_area(f"Question {i+1}", b['text'], height=100, key=f"digi_text_{b['id']}")
-                if new_text != st.session_state.digi_blocks[i]['text']:
-                    st.session_state.digi_blocks[i]['text'] = new_text
-                    st.session_state.digi_saved = False
+            render_blocks_form("digi_blocks", "digi_saved", "digi_text_")
 
         digi_md = "\n\n".join([b['text'] for b in st.session_state.digi_blocks])
-        digi_html = create_a4_html(digi_md, inst_name, inst_address, inst_contact, teacher_name, inst_logo, is_two_column, digi_subject or "Digitized Paper", digi_class or "N/A", "N/A", exam_time, "")
-        digi_word = create_word_docx(digi_md, inst_name, inst_address, inst_contact, teacher_name, inst_logo, is_two_column, digi_subject or "Digitized Paper", digi_class or "N/A", "N/A", exam_time, "")
+        digi_html, digi_word, digi_pdf = render_downloads("digi_downloads", digi_md, digi_subject or "Digitized Paper", digi_class or "N/A", "N/A", "")
 
         gc1, gc2, gc3, gc4 = st.columns(4)
         gc1.download_button("🖨️ HTML", digi_html, f"{digi_subject or 'Digitized'}_Paper.html", "text/html")
         gc2.download_button("📄 Word", digi_word, f"{digi_subject or 'Digitized'}_Paper.docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document")
-        digi_pdf = html_to_pdf(digi_html)
         if digi_pdf:
             gc3.download_button("📕 PDF", digi_pdf, f"{digi_subject or 'Digitized'}_Paper.pdf", "application/pdf")
         else:
             gc3.caption("PDF unavailable")
         st.caption("💡 If the Word file shows boxes instead of Hindi text, install the free 'Noto Sans Devanagari' font on the computer opening it (one-time setup). Not needed for the PDF.")
         if gc4.button("☁️ Save History", key="digi_save_history"):
-            data = {"username": st.session_state.username, "date": datetime.now().strftime("%Y-%m-%d"), "subject": digi_subject or "Digitized Paper", "board": "Digitized", "content": digi_md}
             try:
-                supabase.table("papers").insert(data).execute()
+                st.session_state.digi_history_id = save_paper(st.session_state.username, digi_subject or "Digitized Paper", "Digitized", digi_md, st.session_state.get("digi_history_id"))
                 st.session_state.digi_saved = True
-                st.success("Saved!")
+                if digi_subject.strip():
+                    bank_paper(st.session_state.username, st.session_state.digi_blocks, {
+                        "class": digi_class, "subject": digi_subject, "language": "Hindi" if content_language(digi_md) == "hi" else "English"})
+                # Full rerun so the Cloud History tab (its own fragment) shows the new paper.
+                st.session_state.flash_msg = "Saved to Cloud History!"
+                rerun_script()
             except Exception as e:
                 logging.error(f"[Digitize Save History Error] {e}")
                 st.error("Couldn't save to Cloud History. Please try again.")
 
-with tab_history:
+with tab_digitize:
+    render_digitize_tab()
+
+# Boards a saved paper can have: the sidebar's patterns plus the BSEB and Digitize tabs.
+HISTORY_BOARD_FILTERS = ["All boards", "Standard", "BSEB (Bihar Board)", "CBSE", "ICSE", "BSEB", "Digitized"]
+
+@isolated_section("tab_history")
+def render_history_tab():
     st.markdown("### Cloud History")
-    with st.spinner("Loading your saved papers..."):
+    sc1, sc2, sc3 = st.columns([3, 1, 1])
+    history_query = sc1.text_input("🔎 Search your papers", key="history_query", placeholder="e.g. Class 10 Trigonometry Hindi").strip()
+    history_board = sc2.selectbox("Board", HISTORY_BOARD_FILTERS, key="history_board")
+    history_dates = sc3.date_input("Saved between", value=(), key="history_dates")
+    searching = bool(history_query) or history_board != HISTORY_BOARD_FILTERS[0] or bool(history_dates)
+    snippets = {}
+    with st.spinner("Searching your saved papers..." if searching else "Loading your saved papers..."):
         try:
-            res = supabase.table("papers").select("*").eq("username", st.session_state.username).order("id", desc=True).execute()
+            if searching:
+                date_from = history_dates[0].isoformat() if history_dates else None
+                date_to = history_dates[-1].isoformat() if history_dates else None
+                hits = search_history(st.session_state.username, history_query,
+                                      None if history_board == HISTORY_BOARD_FILTERS[0] else history_board, date_from, date_to)
+                snippets = {h['id']: h.get('snippet') for h in hits}
+                # Only the matching papers are fetched, in search order.
+                rows = []
+                if snippets:
+                    with timed("supabase.load_history"):
+                        rows = get_supabase().table("papers").select(HISTORY_COLUMNS).eq("username", st.session_state.username).in_("id", list(snippets)).execute().data or []
+                    order = {pid: i for i, pid in enumerate(snippets)}
+                    rows.sort(key=lambda r: order[r['id']])
+            else:
+                with timed("supabase.load_history"):
+                    rows = get_supabase().table("papers").select(HISTORY_COLUMNS).eq("username", st.session_state.username).order("id", desc=True).execute().data or []
+            papers = unpack_papers(rows)
             history_error = None
         except Exception as e:
             logging.error(f"[History Load Error] {e}")
-            res = None
+            papers = None
             history_error = "Couldn't load your history right now. Please refresh."
 
     if history_error:
         st.error(history_error)
-    elif res.data:
-        st.caption(f"{len(res.data)} saved paper(s)")
-        for p in res.data:
+    elif papers:
+        st.caption(f"{len(papers)} matching paper(s)" if searching else f"{len(papers)} saved paper(s)")
+
+        with st.expander("📦 Batch Export (ZIP)"):
+            paper_labels = {p['id']: f"{p['subject']} ({p['date']})" for p in papers}
+            batch_ids = st.multiselect("Papers to export", list(paper_labels), format_func=lambda pid: paper_labels[pid], key="batch_ids")
+            batch_formats = st.multiselect("Formats", BATCH_FORMATS, default=BATCH_FORMATS, key="batch_formats")
+            if st.button("📦 Build ZIP", use_container_width=True):
+                if not batch_ids:
+                    st.error("Please select at least one paper.")
+                elif not batch_formats:
+                    st.error("Please select at least one format.")
+                else:
+                    chosen = [p for p in papers if p['id'] in batch_ids]
+                    with st.spinner(f"Rendering {len(chosen)} paper(s)..."):
+                        try:
+                            discard_zip("batch_zip")
+                            st.session_state.batch_zip, batch_missing = build_papers_zip(
+                                chosen, batch_formats, inst_name, inst_address, inst_contact, teacher_name, inst_logo, is_two_column, exam_time, new_zip_path())
+                            if batch_missing:
+                                st.warning(f"{len(batch_missing)} file(s) couldn't be rendered and were skipped: {', '.join(batch_missing)}")
+                        except Exception as e:
+                            logging.error(f"[Batch Export Error] {e}")
+                            discard_zip("batch_zip")
+                            st.error("Couldn't build the ZIP. Please try again.")
+            render_zip_download("batch_zip", "⬇️ Download ZIP", f"PaperBanao_Papers_{datetime.now().strftime('%Y%m%d')}.zip")
+
+        mark_section("tab_history.paper_list")
+        for p in papers:
             with st.expander(f"📄 {p['subject']} ({p['date']})"):
+                if snippets.get(p['id']):
+                    st.caption(snippets[p['id']])
                 h_html = create_a4_html(p['content'], inst_name, inst_address, inst_contact, teacher_name, inst_logo, is_two_column, p['subject'], "N/A", "N/A", exam_time, "")
                 h_word = create_word_docx(p['content'], inst_name, inst_address, inst_contact, teacher_name, inst_logo, is_two_column, p['subject'], "N/A", "N/A", exam_time, "")
 
@@ -1572,22 +1606,71 @@ with tab_history:
                 else:
                     dl3.caption("PDF unavailable")
 
+                if p.get('rev'):
+                    revs_key = f"revs_open_{p['id']}"
+                    if not st.session_state.get(revs_key):
+                        if st.button(f"🕘 Revisions ({p['rev']})", key=f"rv_{p['id']}"):
+                            st.session_state[revs_key] = True
+                            rerun_script(scope="fragment")
+                    else:
+                        try:
+                            revisions = load_revisions(p['id'], st.session_state.username, p['content'])
+                        except Exception as e:
+                            logging.error(f"[Revisions Load Error] {e}")
+                            revisions = []
+                            st.error("Couldn't load this paper's revisions. Please try again.")
+                        if revisions:
+                            rev_labels = {rev: f"Revision {rev + 1} (replaced {str(at or '')[:16].replace('T', ' ')})" for rev, at, _ in revisions}
+                            rev_contents = {rev: text for rev, _, text in revisions}
+                            pick = st.selectbox("Revision", list(rev_labels), format_func=lambda r, labels=rev_labels: labels[r], key=f"rs_{p['id']}")
+                            st.text_area("Preview", rev_contents[pick], height=200, disabled=True, key=f"rp_{p['id']}_{pick}")
+                            rc1, rc2 = st.columns(2)
+                            if rc1.button("↩️ Restore this revision", key=f"rr_{p['id']}"):
+                                try:
+                                    # Restoring is itself a new revision, so the current text stays recoverable.
+                                    save_paper(st.session_state.username, p['subject'], p['board'], rev_contents[pick], p['id'])
+                                    st.session_state[revs_key] = False
+                                    st.session_state.flash_msg = f"Restored revision {pick + 1}."
+                                    rerun_script()
+                                except Exception as e:
+                                    logging.error(f"[Restore Revision Error] {e}")
+                                    st.error("Couldn't restore that revision. Please try again.")
+                            if rc2.button("Close", key=f"rc_{p['id']}"):
+                                st.session_state[revs_key] = False
+                                rerun_script(scope="fragment")
+
                 confirm_key = f"confirm_del_{p['id']}"
                 if confirm_key not in st.session_state: st.session_state[confirm_key] = False
 
                 if not st.session_state[confirm_key]:
                     if dl4.button("🗑️ Delete", key=f"d_{p['id']}"):
                         st.session_state[confirm_key] = True
-                        st.rerun()
+                        rerun_script(scope="fragment")
                 else:
                     st.warning("Delete this paper permanently?")
                     yc, nc = st.columns(2)
                     if yc.button("Yes, delete", key=f"yd_{p['id']}"):
                         delete_paper(p['id'], st.session_state.username)
                         st.session_state[confirm_key] = False
-                        st.rerun()
+                        rerun_script(scope="fragment")
                     if nc.button("Cancel", key=f"nd_{p['id']}"):
                         st.session_state[confirm_key] = False
-                        st.rerun()
+                        rerun_script(scope="fragment")
+    elif searching:
+        st.info("No saved papers match your search.")
     else:
         st.info("No saved papers yet — generate one and click '☁️ Save History' to keep it here.")
+
+with tab_history:
+    render_history_tab()
+
+finish_rerun()
+if st.session_state.get("last_profile"):
+    _prof = st.session_state.last_profile
+    with st.sidebar.expander("🔬 Last Rerun Profile", expanded=True):
+        st.caption(f"{_prof['samples']} samples over {_prof['total_s']:.2f}s")
+        st.table({"Section": list(_prof["section_times"]), "ms": list(_prof["section_times"].values())})
+        st.download_button("⬇️ Flamegraph stacks (.folded)", _prof["folded"], "paperbanao_rerun.folded", "text/plain")
+        if st.button("Dismiss profile"):
+            del st.session_state["last_profile"]
+            rerun_script()
@@ -0,0 +1,137 @@
+"""Offline benchmarks for the rendering and parsing hot paths.
+
+Renders fixture papers (English / Hindi / Bilingual, 10-150 questions, one-
+and two-column, with/without logo and answer key) through each stage and
+reports median wall time, peak traced memory and (for the PDF stages)
+output size per stage:
+
+    split      resp_text.split("|||") into blocks (split_blocks)
+    clean      clean_math_for_word over the whole paper
+    html       create_a4_html
+    docx       create_word_docx
+    pdf        html_to_pdf(engine="pisa") (xhtml2pdf) on the rendered HTML
+    pdf_fitz   html_to_pdf(engine="fitz") (PyMuPDF Story layout), same HTML
+
+A summary at the end gives each stage's success rate, so the two PDF
+engines can be compared on speed and on how often they produce a file.
+
+No network or Gemini key is needed. Typical use:
+
+    python bench_render.py --quick                      # small matrix, fast
+    python bench_render.py --json bench.json            # full matrix, save results
+    python bench_render.py --compare bench.json         # fail if >20% slower than saved run
+    python bench_render.py --quick --stages pdf,pdf_fitz  # PDF engines head to head
+"""
+import sys
+import json
+import time
+import logging
+import argparse
+import itertools
+import statistics
+import tracemalloc
+from io import BytesIO
+
+from PIL import Image
+
+from engine import StoredLogo, split_blocks, clean_math_for_word, create_a4_html, create_word_docx, html_to_pdf
+from fixtures import LANGUAGES, make_fixture_response
+
+SIZES = [10, 50, 150]
+QUICK_SIZES = [10, 50]
+STAGES = ["split", "clean", "html", "docx", "pdf", "pdf_fitz"]
+
+def make_logo():
+    buf = BytesIO()
+    Image.new("RGB", (240, 240), (30, 60, 120)).save(buf, format="PNG")
+    return StoredLogo(buf.getvalue(), "image/png")
+
+def run_stage(stage, resp_text, paper_md, html, logo, two_col):
+    header = ("My Success Academy", "NH-22 Education Lane, City", "+91 9310038172", "Mr. Suraj", logo, two_col,
+              "Mathematics", "Class 10", "50", "2 Hours", "Trigonometry")
+    if stage == "split":
+        return split_blocks(resp_text)
+    if stage == "clean":
+        return clean_math_for_word(paper_md)
+    if stage == "html":
+        return create_a4_html(paper_md, *header)
+    if stage == "docx":
+        return create_word_docx(paper_md, *header)
+    if stage == "pdf":
+        return html_to_pdf(html, engine="pisa")
+    if stage == "pdf_fitz":
+        return html_to_pdf(html, engine="fitz")
+
+def measure(stage, repeat, *args):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = run_stage(stage, *args)
+        times.append(time.perf_counter() - t0)
+    # Peak memory comes from one extra traced run so tracing doesn't skew the timings.
+    tracemalloc.start()
+    run_stage(stage, *args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    size = len(result) if isinstance(result, bytes) else 0
+    return statistics.median(times), peak, result is not None, size
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="Smaller matrix (10/50 questions, logo+answer key only)")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per case (median is reported)")
+    parser.add_argument("--stages", default=",".join(STAGES), help="Comma-separated subset of: " + ", ".join(STAGES))
+    parser.add_argument("--json", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Baseline JSON from an earlier --json run; exit 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=1.2, help="Slowdown ratio that counts as a regression")
+    args = parser.parse_args(argv)
+
+    # xhtml2pdf logs a warning per unsupported CSS property and missing glyph.
+    logging.getLogger("xhtml2pdf").setLevel(logging.ERROR)
+    stages = [s for s in args.stages.split(",") if s in STAGES]
+    sizes = QUICK_SIZES if args.quick else SIZES
+    flags = [(True, True)] if args.quick else list(itertools.product([True, False], repeat=2))
+    logo = make_logo()
+
+    results = {}
+    print(f"{'case':<44} {'stage':<8} {'median ms':>10} {'peak KiB':>10} {'out KiB':>8}")
+    for language, size, two_col, (with_logo, answer_key) in itertools.product(LANGUAGES, sizes, [False, True], flags):
+        case = f"{language}/{size}q/{'2col' if two_col else '1col'}/{'logo' if with_logo else 'nologo'}/{'key' if answer_key else 'nokey'}"
+        resp_text = make_fixture_response(language, size, answer_key)
+        paper_md = "\n\n".join(b['text'] for b in split_blocks(resp_text))
+        case_logo = logo if with_logo else None
+        html = create_a4_html(paper_md, "My Success Academy", "City", "+91", "Mr. Suraj", case_logo, two_col,
+                              "Mathematics", "Class 10", "50", "2 Hours", "Trigonometry")
+        for stage in stages:
+            seconds, peak, ok, size = measure(stage, args.repeat, resp_text, paper_md, html, case_logo, two_col)
+            results[f"{case}:{stage}"] = {"ms": round(seconds * 1000, 3), "peak_kib": round(peak / 1024, 1), "ok": ok, "out_kib": round(size / 1024, 1)}
+            print(f"{case:<44} {stage:<8} {seconds * 1000:>10.2f} {peak / 1024:>10.1f} {size / 1024:>8.1f}{'' if ok else '  FAILED'}")
+
+    print()
+    for stage in stages:
+        runs = [r for key, r in results.items() if key.endswith(f":{stage}")]
+        ok_runs = [r for r in runs if r["ok"]]
+        median_ms = statistics.median(r["ms"] for r in ok_runs) if ok_runs else 0.0
+        median_kib = statistics.median(r["out_kib"] for r in ok_runs) if ok_runs else 0.0
+        print(f"{stage:<8} success {len(ok_runs)}/{len(runs)}  median of successful cases {median_ms:.2f} ms, {median_kib:.1f} KiB out")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = [
+            (key, baseline[key]["ms"], r["ms"]) for key, r in results.items()
+            if key in baseline and baseline[key]["ms"] > 0 and r["ms"] / baseline[key]["ms"] > args.threshold
+        ]
+        for key, old, new in regressions:
+            print(f"REGRESSION {key}: {old:.2f} ms -> {new:.2f} ms ({new / old:.2f}x)")
+        if regressions:
+            return 1
+        print(f"No regressions over {args.threshold:.2f}x against {args.compare}.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+"""Gemini context caching for large, repeated prompt context.
+
+A PDF Extract paper sends the same book text on its first generation, on
+every retry and on every question regenerated from it. With a cache
+configured, that text is uploaded once as a cachedContents entry and later
+generateContent calls only reference its handle, so the book is neither
+re-sent nor billed as fresh input tokens.
+
+Handles are kept per API key (cached contents belong to the key's
+project), model and text digest. Each lives for ttl seconds; one that is
+used with less than half its ttl left is extended, and one within
+EXPIRY_MARGIN of expiring is replaced rather than risked. Callers that
+must not upload (regenerations) look handles up with create=False.
+
+Text shorter than min_chars is sent inline without asking. Above that,
+a text Gemini says is too small for the model is sent inline for
+RETRY_AFTER seconds, and a key and model that can't create caches at all
+(free tier, an older model) are left alone for as long. Any other create
+failure (network, 5xx, 429) only sends that one call inline.
+
+The client does the HTTP: create(api_key, model, text, ttl) -> name,
+raising CacheRefused when Gemini won't cache the text, extend(api_key,
+name, ttl) and delete(api_key, name). engine.GeminiCacheClient is the
+real one; tests can pass any object with those methods.
+"""
+import time
+import atexit
+import hashlib
+import logging
+import threading
+
+from model_registry import key_fingerprint
+
+DEFAULT_TTL = 600.0
+MIN_CONTEXT_CHARS = 16000    # ~4k tokens, above Gemini's minimum cacheable size
+EXPIRY_MARGIN = 30.0         # don't hand out a handle that may expire mid-request
+RETRY_AFTER = 3600.0
+
+class CacheRefused(Exception):
+    """Gemini won't cache this: reason is "too_small" (this text, this
+    model) or "unsupported" (this key and model)."""
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+class ContextCache:
+    def __init__(self, client, ttl=DEFAULT_TTL, min_chars=MIN_CONTEXT_CHARS):
+        self.client = client
+        self.ttl = ttl
+        self.min_chars = min_chars
+        self.lock = threading.Lock()
+        self.entries = {}        # (key fp, model, digest) -> {"name", "api_key", "expires_at"}
+        self.key_locks = {}
+        self.unsupported = {}    # (key fp, model) -> when Gemini last refused to cache for it
+        self.too_small = {}      # entry key -> when Gemini last called the text too small
+        atexit.register(self.close)
+
+    def _entry_key(self, api_key, model, text):
+        return (key_fingerprint(api_key), model, hashlib.sha256(text.encode("utf-8")).hexdigest())
+
+    def _key_lock(self, k):
+        with self.lock:
+            return self.key_locks.setdefault(k, threading.Lock())
+
+    def handle(self, api_key, model, text, create=True):
+        """The cachedContents name holding text for this key and model,
+        extending it as needed and, with create, uploading it when there is
+        no live one; None to send text inline (or not at all)."""
+        if not text or len(text) < self.min_chars:
+            return None
+        k = self._entry_key(api_key, model, text)
+        now = time.time()
+        if now - self.unsupported.get(k[:2], 0.0) < RETRY_AFTER or now - self.too_small.get(k, 0.0) < RETRY_AFTER:
+            return None
+        # One upload per text even when regenerations ask for it concurrently.
+        with self._key_lock(k):
+            now = time.time()
+            entry = self.entries.get(k)
+            if entry and entry["expires_at"] - now > EXPIRY_MARGIN:
+                if entry["expires_at"] - now < self.ttl / 2:
+                    try:
+                        self.client.extend(api_key, entry["name"], self.ttl)
+                        entry["expires_at"] = now + self.ttl
+                    except Exception as e:
+                        logging.error(f"[Context Cache Extend Error] {e}")
+                return entry["name"]
+            if not create:
+                return None
+            try:
+                name = self.client.create(api_key, model, text, self.ttl)
+            except CacheRefused as e:
+                logging.error(f"[Context Cache Refused] {e.reason}: {e}")
+                with self.lock:
+                    if e.reason == "too_small":
+                        self.too_small[k] = now
+                    else:
+                        self.unsupported[k[:2]] = now
+                return None
+            except Exception as e:
+                logging.error(f"[Context Cache Create Error] {e}")
+                return None
+            with self.lock:
+                self.entries[k] = {"name": name, "api_key": api_key, "expires_at": now + self.ttl}
+            return name
+
+    def invalidate(self, api_key, model, text):
+        """Forgets a handle Gemini no longer recognises."""
+        with self.lock:
+            self.entries.pop(self._entry_key(api_key, model, text), None)
+
+    def close(self):
+        """Deletes the live caches now rather than paying for them until they expire."""
+        with self.lock:
+            live = [e for e in self.entries.values() if e["expires_at"] > time.time()]
+            self.entries.clear()
+        for e in live:
+            try:
+                self.client.delete(e["api_key"], e["name"])
+            except Exception as err:
+                logging.error(f"[Context Cache Delete Error] {err}")
+
+_cache = None
+
+def configure_context_cache(cache):
+    global _cache
+    _cache = cache
+    return cache
+
+def cached_context(api_key, model, text, create=True):
+    return _cache.handle(api_key, model, text, create) if _cache is not None else None
+
+def invalidate_cached_context(api_key, model, text):
+    if _cache is not None:
+        _cache.invalidate(api_key, model, text)
@@ -0,0 +1,1465 @@
+"""PaperBanao engine: prompt building, Gemini calls, parsing and the
+HTML/Word/PDF renderers, with no Streamlit dependency.
+
+PyMuPDF, markdown, xhtml2pdf and python-docx are imported inside the
+functions that use them, so importing this module (and the login page)
+doesn't pay for the PDF/Word stacks.
+
+app.py is the Streamlit UI on top of this module; paper_cli.py drives it
+headless (bulk/scheduled generation). Point GEMINI_API_BASE at a local
+stand-in to run everything without touching the real Gemini API.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import base64
+import random
+import hashlib
+import logging
+import tempfile
+import zipfile
+import threading
+import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from io import BytesIO
+from metrics import traced
+from usage import record_call, carry_usage_context, usage_context
+from ratelimit import RateLimited, acquire_generation_slot, report_upstream_429
+from model_registry import observe_model_call
+from context_cache import CacheRefused, cached_context, invalidate_cached_context
+from transcripts import cached_transcripts, store_transcript
+
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta").rstrip("/")
+DEFAULT_MODEL_NAME = "gemini-1.5-flash"
+
+class StoredLogo(BytesIO):
+    def __init__(self, data: bytes, mimetype: str):
+        super().__init__(data)
+        self.type = mimetype
+
+# ==========================================
+# --- HTTP REQUESTS: GEMINI API CALLS ---
+# ==========================================
+@traced("gemini.list_models")
+def list_generation_models(api_key):
+    """Names of the models this key can call generateContent on. Raises on failure."""
+    res = requests.get(f"{GEMINI_API_BASE}/models?key={api_key}", timeout=30)
+    if res.status_code != 200:
+        raise Exception(f"API Error {res.status_code} listing models")
+    return [m['name'].replace('models/', '') for m in res.json().get('models', []) if 'generateContent' in m.get('supportedGenerationMethods', [])]
+
+class GeminiCacheClient:
+    """cachedContents calls for context_cache.ContextCache. Raise on failure."""
+    @traced("gemini.cache_create")
+    def create(self, api_key, model, text, ttl):
+        body = {"model": f"models/{model}", "contents": [{"role": "user", "parts": [{"text": text}]}], "ttl": f"{int(ttl)}s"}
+        res = requests.post(f"{GEMINI_API_BASE}/cachedContents?key={api_key}", json=body, timeout=90)
+        if res.status_code == 200:
+            return res.json()["name"]
+        try:
+            error_msg = res.json().get('error', {}).get('message', 'Unknown error')
+        except ValueError:
+            error_msg = res.text[:200]
+        if res.status_code in (400, 403, 404):
+            lowered = error_msg.lower()
+            if "too small" in lowered or "min_total_token_count" in lowered:
+                raise CacheRefused("too_small", error_msg)
+            if "not supported" in lowered or "does not support" in lowered or "not available" in lowered:
+                raise CacheRefused("unsupported", error_msg)
+        raise Exception(f"API Error {res.status_code} creating cached content: {error_msg}")
+
+    def extend(self, api_key, name, ttl):
+        res = requests.patch(f"{GEMINI_API_BASE}/{name}?updateMask=ttl&key={api_key}", json={"ttl": f"{int(ttl)}s"}, timeout=30)
+        if res.status_code != 200:
+            raise Exception(f"API Error {res.status_code} extending cached content")
+
+    def delete(self, api_key, name):
+        res = requests.delete(f"{GEMINI_API_BASE}/{name}?key={api_key}", timeout=30)
+        if res.status_code not in (200, 404):
+            raise Exception(f"API Error {res.status_code} deleting cached content")
+
+@traced("gemini.generate_content")
+def generate_gemini_content(prompt, api_key, model_name=DEFAULT_MODEL_NAME, images=None, response_schema=None, context=None, context_inline=True):
+    """context is large shared text (a book) that goes before the prompt:
+    referenced through the context cache when possible, otherwise sent
+    inline. With context_inline False it is only used while already cached:
+    never uploaded to the cache or sent inline for this call."""
+    url = f"{GEMINI_API_BASE}/models/{model_name}:generateContent?key={api_key}"
+    headers = {'Content-Type': 'application/json'}
+
+    handle = cached_context(api_key, model_name, context, create=context_inline) if context else None
+    image_parts = []
+    if images:
+        for img in images:
+            buffered = BytesIO()
+            # PNGs (and some other formats) can be in RGBA/P/LA mode, which
+            # the JPEG encoder can't write (it has no alpha channel support).
+            # Converting to RGB first prevents a crash on transparent PNGs.
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            img.save(buffered, format="JPEG")
+            img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
+            image_parts.append({
+                "inline_data": {
+                    "mime_type": "image/jpeg",
+                    "data": img_str
+                }
+            })
+
+    # Shared-key calls queue here for a rate-limit token instead of racing
+    # each other into Gemini's own 429s.
+    acquire_generation_slot(api_key)
+
+    while True:
+        text = f"{context}\n\n{prompt}" if context and not handle and context_inline else prompt
+        payload = {"contents": [{"parts": [{"text": text}] + image_parts}]}
+        if handle:
+            payload["cachedContent"] = handle
+        if response_schema:
+            # JSON mode: the reply text is a JSON document matching the schema.
+            payload["generationConfig"] = {"responseMimeType": "application/json", "responseSchema": response_schema}
+
+        # Timeout prevents the app from hanging forever for a user if the
+        # Gemini API stalls or the network drops mid-request.
+        start = time.perf_counter()
+        try:
+            response = requests.post(url, headers=headers, json=payload, timeout=90)
+        except requests.RequestException:
+            record_call(model_name, None, time.perf_counter() - start, len(text), len(image_parts), status="error:network")
+            observe_model_call(api_key, model_name, time.perf_counter() - start, ok=False)
+            raise
+        latency = time.perf_counter() - start
+        if response.status_code == 200:
+            data = response.json()
+            meta = data.get('usageMetadata') or {}
+            observe_model_call(api_key, model_name, latency, ok=True,
+                               output_tokens=meta.get('candidatesTokenCount', 0) + meta.get('thoughtsTokenCount', 0))
+            record_call(model_name, data.get('usageMetadata'), latency, len(text), len(image_parts))
+            try:
+                return data['candidates'][0]['content']['parts'][0]['text']
+            except (KeyError, IndexError):
+                logging.error("Unexpected response format from Gemini API.")
+                raise Exception("Unexpected response format from Gemini API.")
+
+        try:
+            error_msg = response.json().get('error', {}).get('message', 'Unknown error')
+        except ValueError:
+            error_msg = response.text[:200]
+        if handle and response.status_code == 404 and "cachedcontent" in error_msg.lower().replace(" ", ""):
+            # The cache expired or was deleted on Gemini's side: forget it and
+            # go again without it, inside this call's trace and rate-limit slot.
+            record_call(model_name, None, latency, len(text), len(image_parts), status="error:cache_expired")
+            invalidate_cached_context(api_key, model_name, context)
+            handle = None
+            continue
+        observe_model_call(api_key, model_name, latency, ok=False)
+        record_call(model_name, None, latency, len(text), len(image_parts), status=f"error:{response.status_code}")
+        if response.status_code == 429:
+            report_upstream_429(api_key)
+        logging.error(f"Gemini API Error {response.status_code}: {error_msg}")
+        raise Exception(f"API Error {response.status_code}: {error_msg}")
+
+# --- Helper Functions ---
+# Scanned books have no text layer: those pages are rasterized and
+# transcribed by Gemini, a few pages per call and several calls at once.
+# Transcripts are cached by file digest and page (see transcripts.py).
+SCANNED_PAGE_MIN_CHARS = 25     # fewer non-blank characters than this: no usable text layer
+SCAN_DPI = 150
+SCAN_MAX_PIXELS = 2000          # longest side of a rasterized page, whatever its size
+SCAN_PAGES_PER_CALL = 4
+SCAN_WORKERS = 4
+SCAN_RATE_LIMIT_WAIT = 300      # seconds a document may spend waiting out the rate limiter before pages are given up
+SCAN_PROMPT_VERSION = 1         # bump when SCAN_PROMPT changes, so old transcripts aren't reused
+SCAN_PAGE_DELIMITER = "@@@PAGE@@@"
+SCAN_PROMPT = (
+    "Transcribe the attached scanned textbook page(s) exactly as printed, in their original language. "
+    "Keep headings, lists, formulas and table contents (one row per line); skip page numbers and running headers. "
+    "Do not summarise, translate or add anything. "
+    f"Output the pages in the order given, each followed by a line containing only {SCAN_PAGE_DELIMITER}."
+)
+
+def is_scanned_page(text):
+    return len("".join(text.split())) < SCANNED_PAGE_MIN_CHARS
+
+def rasterize_page(page):
+    """The page as an RGB PIL image at SCAN_DPI, scaled down if that would
+    exceed SCAN_MAX_PIXELS on its longest side."""
+    from PIL import Image
+    dpi = min(SCAN_DPI, SCAN_MAX_PIXELS * 72 / max(page.rect.width, page.rect.height))
+    pix = page.get_pixmap(dpi=int(dpi), alpha=False)
+    return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+
+def transcribe_pages(images, api_key, model_name, prompt=SCAN_PROMPT):
+    """Transcripts for a batch of page images, in order. prompt must ask for
+    SCAN_PAGE_DELIMITER after each page; a batch whose reply doesn't split
+    into one part per page is redone a page at a time."""
+    resp_text = generate_gemini_content(prompt, api_key, model_name, images=images)
+    parts = [p.strip() for p in resp_text.split(SCAN_PAGE_DELIMITER)]
+    if parts and not parts[-1]:
+        parts.pop()
+    if len(parts) == len(images):
+        return parts
+    if len(images) == 1:
+        return [resp_text.replace(SCAN_PAGE_DELIMITER, "").strip()]
+    return [transcribe_pages([img], api_key, model_name, prompt)[0] for img in images]
+
+def transcribe_cached_pages(keys, load_image, prompt, api_key, model_name):
+    """Transcripts of pages {index: cache key}, from the transcript cache or
+    from Gemini in batches of SCAN_PAGES_PER_CALL, SCAN_WORKERS at a time.
+    load_image(index) is only called as its batch is sent, so at most
+    SCAN_WORKERS batches of images are in memory at once, and pages with the
+    same key are sent once. A batch turned away by the rate limiter is sent
+    again once it says there's room, for up to SCAN_RATE_LIMIT_WAIT seconds
+    in all. Returns ({index: text}, pages sent, [errors]); pages of failed
+    batches are left out."""
+    cached = cached_transcripts(set(keys.values()))
+    texts = {i: cached[k] for i, k in keys.items() if k in cached}
+    same_key = {}
+    for i, k in keys.items():
+        if i not in texts:
+            same_key.setdefault(k, []).append(i)
+    todo = [indices[0] for indices in same_key.values()]
+    queue = deque(todo[n:n + SCAN_PAGES_PER_CALL] for n in range(0, len(todo), SCAN_PAGES_PER_CALL))
+    errors = []
+    deadline = time.monotonic() + SCAN_RATE_LIMIT_WAIT
+    resume_at = 0.0
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
+        pending = {}
+        while queue or pending:
+            now = time.monotonic()
+            if queue and len(pending) < SCAN_WORKERS and now >= resume_at:
+                batch = queue.popleft()
+                images = [load_image(i) for i in batch]
+                pending[pool.submit(carry_usage_context(transcribe_pages), images, api_key, model_name, prompt)] = batch
+                continue
+            timeout = resume_at - now if queue and len(pending) < SCAN_WORKERS else None
+            if not pending:
+                time.sleep(timeout)
+                continue
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for fut in done:
+                done_batch = pending.pop(fut)
+                try:
+                    for i, text in zip(done_batch, fut.result()):
+                        store_transcript(keys[i], text)
+                        for j in same_key[keys[i]]:
+                            texts[j] = text
+                except RateLimited as e:
+                    if time.monotonic() + e.retry_after < deadline:
+                        resume_at = max(resume_at, time.monotonic() + e.retry_after)
+                        queue.append(done_batch)
+                    else:
+                        logging.error(f"[Transcribe Error] pages {[i + 1 for i in done_batch]}: {e}")
+                        errors.append(e)
+                except Exception as e:
+                    logging.error(f"[Transcribe Error] pages {[i + 1 for i in done_batch]}: {e}")
+                    errors.append(e)
+    return texts, len(todo), errors
+
+def transcribe_scanned_pages(doc, page_indices, digest, api_key, model_name):
+    """{page index: text} for a PDF's scanned pages; failed pages are left out."""
+    keys = {i: f"pdf:{digest}:{i + 1}:v{SCAN_PROMPT_VERSION}" for i in page_indices}
+    texts, _, _ = transcribe_cached_pages(keys, lambda i: rasterize_page(doc[i]), SCAN_PROMPT, api_key, model_name)
+    return texts
+
+@traced("pdf.extract_text")
+def read_pdf_pages(data, start_page, end_page, api_key=None, model_name=DEFAULT_MODEL_NAME):
+    """(text, unread) for pages start_page..end_page of a PDF's bytes. With an
+    api_key, pages without a text layer (scans) are transcribed by Gemini
+    instead of coming back empty; unread lists the page numbers of scans
+    that couldn't be (all of them without a key)."""
+    import pymupdf  # imported on first use to keep cold starts fast
+    try:
+        doc = pymupdf.open(stream=data, filetype="pdf")
+        start_index = max(0, start_page - 1) 
+        end_index = min(len(doc), end_page)
+        pages = {i: doc[i].get_text("text") for i in range(start_index, end_index)}
+        scanned = [i for i, text in pages.items() if is_scanned_page(text)]
+        transcribed = {}
+        if scanned and api_key:
+            transcribed = transcribe_scanned_pages(doc, scanned, hashlib.sha256(data).hexdigest(), api_key, model_name)
+            pages.update(transcribed)
+        text = ""
+        for i in range(start_index, end_index):
+            text += pages[i] + "\n"
+        return text, [i + 1 for i in scanned if i not in transcribed]
+    except Exception as e:
+        logging.error(f"[PDF Extraction Error] {e}")
+        return "", []
+
+def extract_text_from_pdf(uploaded_file, start_page, end_page, api_key=None, model_name=DEFAULT_MODEL_NAME):
+    """Text of pages start_page..end_page of an open PDF file (see read_pdf_pages)."""
+    text, unread = read_pdf_pages(uploaded_file.read(), start_page, end_page, api_key, model_name)
+    if unread:
+        logging.error(f"[PDF Extraction Error] scanned pages {unread} couldn't be read")
+    return text
+
+# --- DIGITIZE ---
+# Photos of a question paper are transcribed page by page, each cached by
+# its content hash and DIGITIZE_PROMPT_VERSION, so digitizing again (say
+# after fixing the Subject, or after an error) only sends new or changed
+# pages to Gemini.
+DIGITIZE_PROMPT_VERSION = 1     # bump when DIGITIZE_PROMPT changes, so old transcripts aren't reused
+DIGITIZE_PROMPT = (
+    "You are digitizing a handwritten or scanned question paper from the attached image(s). "
+    "Transcribe it faithfully — preserve the original question numbering, order, sections, and "
+    "marks exactly as written. Do not invent new questions, do not change the meaning, and do not "
+    "add a title, institute name, header, or footer. Only fix obvious spelling/OCR mistakes. "
+    "Separate each distinct question with the delimiter ||| on its own line, including after the last "
+    "question on a page, unless that question continues onto the next page. "
+    f"Output the pages in the order given, each followed by a line containing only {SCAN_PAGE_DELIMITER}."
+)
+
+@traced("gemini.digitize")
+def digitize_pages(pages, api_key, model_name):
+    """Editor blocks for photos of a paper (image bytes, in page order).
+    Returns (blocks, pages sent to Gemini); 0 means every page came from
+    the cache. Raises if a page couldn't be read; the pages that were read
+    stay cached for the retry."""
+    from PIL import Image
+    keys = {i: f"digitize:{hashlib.sha256(data).hexdigest()}:v{DIGITIZE_PROMPT_VERSION}" for i, data in enumerate(pages)}
+    texts, sent, errors = transcribe_cached_pages(keys, lambda i: Image.open(BytesIO(pages[i])), DIGITIZE_PROMPT, api_key, model_name)
+    if errors:
+        raise errors[0]
+    return split_blocks("\n".join(texts[i] for i in range(len(pages)))), sent
+
+def build_question_prompt(mcq_c, mcq_d, mcq_m, fib_c, fib_d, fib_m, tf_c, tf_d, tf_m, short_c, short_d, short_m, long_c, long_d, long_m, include_answers, selected_language, subject, structured=False):
+    reqs = []
+    if mcq_c > 0: reqs.append(f"## Multiple Choice Questions [{mcq_m} Mark(s) Each]\n- {mcq_c} MCQs (Difficulty: {mcq_d}).")
+    if fib_c > 0: reqs.append(f"## Fill in the Blanks [{fib_m} Mark(s) Each]\n- {fib_c} FIBs (Difficulty: {fib_d}). MUST include 4 options (A, B, C, D) on a new line for each blank.")
+    if tf_c > 0:  reqs.append(f"## True / False [{tf_m} Mark(s) Each]\n- {tf_c} True/False questions (Difficulty: {tf_d}). MUST include exactly 2 options: (A) True  (B) False on a new line.")
+    if short_c > 0: reqs.append(f"## Short Answer Questions [{short_m} Mark(s) Each]\n- {short_c} Short Qs (Difficulty: {short_d}).")
+    if long_c > 0:  reqs.append(f"## Long Answer Questions [{long_m} Mark(s) Each]\n- {long_c} Long Qs (Difficulty: {long_d}).")
+    
+    if selected_language == "English":
+        lang_instruction = "LANGUAGE RULE: Generate the ENTIRE paper and answers strictly in the English language."
+    elif selected_language == "Hindi":
+        lang_instruction = "LANGUAGE RULE: Generate the paper in simple Hindi. Avoid tough academic Hindi words. Provide English terms in brackets for technical words. Example: 'अंश [Numerator]'."
+    else:
+        lang_instruction = "LANGUAGE RULE: Generate the paper in Hinglish (a mix of simple Hindi and English). Provide English terms in brackets for technical words."
+    
+    if structured:
+        return "\n\n".join(reqs) + f"\n\n{lang_instruction}\n\n" + structured_output_rules(subject, include_answers)
+
+    base_prompt = "\n\n".join(reqs) + f"\n\n{lang_instruction}\n\n" + f"""CRITICAL FORMATTING:
+1. STRICTLY adhere to the subject: **{subject}**. Do NOT generate general knowledge questions.
+2. CONTINUOUS NUMBERING: Number ALL questions continuously from start to finish (e.g., **Q1.**, **Q2.**, **Q3.**, etc.) across ALL sections. Do NOT restart numbering at 1 for a new section. 
+3. OPTIONS ON NEW LINE: For MCQs, FIBs, and T/F, ALWAYS place the options on a NEW LINE directly below the question text. Do NOT place options on the same line as the question.
+   Correct Example:
+   **Q1.** What is the value of x?
+   (A) 1   (B) 2   (C) 3   (D) 4
+4. MARKS IN HEADERS: Include the marks per question in the section headers as provided above.
+5. DETAILED ANSWERS: In the Answer Key, provide detailed, step-by-step explanations for Short and Long answer questions, proportional to their marks (e.g., 5-mark questions need a long, detailed explanation). Ensure answer numbers match the continuous question numbers.
+6. DELIMITER: Separate EVERY single Question, Section Header, and the Answer Key with the delimiter `|||` on a new line. Do not group multiple questions together.
+7. MATH: USE UNICODE SYMBOLS ONLY (θ, π, √, ²). NO LaTeX. Write fractions as a/b.
+8. DO NOT generate any Title, Institute Name, Time, or Marks at the very top. Start directly with the first section header.
+    """
+    
+    if include_answers: return base_prompt + "\nAdd '# ANSWER KEY' at end, also separated by `|||`. Ensure numbering in answers exactly matches the continuous numbering of the questions."
+    return base_prompt
+
+def extract_question_number(text):
+    """Pulls the question number out of a block like '**Q3.** ...' or '3. ...'
+    so we can find the matching Answer Key entry for a regenerated question."""
+    m = re.search(r'Q\.?\s*(\d+)', text, re.IGNORECASE)
+    if m:
+        return m.group(1)
+    m2 = re.match(r'\s*\**\s*(\d+)\.', text)
+    if m2:
+        return m2.group(1)
+    return None
+
+def regenerate_single_question(old_text, api_key, model_name, subject, topics, context=None):
+    """Regenerates one question, staying on-topic, and also returns a fresh
+    answer/solution for it so the Answer Key can be kept in sync. context
+    (the paper's book text) is used only while it's in the context cache;
+    it is never re-sent inline for a single question."""
+    topic_context = topics.strip() if topics and topics.strip() else subject
+    prompt = (
+        f"You are regenerating ONE question from a {subject} exam paper. "
+        f"The paper's topics are: {topic_context}. Stay strictly within this subject and these topics — "
+        f"do not drift into unrelated topics.\n\n"
+        f"The original question being replaced was:\n{old_text}\n\n"
+        "Write a NEW question of the same type, difficulty, and marks as the original, strictly on the same "
+        "subject/topics. Keep the same question number label if the original had one (e.g. 'Q3.'). "
+        "Use Unicode math symbols (θ, π, √, ²) instead of LaTeX.\n\n"
+        "Then on a new line write the exact delimiter @@@ANSWER@@@ followed by the correct answer/solution for "
+        "THIS NEW question — a brief correct option letter for MCQ/True-False/Fill-in-the-blank, or a full "
+        "step-by-step explanation for Short/Long answer questions.\n\n"
+        "Output ONLY the question text, then @@@ANSWER@@@, then the answer. No extra commentary."
+    )
+    resp_text = generate_gemini_content(prompt, api_key, model_name, context=context, context_inline=False)
+    if "@@@ANSWER@@@" in resp_text:
+        q_part, a_part = resp_text.split("@@@ANSWER@@@", 1)
+        return q_part.strip(), a_part.strip()
+    return resp_text.strip(), None
+
+REGENERATE_WORKERS = 4
+
+def regenerate_questions(blocks, indices, api_key, model_name, subject, topics, context=None):
+    """Regenerates several questions at once: one Gemini call per question,
+    issued concurrently. Returns ({index: (question, answer)}, [failed indices])
+    without touching blocks, so the caller can apply everything in one go."""
+    results, failed = {}, []
+    if not indices:
+        return results, failed
+    with ThreadPoolExecutor(max_workers=min(REGENERATE_WORKERS, len(indices))) as pool:
+        futures = {pool.submit(carry_usage_context(regenerate_single_question), blocks[i]['text'], api_key, model_name, subject, topics, context): i for i in indices}
+        for fut, i in futures.items():
+            try:
+                results[i] = fut.result()
+            except Exception as e:
+                logging.error(f"[Regenerate Error] Q index {i}: {e}")
+                failed.append(i)
+    return results, failed
+
+def replace_question_block(blocks, i, new_q_text, new_answer_text=None):
+    """Swaps a regenerated question into blocks[i] (in place) and keeps the
+    Answer Key in sync: the answer entry with the old question number is
+    replaced too, so the solution doesn't stay pointing at the old question."""
+    old_number = extract_question_number(blocks[i]['text'])
+    blocks[i]['text'] = new_q_text
+    blocks[i]['id'] = str(uuid.uuid4())
+    if not (new_answer_text and old_number):
+        return
+    ans_key_idx = next((j for j, blk in enumerate(blocks) if "ANSWER KEY" in blk['text'].upper()), None)
+    if ans_key_idx is None:
+        return
+    for j in range(ans_key_idx + 1, len(blocks)):
+        if extract_question_number(blocks[j]['text']) == old_number:
+            blocks[j]['text'] = f"**Q{old_number}.** {new_answer_text}"
+            blocks[j]['id'] = str(uuid.uuid4())
+            break
+
+# --- SHUFFLED SETS (Set A/B/C) ---
+# Variants are built locally from one generated paper: questions are
+# shuffled within their own section, MCQ/FIB options are permuted, and the
+# Answer Key is renumbered and re-lettered to match. No extra model calls.
+VARIANT_SET_LABELS = "ABCDEFGH"
+OPTION_MARKER_RE = re.compile(r'\(([A-Da-d])\)')
+QUESTION_LABEL_RE = re.compile(r'(Q\.?\s*)(\d+)', re.IGNORECASE)
+ANSWER_ENTRY_START_RE = re.compile(r'(?m)^(?=\s*\**\s*(?:Q\.?\s*)?\d+\s*[.)])', re.IGNORECASE)
+FIXED_OPTION_RE = re.compile(r'(?i)\b(all|none|both)\s+of\s+(the\s+)?(above|these)\b')
+
+def renumber_question(text, new_number):
+    if QUESTION_LABEL_RE.search(text):
+        return QUESTION_LABEL_RE.sub(lambda m: f"{m.group(1)}{new_number}", text, count=1)
+    return re.sub(r'^(\s*\**\s*)\d+\.', lambda m: f"{m.group(1)}{new_number}.", text, count=1)
+
+def shuffle_options(text, rng):
+    """Permutes the (A)..(D) options of a question in place, keeping the
+    markers and layout. Returns (new_text, {old_letter: new_letter}).
+    True/False and 'all/none of the above' style options are left alone."""
+    parts = OPTION_MARKER_RE.split(text)
+    letters = [l.upper() for l in parts[1::2]]
+    if len(letters) < 3 or letters != list("ABCD"[:len(letters)]):
+        return text, {}
+    contents = parts[2::2]
+    if any(FIXED_OPTION_RE.search(c) for c in contents):
+        return text, {}
+    layout = [re.match(r'(\s*)(.*?)(\s*)$', c, re.DOTALL).groups() for c in contents]
+    order = list(range(len(layout)))
+    rng.shuffle(order)
+    new_parts = [parts[0]]
+    for pos, src in enumerate(order):
+        lead, _, trail = layout[pos]
+        new_parts += [f"({parts[1 + 2 * pos]})", f"{lead}{layout[src][1]}{trail}"]
+    return "".join(new_parts), {letters[src]: letters[pos] for pos, src in enumerate(order)}
+
+def remap_answer(text, new_number, letter_map):
+    text = renumber_question(text, new_number)
+    if not letter_map:
+        return text
+    if OPTION_MARKER_RE.search(text):
+        return OPTION_MARKER_RE.sub(lambda m: f"({letter_map.get(m.group(1).upper(), m.group(1))})", text)
+    # Bare letter answers like "**Q3.** B" or "Q3. Answer: B"
+    return re.sub(r'((?:Q\.?\s*)?\d+\s*[.)]\**\s*(?:Answer\s*:?\s*)?)([A-D])\b',
+                  lambda m: m.group(1) + letter_map.get(m.group(2), m.group(2)), text, count=1, flags=re.IGNORECASE)
+
+def make_paper_variant(blocks, rng):
+    """Builds one shuffled variant of a block list (see the note above)."""
+    ans_idx = next((i for i, b in enumerate(blocks) if "ANSWER KEY" in b['text'].upper()), len(blocks))
+    q_blocks, a_blocks = blocks[:ans_idx], blocks[ans_idx:]
+
+    # Group consecutive question blocks into sections; headers and any
+    # other non-question blocks stay exactly where they were.
+    layout, run = [], []
+    for b in q_blocks:
+        text = b['text'].strip()
+        if text.startswith('#'):
+            # A section header, possibly with its first question glued on.
+            header, _, text = text.partition('\n')
+            if run: layout.append(run); run = []
+            layout.append({'text': header})
+            text = text.strip()
+            if not text: continue
+        if extract_question_number(text) is not None:
+            run.append({'text': text})
+        else:
+            if run: layout.append(run); run = []
+            layout.append({'text': text})
+    if run: layout.append(run)
+
+    new_blocks, number_map, letter_maps, n = [], {}, {}, 0
+    for item in layout:
+        if isinstance(item, dict):
+            new_blocks.append({'id': str(uuid.uuid4()), 'text': item['text']})
+            continue
+        shuffled = item[:]
+        rng.shuffle(shuffled)
+        for b in shuffled:
+            n += 1
+            old_number = extract_question_number(b['text'])
+            text, letter_map = shuffle_options(b['text'], rng)
+            number_map[old_number] = n
+            letter_maps[old_number] = letter_map
+            new_blocks.append({'id': str(uuid.uuid4()), 'text': renumber_question(text, n)})
+
+    if a_blocks:
+        # The Answer Key may come back as one block per answer or as one
+        # big block, so split it into per-question entries either way.
+        header, *rest = a_blocks
+        head_lines = header['text'].split('\n', 1)
+        entries_text = [head_lines[1]] if len(head_lines) > 1 else []
+        entries_text += [b['text'] for b in rest]
+        numbered, unnumbered = [], []
+        for chunk in entries_text:
+            for entry in ANSWER_ENTRY_START_RE.split(chunk):
+                entry = entry.strip()
+                if not entry: continue
+                old_number = extract_question_number(entry)
+                if old_number in number_map:
+                    numbered.append((number_map[old_number], remap_answer(entry, number_map[old_number], letter_maps[old_number])))
+                else:
+                    unnumbered.append(entry)
+        new_blocks.append({'id': str(uuid.uuid4()), 'text': head_lines[0]})
+        new_blocks += [{'id': str(uuid.uuid4()), 'text': t} for _, t in sorted(numbered, key=lambda e: e[0])]
+        new_blocks += [{'id': str(uuid.uuid4()), 'text': t} for t in unnumbered]
+    return new_blocks
+
+def generate_paper_variants(blocks, n_sets, seed=None):
+    """Returns [(label, blocks)] for Set A, Set B, ... from one generated paper."""
+    base_seed = seed if seed is not None else random.randrange(1 << 30)
+    return [(f"Set {VARIANT_SET_LABELS[k]}", make_paper_variant(blocks, random.Random(f"{base_seed}-{k}")))
+            for k in range(min(n_sets, len(VARIANT_SET_LABELS)))]
+
+def clean_math_for_word(text):
+    text = re.sub(r'\\frac\{([^}]+)\}\{([^}]+)\}', r'(\1)/(\2)', text)
+    text = re.sub(r'\\\((.*?)\\\)', r'\1', text)
+    text = re.sub(r'\\\[(.*?)\\\]', r'\1', text)
+    latex_map = {r'\pi': 'π', r'\theta': 'θ', r'\sqrt': '√', r'\times': '×', r'\div': '÷', '$': '', '^2': '²', '^3': '³'}
+    for k, v in latex_map.items(): text = text.replace(k, v)
+    text = text.replace('☐', '[ ]').replace('☑', '[x]').replace('•', '-').replace('◦', '-')
+    text = text.replace('\u200b', '').replace('\u2022', '-').replace('\u25cf', '-').replace('\u25cb', '-')
+    return text.strip()
+
+# 🌟 HTML RENDERER 🌟
+@traced("render.html")
+def create_a4_html(md_content, i_name, i_address, i_contact, t_name, inst_logo=None, is_2_col=False, sub="Subject", grade="Class", total_m="Marks", exam_time="Time", topics=""):
+    import markdown
+    md_content = clean_math_for_word(md_content)
+    
+    md_content = re.sub(r"^#.*?\*\*\*", "", md_content, count=1, flags=re.DOTALL).strip()
+    md_content = re.sub(r"^\*\*Subject:\*\*.*?\n", "", md_content, flags=re.MULTILINE)
+    md_content = re.sub(r"^\*\*Class:\*\*.*?\n", "", md_content, flags=re.MULTILINE)
+    md_content = re.sub(r"^\*\*Marks:\*\*.*?\n", "", md_content, flags=re.MULTILINE)
+    md_content = re.sub(r"^\*\*Time:\*\*.*?\n", "", md_content, flags=re.MULTILINE)
+    
+    md_content = re.sub(r"^\d+\.\s", "**Q.** ", md_content, flags=re.MULTILINE)
+    md_content = md_content.strip()
+    
+    logo_html_inline = ""
+    logo_footer = ""
+    if inst_logo:
+        inst_logo.seek(0)
+        b64 = base64.b64encode(inst_logo.getvalue()).decode()
+        logo_html_inline = f"<td style='width: 70px; padding-right: 15px; vertical-align: middle;'><img src='data:{inst_logo.type};base64,{b64}' style='max-height: 55px;'/></td>"
+        logo_footer = f"<img src='data:{inst_logo.type};base64,{b64}' style='height: 18px; vertical-align: middle; margin-right: 8px;'/>"
+    
+    main_heading_text = topics.strip().upper() if topics.strip() != "" else sub.upper()
+    
+    custom_header = f"""
+    <div style='border-bottom: 2px solid black; padding-bottom: 10px; margin-bottom: 10px; width: 100%;'>
+        <table style='width: 100%; border-collapse: collapse; border: none; margin-bottom: 10px;'>
+            <tr>
+                <td style='text-align: center; vertical-align: middle; border: none;'>
+                    <table style='margin: 0 auto;'>
+                        <tr>
+                            {logo_html_inline}
+                            <td style='vertical-align: middle;'>
+                                <h1 style='margin: 0; font-size: 24px; font-family: "Noto Sans", "Nirmala UI", "Times New Roman", serif; font-weight: 900; text-transform: uppercase; white-space: nowrap;'>{i_name}</h1>
+                            </td>
+                        </tr>
+                    </table>
+                </td>
+            </tr>
+        </table>
+        <table style='width: 100%; font-weight: bold; font-size: 13px; border: none;'>
+            <tr>
+                <td style='text-align: left; vertical-align: bottom; width: 33%; border: none;'>Class : {grade}<br>Time : {exam_time}</td>
+                <td style='text-align: center; vertical-align: middle; width: 34%; border: none;'>
+                    <div style='border: 2px solid black; border-radius: 12px; display: inline-block; padding: 4px 25px; font-weight: bold; font-size: 14px; background: white;'>
+                        EXAMINATION
+                    </div>
+                </td>
+                <td style='text-align: right; vertical-align: bottom; width: 33%; border: none;'>Sub.: {sub}<br>Marks: {total_m}</td>
+            </tr>
+        </table>
+    </div>
+    <div style='border-top: 1px solid black; border-bottom: 3px solid black; padding: 2px 0; margin-bottom: 15px;'>
+        <div style='background-color: black; color: white; padding: 5px; text-align: center; font-weight: bold; font-size: 15px; text-transform: uppercase; letter-spacing: 1px;'>
+            Multiple Choice Questions & Theory
+        </div>
+    </div>
+    <h2 style='text-align: center; text-decoration: underline; text-transform: uppercase; margin-top: 0; margin-bottom: 15px; font-size: 18px;'>{main_heading_text}</h2>
+    """
+
+    ans_split_marker = "|||ANSWER_KEY_SPLIT|||"
+    md_content = re.sub(r'(?im)^#+\s*Answer Key.*$', ans_split_marker, md_content)
+    
+    # The <!--pdf:...--> comments mark the parts the PyMuPDF backend lays
+    # out itself (full-width header, flowing body); browsers ignore them.
+    if ans_split_marker in md_content:
+        q_part, a_part = md_content.split(ans_split_marker)
+        final_inner_html = f"""
+        <!--pdf:header-->{custom_header}<!--/pdf:header-->
+        <!--pdf:body--><div class="content-body">{markdown.markdown(q_part.strip())}</div><!--/pdf:body-->
+        <div style="page-break-before: always; width: 100%;"></div>
+        <!--pdf:header-->{custom_header}
+        <h2 style="text-align: center; text-decoration: underline; margin-bottom: 15px;">ANSWER KEY</h2><!--/pdf:header-->
+        <!--pdf:body--><div class="content-body">{markdown.markdown(a_part.strip())}</div><!--/pdf:body-->
+        """
+    else:
+        final_inner_html = f"""
+        <!--pdf:header-->{custom_header}<!--/pdf:header-->
+        <!--pdf:body--><div class="content-body">{markdown.markdown(md_content.strip())}</div><!--/pdf:body-->
+        """
+    
+    col_style = "column-count: 2; column-gap: 15mm; column-rule: 1px solid #000; font-size: 14px;" if is_2_col else "font-size: 16px;"
+
+    return f"""<!DOCTYPE html><html><head><meta charset="UTF-8"><style>
+    body {{ background: #f0f0f0; font-family: 'Noto Sans', 'Nirmala UI', 'Times New Roman', serif; margin: 0; padding: 20px; display: flex; justify-content: center; }} 
+    .a4-page {{ background: white; width: 210mm; min-height: 297mm; padding: 20px; box-shadow: 0 0 10px rgba(0,0,0,0.2); box-sizing: border-box; position: relative; overflow: hidden; }} 
+    .watermark {{ position: fixed; top: 50%; left: 50%; transform: translate(-50%, -50%) rotate(-45deg); font-size: 85px; color: rgba(0, 0, 0, 0.06); z-index: -9999; pointer-events: none; white-space: nowrap; font-weight: bold; text-transform: uppercase; }}
+    table {{ width: 100%; border-collapse: collapse; border: none; position: relative; z-index: 1; }}
+    td {{ border: none; padding: 0; }}
+    @media print {{ 
+        @page {{ size: A4; margin: 0; }} 
+        body {{ background: white; padding: 0; margin: 0; display: block; }} 
+        .a4-page {{ box-shadow: none; width: 100%; min-height: auto; padding: 10mm; margin: 0; page-break-after: always; }} 
+        .watermark {{ color: rgba(0, 0, 0, 0.06) !important; -webkit-print-color-adjust: exact; print-color-adjust: exact; }}
+        tfoot {{ display: table-footer-group; }}
+    }} 
+    h1, h2, h3 {{ text-align: center; column-span: all; }} 
+    h2 {{ font-size: 16px; border-bottom: 1px dashed #ccc; padding-bottom: 5px; }}
+    .content-body {{ {col_style} position: relative; z-index: 1; text-align: justify; }} 
+    .content-body p {{ margin-bottom: 8px; margin-top: 4px; }}
+    .footer-content {{ text-align: center; margin-top: 20px; padding-top: 10px; border-top: 2px dashed #bbb; font-size: 13px; color: #444; position: relative; z-index: 1; background: white; }}
+    </style></head><body><div class="a4-page">
+    <div class="watermark">{i_name}</div>
+    <table>
+        <thead><tr><td></td></tr></thead>
+        <tbody><tr><td>{final_inner_html}</td></tr></tbody>
+        <tfoot><tr><td>
+            <div class="footer-content"><!--pdf:footer-->
+                {logo_footer}<strong>{i_name}</strong> | 📍 {i_address} | 📞 {i_contact} | 👨‍🏫 <strong>{t_name}</strong>
+            <!--/pdf:footer--></div>
+        </td></tr></tfoot>
+    </table>
+    </div></body></html>"""
+
+# --- PDF ENGINES ---
+# "pisa" (xhtml2pdf) renders create_a4_html's page as-is; "fitz" (PyMuPDF's
+# Story layout) lays the same HTML out itself, with a real two-column flow
+# and HarfBuzz-shaped Devanagari. PAPERBANAO_PDF_ENGINE picks the default.
+# pisa stays the default: it only references the base-14 fonts (~4 KB a
+# paper), while fitz embeds subset fonts (~15-20 KB English, ~30 KB Hindi),
+# so fitz is for layout and shaping, not for smaller files.
+PDF_ENGINES = ("pisa", "fitz")
+PDF_ENGINE = os.environ.get("PAPERBANAO_PDF_ENGINE", "pisa")
+PDF_FONT_DIRS = [d for d in [os.environ.get("PAPERBANAO_FONT_DIR")] if d] + [
+    "/usr/share/fonts/truetype/noto", "/usr/share/fonts/noto", "/usr/share/fonts/opentype/noto",
+    "/Library/Fonts", "C:\\Windows\\Fonts",
+]
+PDF_PAGE_MARGIN = 28      # pt (10 mm)
+PDF_COLUMN_GAP = 42       # pt (15 mm)
+PDF_FOOTER_HEIGHT = 26    # pt
+PDF_MARKER_RE = {part: re.compile(rf'<!--pdf:{part}-->(.*?)<!--/pdf:{part}-->', re.DOTALL) for part in ("header", "body", "footer")}
+
+PDF_SUBSET_FONTS = True
+# Faces the fitz engine embeds when found in PDF_FONT_DIRS: (css family, weight) -> file.
+PDF_FONT_FACES = {
+    ("NotoSans", "normal"): "NotoSans-Regular.ttf",
+    ("NotoSans", "bold"): "NotoSans-Bold.ttf",
+    ("NotoSansDevanagari", "normal"): "NotoSansDevanagari-Regular.ttf",
+    ("NotoSansDevanagari", "bold"): "NotoSansDevanagari-Bold.ttf",
+}
+DEVANAGARI_RE = re.compile(r'[\u0900-\u097F]')
+# Pictographs (and the joiners/selectors that build them) pull MuPDF's emoji
+# and serif fallback fonts into every file, ~35 KB even subset; the fitz
+# engine leaves them out of the footer, as xhtml2pdf can't draw them either.
+INLINE_FONT_RE = re.compile(r"font-family:[^;']*;?")   # inline faces would bypass the registry's stack
+PICTOGRAPH_RE = re.compile('[\u200d\ufe0f\u2600-\u27bf\U0001F000-\U0001FAFF]')
+
+class PDFFontRegistry:
+    """Font programs for the fitz engine, read from disk once and shared by
+    every render. Faces that aren't installed are left to MuPDF's built-in
+    Noto fallbacks, which also cover Devanagari."""
+    def __init__(self, font_dirs=None):
+        import pymupdf
+        self.archive = pymupdf.Archive()
+        self.faces = []
+        rules = []
+        for (family, weight), filename in PDF_FONT_FACES.items():
+            path = next((os.path.join(d, filename) for d in (font_dirs or PDF_FONT_DIRS) if os.path.exists(os.path.join(d, filename))), None)
+            if path is None:
+                continue
+            with open(path, "rb") as f:
+                self.archive.add((f.read(), filename))
+            self.faces.append((family, weight))
+            rules.append(f"@font-face {{ font-family: {family}; font-weight: {weight}; src: url({filename}); }}")
+        self.font_face_css = "\n".join(rules)
+
+    def css(self, html_string):
+        """@font-face rules plus a body font stack; Hindi papers lead with the
+        Devanagari face so its matching Latin glyphs are used too."""
+        families = {family for family, _ in self.faces}
+        order = ["NotoSansDevanagari", "NotoSans"] if DEVANAGARI_RE.search(html_string) else ["NotoSans", "NotoSansDevanagari"]
+        stack = ", ".join([f for f in order if f in families] + ["sans-serif"])
+        return f"{self.font_face_css}\nbody {{ font-family: {stack}; }}\n"
+
+_pdf_fonts = None
+_pdf_fonts_lock = threading.Lock()
+
+def pdf_font_registry():
+    """The process-wide PDFFontRegistry, loaded on first use."""
+    global _pdf_fonts
+    with _pdf_fonts_lock:
+        if _pdf_fonts is None:
+            _pdf_fonts = PDFFontRegistry()
+        return _pdf_fonts
+
+STORY_CSS = """
+body { font-size: 10pt; text-align: justify; }
+h1 { font-size: 17pt; text-align: center; margin: 0; }
+h2 { font-size: 12pt; text-align: center; text-decoration: underline; margin: 4pt 0 8pt 0; }
+h3 { font-size: 11pt; text-align: center; }
+p { margin: 2pt 0 5pt 0; }
+table { width: 100%; }
+td { padding: 0; vertical-align: middle; }
+img { max-height: 40pt; }
+"""
+
+def _pisa_pdf(html_string):
+    # xhtml2pdf pulls in all of reportlab (~0.5 s): only pay for it on the first export.
+    from xhtml2pdf import pisa
+    buf = BytesIO()
+    result = pisa.CreatePDF(html_string, dest=buf)
+    if result.err:
+        return None
+    return buf.getvalue()
+
+def _fitz_pdf(html_string):
+    import pymupdf
+    fonts = pdf_font_registry()
+    archive, css = fonts.archive, fonts.css(html_string) + STORY_CSS
+    two_col = "column-count: 2" in html_string
+    headers = [INLINE_FONT_RE.sub('', h) for h in PDF_MARKER_RE["header"].findall(html_string)]
+    bodies = [INLINE_FONT_RE.sub('', b) for b in PDF_MARKER_RE["body"].findall(html_string)]
+    footer = PDF_MARKER_RE["footer"].search(html_string)
+    watermark = re.search(r'<div class="watermark">(.*?)</div>', html_string, re.DOTALL)
+    if not bodies:
+        raise ValueError("HTML has no <!--pdf:body--> sections (not from create_a4_html?)")
+
+    page_rect = pymupdf.paper_rect("a4")
+    content = page_rect + (PDF_PAGE_MARGIN, PDF_PAGE_MARGIN, -PDF_PAGE_MARGIN, -PDF_PAGE_MARGIN - PDF_FOOTER_HEIGHT)
+    footer_rect = pymupdf.Rect(content.x0, content.y1 + 4, content.x1, page_rect.y1 - 6)
+    footer_html = footer and f"<div style='text-align: center; font-size: 8pt; color: #444;'>{PICTOGRAPH_RE.sub('', footer.group(1))}</div>"
+    footer_css = css.replace("text-align: justify;", "")
+
+    def end_page():
+        # Drawn in the same pass as the body so the two share font objects.
+        if footer_html:
+            footer_story = pymupdf.Story(html=footer_html, user_css=footer_css, archive=archive)
+            footer_story.place(footer_rect)
+            footer_story.draw(dev)
+        writer.end_page()
+
+    buf = BytesIO()
+    writer = pymupdf.DocumentWriter(buf)
+    column_rules = []  # (page number, x, y0, y1) for the line between the columns
+    page_no = 0
+    for header_html, body_html in zip(headers + [""] * len(bodies), bodies):
+        body = pymupdf.Story(html=body_html, user_css=css, archive=archive)
+        top = content.y0
+        dev = writer.begin_page(page_rect)
+        if header_html:
+            header = pymupdf.Story(html=header_html, user_css=css, archive=archive)
+            _, filled = header.place(content)
+            header.draw(dev)
+            top = pymupdf.Rect(filled).y1 + 6
+        while True:
+            area = pymupdf.Rect(content.x0, top, content.x1, content.y1)
+            if two_col:
+                half = (area.width - PDF_COLUMN_GAP) / 2
+                columns = [pymupdf.Rect(area.x0, area.y0, area.x0 + half, area.y1), pymupdf.Rect(area.x1 - half, area.y0, area.x1, area.y1)]
+            else:
+                columns = [area]
+            more = 0
+            for i, col in enumerate(columns):
+                more, filled = body.place(col)
+                body.draw(dev)
+                if i == 1:
+                    column_rules.append((page_no, (area.x0 + area.x1) / 2, area.y0, area.y1))
+                if not more:
+                    break
+            end_page()
+            page_no += 1
+            if not more:
+                break
+            dev = writer.begin_page(page_rect)
+            top = content.y0
+    writer.close()
+
+    # Watermark, footer rule and column rules go on every finished page.
+    doc = pymupdf.open("pdf", buf.getvalue())
+    for page_no, x, y0, y1 in column_rules:
+        doc[page_no].draw_line((x, y0), (x, y1), color=(0, 0, 0), width=0.6)
+    for page in doc:
+        if watermark:
+            text = re.sub(r'<[^>]+>', '', watermark.group(1)).strip().upper()
+            page.insert_text((120, 620), text, fontsize=48, color=(0.92, 0.92, 0.92), morph=(pymupdf.Point(120, 620), pymupdf.Matrix(-45)), overlay=False)
+        page.draw_line((footer_rect.x0, footer_rect.y0 - 2), (footer_rect.x1, footer_rect.y0 - 2), color=(0.7, 0.7, 0.7), width=0.6, dashes="[3] 0")
+    if PDF_SUBSET_FONTS:
+        # Keep only the glyphs the paper uses; full Noto programs are ~2 MB a paper.
+        try:
+            doc.subset_fonts()
+        except Exception as e:
+            logging.error(f"[PDF Font Subset Error] {e}")
+    out = doc.tobytes(garbage=4, deflate=True, use_objstms=1)
+    doc.close()
+    return out
+
+@traced("render.pdf")
+def html_to_pdf(html_string, engine=None):
+    """Renders create_a4_html() output to PDF bytes with the chosen engine
+    (default PDF_ENGINE). Returns None if rendering fails."""
+    engine = engine or PDF_ENGINE
+    try:
+        return _fitz_pdf(html_string) if engine == "fitz" else _pisa_pdf(html_string)
+    except Exception as e:
+        logging.error(f"[PDF Generation Error] ({engine}) {e}")
+        return None
+
+# 🌟 WORD RENDERER 🌟
+# Every export starts from a pre-styled template, built once per (two-column,
+# language) and kept as .docx bytes; opening a copy is much cheaper than
+# Document() plus restyling. Styles the renderer never uses (and Word's
+# latent-style table) are dropped from the template, which also keeps each
+# add_heading() style lookup short.
+DOCX_TEMPLATE_STYLES = {"normal", "title", "heading 1", "heading 2"}
+_docx_templates = {}
+_docx_templates_lock = threading.Lock()
+
+def paper_language(*texts):
+    """"hi" if any of the texts contain Devanagari, else "en"."""
+    return "hi" if any(DEVANAGARI_RE.search(t or "") for t in texts) else "en"
+
+def _build_docx_template(is_2_col, language):
+    from docx import Document
+    from docx.shared import Inches, Pt, RGBColor
+    from docx.oxml.ns import qn
+    doc = Document()
+
+    def set_style_fonts(rPr):
+        rFonts = rPr.rFonts
+        if rFonts is not None:
+            if language == "hi":
+                rFonts.set(qn('w:cs'), 'Noto Sans Devanagari')
+            rFonts.set(qn('w:ascii'), 'Arial')
+            rFonts.set(qn('w:hAnsi'), 'Arial')
+
+    style = doc.styles['Normal']
+    font = style.font
+    font.name = 'Arial' 
+    font.size = Pt(11)
+    set_style_fonts(style.element.rPr)
+    if language == "hi":
+        style_lang = style.element.rPr.find(qn('w:lang'))
+        if style_lang is None:
+            style_lang = style.element.rPr.makeelement(qn('w:lang'), {})
+            style.element.rPr.append(style_lang)
+        style_lang.set(qn('w:bidi'), 'hi-IN')
+    
+    for i in range(3):
+        try:
+            h_style = doc.styles[f'Heading {i}']
+            h_style.font.name = 'Arial'
+            set_style_fonts(h_style.element.rPr)
+            h_style.font.color.rgb = RGBColor(0, 0, 0)
+            if i == 0:
+                h_style.font.size = Pt(16)
+                h_style.font.bold = True
+            elif i == 1:
+                h_style.font.size = Pt(12)
+                h_style.font.bold = True
+            elif i == 2:
+                h_style.font.size = Pt(11)
+                h_style.font.bold = True
+        except KeyError: pass
+
+    if is_2_col:
+        for section in doc.sections:
+            section.top_margin = section.bottom_margin = section.left_margin = section.right_margin = Inches(0.4)
+
+    # Keep the styles we use, the defaults, and whatever they are based on or linked to.
+    styles = doc.styles.element
+    by_id = {st.get(qn('w:styleId')): st for st in styles.findall(qn('w:style'))}
+    todo = [sid for sid, st in by_id.items()
+            if st.get(qn('w:default')) == '1' or st.find(qn('w:name')).get(qn('w:val')).lower() in DOCX_TEMPLATE_STYLES]
+    keep = set()
+    while todo:
+        sid = todo.pop()
+        if sid in keep or sid not in by_id:
+            continue
+        keep.add(sid)
+        for tag in ('w:basedOn', 'w:link', 'w:next'):
+            ref = by_id[sid].find(qn(tag))
+            if ref is not None:
+                todo.append(ref.get(qn('w:val')))
+    for sid, st in by_id.items():
+        if sid not in keep:
+            styles.remove(st)
+    latent = styles.find(qn('w:latentStyles'))
+    if latent is not None:
+        styles.remove(latent)
+
+    bio = BytesIO()
+    doc.save(bio)
+    return bio.getvalue()
+
+def docx_template(is_2_col, language):
+    """Template .docx bytes for this layout and language, built on first use."""
+    key = (bool(is_2_col), language)
+    with _docx_templates_lock:
+        if key not in _docx_templates:
+            _docx_templates[key] = _build_docx_template(*key)
+        return _docx_templates[key]
+
+@traced("render.docx")
+def create_word_docx(md_content, i_name, i_address, i_contact, t_name, inst_logo=None, is_2_col=False, sub="Subject", grade="Class", total_m="Marks", exam_time="Time", topics=""):
+    from docx import Document
+    from docx.shared import Inches, Pt, RGBColor
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    from docx.oxml.ns import qn
+    language = paper_language(md_content, i_name, i_address, i_contact, t_name, sub, grade, total_m, exam_time, topics)
+    doc = Document(BytesIO(docx_template(is_2_col, language)))
+    
+    md_content = re.sub(r"^#.*?\*\*\*", "", md_content, count=1, flags=re.DOTALL).strip()
+    md_content = re.sub(r"^\*\*Subject:\*\*.*?\n", "", md_content, flags=re.MULTILINE)
+    md_content = re.sub(r"^\*\*Class:\*\*.*?\n", "", md_content, flags=re.MULTILINE)
+    md_content = re.sub(r"^\*\*Marks:\*\*.*?\n", "", md_content, flags=re.MULTILINE)
+    md_content = re.sub(r"^\*\*Time:\*\*.*?\n", "", md_content, flags=re.MULTILINE)
+    md_content = re.sub(r"^\d+\.\s", "**Q.** ", md_content, flags=re.MULTILINE)
+    md_content = md_content.strip()
+        
+    md_content = md_content.replace('\r', '')
+
+    def apply_cs_font(run):
+        # English papers get Arial and no complex-script text from the template's styles.
+        if language != "hi":
+            return
+        rpr = run._r.get_or_add_rPr()
+        rfonts = rpr.find(qn('w:rFonts'))
+        if rfonts is None:
+            rfonts = rpr.makeelement(qn('w:rFonts'), {})
+            rpr.append(rfonts)
+        rfonts.set(qn('w:cs'), 'Noto Sans Devanagari')
+        rfonts.set(qn('w:ascii'), 'Arial')
+        rfonts.set(qn('w:hAnsi'), 'Arial')
+        # Without an explicit language tag, Word doesn't reliably classify
+        # Devanagari text as "complex script" and may render it with the
+        # ascii font (Arial, no Devanagari glyphs = tofu boxes) regardless
+        # of the w:cs font specified above. This tag is what makes Word
+        # actually route the text correctly.
+        lang = rpr.find(qn('w:lang'))
+        if lang is None:
+            lang = rpr.makeelement(qn('w:lang'), {})
+            rpr.append(lang)
+        lang.set(qn('w:bidi'), 'hi-IN')
+
+    def insert_chate_header():
+        title_table = doc.add_table(rows=1, cols=1)
+        p1 = title_table.cell(0,0).paragraphs[0]
+        p1.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        
+        if inst_logo is not None:
+            try:
+                inst_logo.seek(0)
+                r_logo = p1.add_run()
+                r_logo.add_picture(inst_logo, height=Inches(0.38))
+                p1.add_run("   ") 
+            except Exception: pass
+            
+        r1 = p1.add_run(i_name.upper())
+        r1.bold = True
+        r1.font.size = Pt(18)
+        apply_cs_font(r1)
+        
+        details_table = doc.add_table(rows=1, cols=3)
+        details_table.autofit = False
+        for cell in details_table.columns[0].cells: cell.width = Inches(2.0)
+        for cell in details_table.columns[1].cells: cell.width = Inches(3.0)
+        for cell in details_table.columns[2].cells: cell.width = Inches(2.0)
+
+        p3 = details_table.cell(0,0).paragraphs[0]
+        p3.alignment = WD_ALIGN_PARAGRAPH.LEFT
+        r3 = p3.add_run(f"Class : {grade}\nTime : {exam_time}")
+        r3.bold = True
+        r3.font.size = Pt(10)
+        apply_cs_font(r3)
+
+        p4 = details_table.cell(0,1).paragraphs[0]
+        p4.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        r4 = p4.add_run("\n[ EXAMINATION ]")
+        r4.bold = True
+        r4.font.size = Pt(12)
+        apply_cs_font(r4)
+
+        p2 = details_table.cell(0,2).paragraphs[0]
+        p2.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+        r2 = p2.add_run(f"Sub.: {sub}\nMarks: {total_m}")
+        r2.bold = True
+        r2.font.size = Pt(10)
+        apply_cs_font(r2)
+        
+        doc.add_paragraph("__________________________________________________________________________").alignment = WD_ALIGN_PARAGRAPH.CENTER
+        pt = doc.add_paragraph("MULTIPLE CHOICE QUESTIONS & THEORY")
+        pt.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        pt.runs[0].bold = True
+        apply_cs_font(pt.runs[0])
+        
+        main_heading_text = topics.strip().upper() if topics.strip() != "" else sub.upper()
+        ptopics = doc.add_paragraph(main_heading_text)
+        ptopics.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        ptopics.runs[0].underline = True
+        ptopics.runs[0].font.size = Pt(14)
+        ptopics.runs[0].bold = True
+        apply_cs_font(ptopics.runs[0])
+        doc.add_paragraph() 
+
+    insert_chate_header()
+
+    if is_2_col:
+        new_section = doc.add_section(0) 
+        sectPr = new_section._sectPr
+        cols = sectPr.xpath('./w:cols')[0]
+        cols.set(qn('w:num'), '2')
+        cols.set(qn('w:space'), '720') 
+
+    for line in md_content.split('\n'):
+        line_clean = line.strip()
+        if not line_clean: continue
+        line_clean = clean_math_for_word(line_clean)
+        
+        if "Answer Key" in line_clean or "ANSWER KEY" in line_clean:
+            doc.add_page_break() 
+            insert_chate_header() 
+            doc.add_heading("Answer Key", level=1)
+            continue
+            
+        if line_clean.startswith('# '): 
+            doc.add_heading(line_clean.replace('# ', ''), level=1)
+        elif line_clean.startswith('## '): 
+            doc.add_heading(line_clean.replace('## ', ''), level=2)
+        else:
+            p = doc.add_paragraph()
+            p.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY 
+            parts = re.split(r'\*\*(.*?)\*\*', line_clean)
+            for i, part in enumerate(parts):
+                run = p.add_run(part)
+                if i % 2 == 1: run.bold = True
+                apply_cs_font(run)
+                
+    if doc.sections:
+        footer = doc.sections[0].footer
+        footer_para = footer.paragraphs[0] if footer.paragraphs else footer.add_paragraph()
+        footer_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        
+        if inst_logo is not None:
+            try:
+                inst_logo.seek(0)
+                run_logo = footer_para.add_run()
+                run_logo.add_picture(inst_logo, height=Inches(0.18))
+                footer_para.add_run("  ") 
+            except Exception: pass
+            
+        run_name = footer_para.add_run(f"{i_name}  |  ")
+        run_name.font.size = Pt(10)
+        run_name.font.bold = True
+        run_name.font.color.rgb = RGBColor(100, 100, 100)
+        apply_cs_font(run_name)
+        
+        run_rest = footer_para.add_run(f"📍 {i_address}  |  📞 {i_contact}  |  👨‍🏫 {t_name}")
+        run_rest.font.size = Pt(10)
+        run_rest.font.color.rgb = RGBColor(100, 100, 100)
+        apply_cs_font(run_rest)
+            
+    bio = BytesIO()
+    doc.save(bio)
+    return bio.getvalue()
+
+# 📦 BATCH ZIP EXPORT 📦
+# Rendering runs on a small worker pool, but only a couple of papers per
+# worker are ever in flight, and each finished file goes straight into a
+# ZIP on a spooled temp file (RAM until it gets big, then disk), so a
+# term's worth of papers never sits in memory all at once.
+BATCH_EXPORT_WORKERS = 4
+BATCH_SPOOL_MAX_BYTES = 8 * 1024 * 1024
+BATCH_FORMATS = ["HTML", "Word", "PDF"]
+
+def safe_file_stem(text, fallback="Paper"):
+    stem = re.sub(r'[^\w\- ]+', '_', text or "").strip().replace(' ', '_')
+    return stem[:60] or fallback
+
+def paper_file_stem(paper):
+    return paper.get('file_stem') or f"{safe_file_stem(paper['subject'])}_{paper['id']}"
+
+def render_paper_artifacts(paper, formats, i_name, i_address, i_contact, t_name, logo_bytes=None, logo_mimetype=None, is_2_col=False, exam_time="Time"):
+    """Renders one saved paper into the requested formats and returns
+    (files, missing). Each worker gets its own copy of the logo so threads
+    don't fight over seek() on the sidebar's file object."""
+    logo = StoredLogo(logo_bytes, logo_mimetype or "image/png") if logo_bytes else None
+    stem = paper_file_stem(paper)
+    grade, total_m, topics = paper.get('class', "N/A"), paper.get('marks', "N/A"), paper.get('topics', "")
+    files, missing = [], []
+    html = create_a4_html(paper['content'], i_name, i_address, i_contact, t_name, logo, is_2_col, paper['subject'], grade, total_m, exam_time, topics)
+    if "HTML" in formats:
+        files.append((f"{stem}.html", html.encode("utf-8")))
+    if "Word" in formats:
+        files.append((f"{stem}.docx", create_word_docx(paper['content'], i_name, i_address, i_contact, t_name, logo, is_2_col, paper['subject'], grade, total_m, exam_time, topics)))
+    if "PDF" in formats:
+        pdf = html_to_pdf(html)
+        if pdf:
+            files.append((f"{stem}.pdf", pdf))
+        else:
+            missing.append(f"{stem}.pdf")
+    return files, missing
+
+def build_papers_zip(papers, formats, i_name, i_address, i_contact, t_name, inst_logo=None, is_2_col=False, exam_time="Time", path=None):
+    """Renders many papers concurrently into one ZIP. Returns the ZIP bytes
+    (or, with path, writes the ZIP to that file and returns path) and a list
+    of files that couldn't be rendered (e.g. failed PDFs)."""
+    logo_bytes, logo_mimetype = None, None
+    if inst_logo is not None:
+        logo_bytes, logo_mimetype = inst_logo.getvalue(), inst_logo.type
+
+    missing = []
+    with (open(path, "wb") if path else tempfile.SpooledTemporaryFile(max_size=BATCH_SPOOL_MAX_BYTES)) as out:
+        with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zf, ThreadPoolExecutor(max_workers=BATCH_EXPORT_WORKERS) as pool:
+            def write_done(done):
+                for fut in done:
+                    try:
+                        files, failed = fut.result()
+                    except Exception as e:
+                        logging.error(f"[Batch Export Error] {e}")
+                        missing.append(futures[fut])
+                        continue
+                    missing.extend(failed)
+                    for arcname, data in files:
+                        # .docx and .pdf are already compressed; deflating them again only costs CPU.
+                        compress = zipfile.ZIP_DEFLATED if arcname.endswith(".html") else zipfile.ZIP_STORED
+                        zf.writestr(arcname, data, compress_type=compress)
+
+            futures = {}
+            for p in papers:
+                fut = pool.submit(render_paper_artifacts, p, formats, i_name, i_address, i_contact, t_name,
+                                  logo_bytes, logo_mimetype, is_2_col, exam_time)
+                futures[fut] = paper_file_stem(p)
+                if len(futures) >= BATCH_EXPORT_WORKERS * 2:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    write_done(done)
+                    for fut in done: del futures[fut]
+            write_done(wait(futures)[0])
+        if path:
+            return path, missing
+        out.seek(0)
+        return out.read(), missing
+
+# ==========================================
+# --- PAPER SPECS (headless generation) ---
+# ==========================================
+# A paper spec is a plain dict (e.g. loaded from JSON) describing one paper
+# the same way the Create tab does. Anything left out falls back to the
+# Create tab's defaults.
+QUESTION_TYPE_DEFAULTS = {
+    # key: (count, marks, difficulty)
+    "mcq": (5, 1, "Easy"),
+    "fib": (3, 1, "Easy"),
+    "tf": (3, 1, "Easy"),
+    "short": (3, 2, "Medium"),
+    "long": (2, 5, "Hard"),
+}
+
+def split_blocks(resp_text):
+    """Splits a `|||`-delimited model response into editor blocks."""
+    return [{'id': str(uuid.uuid4()), 'text': b.strip()} for b in resp_text.split("|||") if b.strip()]
+
+# ==========================================
+# --- STRUCTURED (JSON) OUTPUT ---
+# ==========================================
+# In JSON mode Gemini is asked for a responseSchema-shaped document instead of
+# `|||`-delimited text, so parsing never depends on the model keeping to the
+# delimiter/label conventions. Items that fail validation are re-requested on
+# their own rather than regenerating the whole paper.
+QUESTION_KINDS = {
+    # kind: (section title, required option count or None)
+    "mcq": ("Multiple Choice Questions", 4),
+    "fib": ("Fill in the Blanks", 4),
+    "tf": ("True / False", 2),
+    "short": ("Short Answer Questions", None),
+    "long": ("Long Answer Questions", None),
+}
+STRUCTURED_REPAIR_ROUNDS = 2
+
+QUESTION_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "text": {"type": "STRING"},
+        "options": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "marks": {"type": "INTEGER"},
+        "answer": {"type": "STRING"},
+    },
+    "required": ["text", "marks"],
+    "propertyOrdering": ["text", "options", "marks", "answer"],
+}
+PAPER_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "sections": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "kind": {"type": "STRING", "enum": list(QUESTION_KINDS)},
+                    "marks_each": {"type": "INTEGER"},
+                    "questions": {"type": "ARRAY", "items": QUESTION_SCHEMA},
+                },
+                "required": ["kind", "marks_each", "questions"],
+                "propertyOrdering": ["kind", "marks_each", "questions"],
+            },
+        },
+    },
+    "required": ["sections"],
+}
+REPAIR_RESPONSE_SCHEMA = {"type": "ARRAY", "items": QUESTION_SCHEMA}
+
+def structured_output_rules(subject, include_answers):
+    answer_rule = (
+        "4. ANSWERS: Fill 'answer' for EVERY question: the correct option as '(C) <option text>' for MCQ/FIB/True-False, "
+        "or a detailed step-by-step explanation for short/long questions, proportional to their marks."
+        if include_answers else "4. ANSWERS: Leave 'answer' empty."
+    )
+    return f"""OUTPUT FORMAT (JSON):
+1. STRICTLY adhere to the subject: **{subject}**. Do NOT generate general knowledge questions.
+2. Return one entry in 'sections' per requested question type, in the order given above, with 'kind' set to mcq, fib, tf, short or long and 'marks_each' to its marks.
+3. For each question put ONLY the question text in 'text' — no 'Q1.' label and no options. Put the options in 'options' WITHOUT the (A)/(B) letters: exactly 4 for mcq and fib, exactly 2 ('True', 'False') for tf, none for short/long.
+{answer_rule}
+5. MATH: USE UNICODE SYMBOLS ONLY (θ, π, √, ²). NO LaTeX. Write fractions as a/b.
+"""
+
+def question_problem(kind, q, include_answers):
+    """Returns why a structured question is unusable, or None if it's fine."""
+    if not isinstance(q, dict) or not str(q.get("text", "")).strip():
+        return "empty question text"
+    needed = QUESTION_KINDS[kind][1]
+    options = [o for o in q.get("options") or [] if str(o).strip()]
+    if needed and len(options) != needed:
+        return f"needs exactly {needed} options, got {len(options)}"
+    if include_answers and not str(q.get("answer", "")).strip():
+        return "missing answer"
+    return None
+
+def parse_structured_paper(resp_text):
+    """Loads a JSON-mode reply into [section, ...], dropping sections of an
+    unknown kind. Raises ValueError if the reply isn't the expected shape."""
+    data = json.loads(resp_text)
+    sections = data.get("sections") if isinstance(data, dict) else None
+    if not isinstance(sections, list):
+        raise ValueError("Structured reply has no 'sections' list.")
+    return [sec for sec in sections if isinstance(sec, dict) and sec.get("kind") in QUESTION_KINDS and isinstance(sec.get("questions"), list)]
+
+def requested_section_marks(config):
+    """{kind: marks each} for the question types a render_question_config() /
+    question_config_from_spec() tuple asks for (count above 0)."""
+    return {kind: int(config[i * 3 + 2]) for i, kind in enumerate(QUESTION_TYPE_DEFAULTS) if config[i * 3] > 0}
+
+def apply_section_marks(sections, marks):
+    """Sets each section's marks_each from the request, so headers and repairs
+    never depend on the model's figure; that is only cross-checked. Sections
+    of a kind that wasn't asked for are dropped."""
+    kept = []
+    for sec in sections:
+        if sec["kind"] not in marks:
+            logging.error(f"[Structured Output] dropping an unrequested '{sec['kind']}' section")
+            continue
+        if sec.get("marks_each") != marks[sec["kind"]]:
+            logging.error(f"[Structured Output] '{sec['kind']}' came back as {sec.get('marks_each')} mark(s) each, not {marks[sec['kind']]}")
+        kept.append(dict(sec, marks_each=marks[sec["kind"]]))
+    return kept
+
+def repair_structured_questions(sections, bad, api_key, model_name, subject, include_answers):
+    """Re-requests only the (section, question) pairs in `bad`, in one call,
+    and patches the replies into sections. Returns the pairs still bad."""
+    items = [{"kind": sections[si]["kind"], "marks": sections[si].get("marks_each"), "problem": problem, "question": sections[si]["questions"][qi]}
+             for si, qi, problem in bad]
+    prompt = (
+        f"These questions from a {subject} exam paper failed validation. Fix each one, keeping its subject, language, "
+        "difficulty and marks, and return a JSON array with exactly one corrected question per item, in the same order.\n\n"
+        + structured_output_rules(subject, include_answers)
+        + "\nITEMS:\n" + json.dumps(items, ensure_ascii=False)
+    )
+    fixed = json.loads(generate_gemini_content(prompt, api_key, model_name, response_schema=REPAIR_RESPONSE_SCHEMA))
+    still_bad = []
+    for (si, qi, problem), q in zip(bad, fixed if isinstance(fixed, list) else []):
+        problem = question_problem(sections[si]["kind"], q, include_answers)
+        if problem is None:
+            sections[si]["questions"][qi] = q
+        else:
+            still_bad.append((si, qi, problem))
+    return still_bad + bad[len(fixed) if isinstance(fixed, list) else 0:]
+
+def structured_paper_to_blocks(sections, include_answers):
+    """Deterministically lays a structured paper out as editor blocks, in the
+    same shape split_blocks() produces: one block per section header and per
+    question (numbered continuously), then '# ANSWER KEY' and one block per answer.
+    Header marks are the sections' marks_each, i.e. the requested marks once
+    apply_section_marks() has run."""
+    blocks, answers, n = [], [], 0
+    for sec in sections:
+        title = QUESTION_KINDS[sec["kind"]][0]
+        blocks.append(f"## {title} [{sec.get('marks_each', 1)} Mark(s) Each]")
+        for q in sec["questions"]:
+            n += 1
+            text = f"**Q{n}.** {str(q['text']).strip()}"
+            options = [str(o).strip() for o in q.get("options") or [] if str(o).strip()]
+            if QUESTION_KINDS[sec["kind"]][1] and options:
+                text += "\n" + "   ".join(f"({letter}) {opt}" for letter, opt in zip("ABCDEFGH", options))
+            blocks.append(text)
+            answers.append(f"**Q{n}.** {str(q.get('answer', '')).strip()}")
+    if include_answers:
+        blocks.append("# ANSWER KEY")
+        blocks.extend(answers)
+    return [{'id': str(uuid.uuid4()), 'text': b} for b in blocks]
+
+def generate_structured_paper(prompt, api_key, model_name, subject, include_answers, context=None, marks=None):
+    """JSON-mode counterpart of split_blocks(generate_gemini_content(prompt))."""
+    return structured_paper_to_blocks(generate_structured_sections(prompt, api_key, model_name, subject, include_answers, context, marks), include_answers)
+
+def generate_structured_sections(prompt, api_key, model_name, subject, include_answers, context=None, marks=None):
+    """The validated sections of a JSON-mode paper, before layout. marks is
+    the requested {kind: marks each} (see requested_section_marks()). Bad
+    items are repaired with targeted re-requests; any that still fail after
+    STRUCTURED_REPAIR_ROUNDS are dropped rather than failing the paper."""
+    sections = parse_structured_paper(generate_gemini_content(prompt, api_key, model_name, response_schema=PAPER_RESPONSE_SCHEMA, context=context))
+    if marks is not None:
+        sections = apply_section_marks(sections, marks)
+    bad = [(si, qi, problem) for si, sec in enumerate(sections) for qi, q in enumerate(sec["questions"])
+           if (problem := question_problem(sec["kind"], q, include_answers))]
+    for _ in range(STRUCTURED_REPAIR_ROUNDS):
+        if not bad:
+            break
+        try:
+            bad = repair_structured_questions(sections, bad, api_key, model_name, subject, include_answers)
+        except Exception as e:
+            logging.error(f"[Structured Repair Error] {e}")
+    if bad:
+        logging.error(f"[Structured Output] dropping {len(bad)} question(s) that failed validation: {[p for _, _, p in bad]}")
+        drop = {(si, qi) for si, qi, _ in bad}
+        for si, sec in enumerate(sections):
+            sec["questions"] = [q for qi, q in enumerate(sec["questions"]) if (si, qi) not in drop]
+    return [sec for sec in sections if sec["questions"]]
+
+def book_context(pdf_text):
+    """PDF Extract's book text as generation context (see context_cache.py), or None."""
+    return f"TEXT EXTRACTED FROM A BOOK:\n\n{pdf_text}" if pdf_text and pdf_text.strip() else None
+
+def build_paper_prompt(q_reqs, subject, grade, topics, pdf_text="", board="", book_in_context=False):
+    """With book_in_context, pdf_text is left out of the prompt: pass
+    book_context(pdf_text) as the generation context instead."""
+    header = f"Subject: {subject}\nClass: {grade}\n" + (f"Board: {board}\n" if board else "") + f"Topics: {topics}"
+    prompt = f"{header}\n\n{q_reqs}\n\nIMPORTANT: Start directly with the questions. DO NOT generate any Title, Institute Name, Time, or Marks at the top."
+    if book_in_context:
+        if book_context(pdf_text):
+            prompt += "\n\nCREATE QUESTIONS STRICTLY FROM THE TEXT EXTRACTED FROM A BOOK GIVEN ABOVE."
+    elif pdf_text:
+        prompt += f"\n\nCREATE QUESTIONS STRICTLY FROM THE FOLLOWING TEXT EXTRACTED FROM A BOOK:\n\n{pdf_text}"
+    return prompt
+
+def question_config_from_spec(spec):
+    """Returns the same tuple render_question_config() does, from a spec's
+    optional "questions" mapping, e.g. {"mcq": {"count": 10, "marks": 1}}."""
+    qs = spec.get("questions", {})
+    values = []
+    for key, (count, marks, diff) in QUESTION_TYPE_DEFAULTS.items():
+        q = qs.get(key, {})
+        values.append((int(q.get("count", count)), q.get("difficulty", diff), int(q.get("marks", marks))))
+    total_q = sum(c for c, _, _ in values)
+    total_m = sum(c * m for c, _, m in values)
+    return tuple(v for triple in values for v in triple) + (total_q, total_m)
+
+def build_spec_prompt(spec, pdf_text="", book_in_context=False):
+    """Builds the full generation prompt for a spec. Returns (prompt, total_q, total_m)."""
+    config = question_config_from_spec(spec)
+    total_q, total_m = config[-2:]
+    q_reqs = build_question_prompt(*config[:-2], spec.get("include_answer_key", True), spec.get("language", "English"), spec["subject"], spec.get("structured", False))
+    return build_paper_prompt(q_reqs, spec["subject"], spec.get("class", ""), spec.get("topics", ""), pdf_text, spec.get("board", ""), book_in_context), total_q, total_m
+
+def load_spec_logo(spec):
+    path = spec.get("institute", {}).get("logo_path")
+    if not path:
+        return None
+    ext = os.path.splitext(path)[1].lower().lstrip(".")
+    with open(path, "rb") as f:
+        return StoredLogo(f.read(), "image/png" if ext == "png" else "image/jpeg")
+
+def generate_paper(spec, api_key, model_name=DEFAULT_MODEL_NAME):
+    """Generates one paper from a spec and renders its files. Returns a dict
+    with the blocks, the paper markdown and [(filename, bytes)] artifacts."""
+    if not spec.get("subject", "").strip() or not str(spec.get("class", "")).strip():
+        raise ValueError("Spec needs a subject and a class.")
+    pdf_text = ""
+    if spec.get("pdf_path"):
+        with open(spec["pdf_path"], "rb") as f:
+            pdf_text = extract_text_from_pdf(f, int(spec.get("start_page", 1)), int(spec.get("end_page", 5)), api_key, model_name)
+    # Specs sharing a book reuse one cached copy of it.
+    prompt, total_q, total_m = build_spec_prompt(spec, pdf_text, book_in_context=True)
+    context = book_context(pdf_text)
+    if total_q == 0:
+        raise ValueError("Spec has no questions (every count is 0).")
+
+    usage_config = {"questions": spec.get("questions", {}), "language": spec.get("language", "English"),
+                    "structured": bool(spec.get("structured")), "pdf_chars": len(pdf_text)}
+    with usage_context(spec.get("username", "cli"), "spec", usage_config):
+        if spec.get("structured"):
+            marks = requested_section_marks(question_config_from_spec(spec))
+            blocks = generate_structured_paper(prompt, api_key, model_name, spec["subject"], spec.get("include_answer_key", True), context, marks)
+        else:
+            blocks = split_blocks(generate_gemini_content(prompt, api_key, model_name, context=context))
+    paper_md = "\n\n".join(b['text'] for b in blocks)
+    inst = spec.get("institute", {})
+    paper = {
+        'id': spec.get("id", "paper"), 'subject': spec["subject"], 'class': spec["class"],
+        'marks': str(total_m), 'topics': spec.get("topics", ""), 'content': paper_md,
+        'file_stem': safe_file_stem(spec.get("file_stem") or f"{spec['subject']}_Paper"),
+    }
+    logo = load_spec_logo(spec)
+    files, missing = render_paper_artifacts(
+        paper, spec.get("formats", BATCH_FORMATS),
+        inst.get("name", "My Success Academy"), inst.get("address", ""), inst.get("contact", ""), inst.get("teacher", ""),
+        logo.getvalue() if logo else None, logo.type if logo else None,
+        spec.get("two_column", True), inst.get("exam_time", "2 Hours"))
+    return {"blocks": blocks, "content": paper_md, "files": files, "missing": missing}
@@ -0,0 +1,51 @@
+"""Fixture papers shared by bench_render.py and mock_gemini.py.
+
+QUESTION_TEXT holds a few English, Hindi and Bilingual questions (Unicode
+maths, Devanagari, mixed scripts); make_fixture_response() cycles them into
+a `|||`-delimited paper shaped like a real Gemini reply.
+"""
+
+LANGUAGES = ["English", "Hindi", "Bilingual"]
+
+# (question stem, options or None) per language; cycled to build fixtures.
+QUESTION_TEXT = {
+    "English": [
+        ("If sin θ = 3/5, find the value of cos θ.", ["4/5", "3/4", "5/3", "1/2"]),
+        ("The value of √144 + 2² is", ["14", "16", "12", "18"]),
+        ("Explain the process of photosynthesis with a labelled diagram.", None),
+        ("Prove that the sum of angles of a triangle is 180°.", None),
+    ],
+    "Hindi": [
+        ("यदि sin θ = 3/5 है, तो cos θ का मान ज्ञात करें।", ["4/5", "3/4", "5/3", "1/2"]),
+        ("√144 + 2² का मान है", ["14", "16", "12", "18"]),
+        ("प्रकाश संश्लेषण [Photosynthesis] की प्रक्रिया को समझाइए।", None),
+        ("सिद्ध करें कि त्रिभुज के कोणों का योग 180° होता है।", None),
+    ],
+    "Bilingual": [
+        ("Agar sin θ = 3/5 hai, to cos θ ka maan [value] ज्ञात करें।", ["4/5", "3/4", "5/3", "1/2"]),
+        ("√144 + 2² ka maan hai", ["14", "16", "12", "18"]),
+        ("Photosynthesis (प्रकाश संश्लेषण) ki process ko explain karein.", None),
+        ("Prove karein ki triangle ke angles ka sum 180° hota hai.", None),
+    ],
+}
+
+def make_fixture_response(language, n_questions, answer_key=True):
+    """A `|||`-delimited paper shaped like a real Gemini response."""
+    blocks = ["## Multiple Choice Questions [1 Mark(s) Each]"]
+    answers = []
+    samples = QUESTION_TEXT[language]
+    for n in range(1, n_questions + 1):
+        stem, options = samples[(n - 1) % len(samples)]
+        if n == n_questions // 2 + 1:
+            blocks.append("## Short Answer Questions [3 Mark(s) Each]")
+        if options:
+            opts = "   ".join(f"({l}) {o}" for l, o in zip("ABCD", options))
+            blocks.append(f"**Q{n}.** {stem}\n{opts}")
+            answers.append(f"**Q{n}.** (A) {options[0]}")
+        else:
+            blocks.append(f"**Q{n}.** {stem}")
+            answers.append(f"**Q{n}.** Step 1: write the given values.\nStep 2: apply the formula \\frac{{a}}{{b}} and simplify.\nStep 3: hence proved.")
+    if answer_key:
+        blocks.append("# ANSWER KEY")
+        blocks.extend(answers)
+    return "\n|||\n".join(blocks)
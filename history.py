@@ -0,0 +1,280 @@
+"""Cloud History storage format.
+
+A saved paper is identified per user by the hash of its content, so saving
+the same paper again updates the existing row instead of adding a copy.
+Contents of COMPRESS_MIN_CHARS or more are stored zlib-compressed and
+base64-encoded behind a "zlib:" prefix; unpack_content() reads both that
+and the plain text of rows saved before compression existed. The papers
+table needs:
+
+    alter table papers add column content_hash text;
+    create unique index papers_username_content_hash on papers (username, content_hash);
+
+Old rows keep a null content_hash until they are saved again; they are
+never matched by an upsert, so they can't be overwritten by mistake.
+
+Saving again from the tab that saved a paper makes a new revision of it.
+papers.content always holds the latest text (the head, revision papers.rev);
+each older revision is one paper_revisions row holding only a block-level
+delta that turns the next revision back into it. Storage grows with the
+size of the edits, and revision r is rebuilt by walking back from the head:
+
+    alter table papers add column rev int not null default 0;
+    create table paper_revisions (
+        id bigserial primary key, paper_id bigint references papers (id) on delete cascade,
+        username text, rev int, created_at timestamptz, delta text,
+        unique (paper_id, rev));
+
+Search runs in the database and returns only ids and snippets. Each row
+carries search_text, the paper's plain words (markdown stripped, plus its
+language by name, so "Class 10 Trigonometry Hindi" works), indexed with a
+tsvector and a GIN index. The 'simple' configuration is used because
+Postgres has no Hindi stemmer. search_papers() does the filtering:
+
+    alter table papers add column search_text text;
+    alter table papers add column search_tsv tsvector generated always as (
+        to_tsvector('simple', coalesce(subject, '') || ' ' || coalesce(board, '') || ' ' || coalesce(search_text, ''))) stored;
+    create index papers_search_tsv on papers using gin (search_tsv);
+    create function search_papers(p_username text, p_query text, p_board text default null,
+                                  p_date_from text default null, p_date_to text default null, p_limit int default 50)
+    returns table (id bigint, subject text, board text, date text, snippet text)
+    language sql stable as $$
+        select id, subject, board, date::text,
+               case when coalesce(p_query, '') = '' then left(search_text, 160)
+                    else ts_headline('simple', search_text, websearch_to_tsquery('simple', p_query),
+                                     'StartSel=**, StopSel=**, MaxFragments=2, MinWords=6, MaxWords=18') end
+        from papers
+        where username = p_username
+          and (coalesce(p_query, '') = '' or search_tsv @@ websearch_to_tsquery('simple', p_query))
+          and (p_board is null or board = p_board)
+          and (p_date_from is null or date::text >= p_date_from)
+          and (p_date_to is null or date::text <= p_date_to)
+        order by case when coalesce(p_query, '') = '' then 0
+                      else ts_rank(search_tsv, websearch_to_tsquery('simple', p_query)) end desc, id desc
+        limit p_limit;
+    $$;
+
+Rows saved before search_text existed match on subject and board only
+until they are saved again. SQLiteHistoryIndex is an FTS5 stand-in with
+the same search() for running without Postgres; backfill() fills it from
+the papers table the first time it starts out empty.
+"""
+import re
+import zlib
+import json
+import base64
+import sqlite3
+import difflib
+import hashlib
+from datetime import datetime, timezone
+
+from engine import paper_language
+
+COMPRESS_MIN_CHARS = 1024
+COMPRESSED_PREFIX = "zlib:"
+PAPER_CONFLICT_COLUMNS = "username,content_hash"
+REVISION_CONFLICT_COLUMNS = "paper_id,rev"
+BLOCK_SEPARATOR = "\n\n"
+HISTORY_COLUMNS = "id, date, subject, board, content, rev"
+SEARCH_LIMIT = 50
+SNIPPET_CHARS = 160
+BACKFILL_PAGE_ROWS = 500
+
+def content_hash(content):
+    """sha256 of the paper text, ignoring line-ending and edge whitespace."""
+    normalized = content.replace("\r\n", "\n").strip()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+def pack_content(content):
+    """The value to store in papers.content: compressed when that is smaller."""
+    if len(content) < COMPRESS_MIN_CHARS:
+        return content
+    packed = COMPRESSED_PREFIX + base64.b64encode(zlib.compress(content.encode("utf-8"), 9)).decode("ascii")
+    return packed if len(packed) < len(content.encode("utf-8")) else content
+
+def unpack_content(stored):
+    if stored and stored.startswith(COMPRESSED_PREFIX):
+        return zlib.decompress(base64.b64decode(stored[len(COMPRESSED_PREFIX):])).decode("utf-8")
+    return stored
+
+def search_text(content):
+    """The paper's plain words for the search index, led by its language."""
+    words = re.sub(r'\s+', ' ', re.sub(r'[*#_`|>\[\]]+', ' ', content)).strip()
+    return ("Hindi " if paper_language(content) == "hi" else "English ") + words
+
+def paper_row(username, date, subject, board, content):
+    """A papers row ready for upsert(on_conflict=PAPER_CONFLICT_COLUMNS)."""
+    return {"username": username, "date": date, "subject": subject, "board": board,
+            "content": pack_content(content), "content_hash": content_hash(content),
+            "search_text": search_text(content)}
+
+def unpack_papers(rows):
+    """History rows with their content decompressed, ready to render."""
+    return [dict(row, content=unpack_content(row.get("content"))) for row in rows]
+
+# ==========================================
+# --- REVISIONS ---
+# ==========================================
+def block_delta(src, dst):
+    """Ops that turn paper text src into dst, block by block: ["=", n]
+    keeps the next n blocks, ["-", n] drops them, ["+", [blocks]] inserts."""
+    a, b = src.split(BLOCK_SEPARATOR), dst.split(BLOCK_SEPARATOR)
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == "equal":
+            ops.append(["=", i2 - i1])
+            continue
+        if i2 > i1:
+            ops.append(["-", i2 - i1])
+        if j2 > j1:
+            ops.append(["+", b[j1:j2]])
+    return ops
+
+def apply_delta(src, ops):
+    blocks, out, pos = src.split(BLOCK_SEPARATOR), [], 0
+    for op, arg in ops:
+        if op == "=":
+            out.extend(blocks[pos:pos + arg])
+            pos += arg
+        elif op == "-":
+            pos += arg
+        else:
+            out.extend(arg)
+    return BLOCK_SEPARATOR.join(out)
+
+def revision_row(paper_id, username, rev, head_content, old_content):
+    """The paper_revisions row that keeps revision rev (old_content) once
+    head_content replaces it as the paper's head."""
+    delta = json.dumps(block_delta(head_content, old_content), ensure_ascii=False, separators=(",", ":"))
+    return {"paper_id": paper_id, "username": username, "rev": rev,
+            "created_at": datetime.now(timezone.utc).isoformat(), "delta": pack_content(delta)}
+
+def rebuild_revisions(head_content, revision_rows):
+    """[(rev, created_at, content)] for every stored revision, newest first,
+    rebuilt from the head by applying each delta in turn."""
+    content, revisions = head_content, []
+    for row in sorted(revision_rows, key=lambda r: r["rev"], reverse=True):
+        content = apply_delta(content, json.loads(unpack_content(row["delta"])))
+        revisions.append((row["rev"], row.get("created_at"), content))
+    return revisions
+
+# ==========================================
+# --- SAVING ---
+# ==========================================
+def save_paper_to(client, username, date, subject, board, content, paper_id=None):
+    """Saves a paper to Cloud History through a supabase client. Returns
+    (paper id, the row written, or None when nothing changed); raises on
+    failure.
+
+    With paper_id (the paper this tab saved earlier) the save becomes that
+    paper's next revision, unless the new text is already another of the
+    user's papers: (username, content_hash) is unique, so that paper is
+    updated instead and its id returned. Otherwise saving an identical
+    paper again just updates that row's date and title."""
+    row = paper_row(username, date, subject, board, content)
+    if paper_id is not None:
+        head = client.table("papers").select("id, content, rev").eq("id", paper_id).eq("username", username).execute().data
+        if head:
+            old_content = unpack_content(head[0]["content"])
+            if content_hash(old_content) == row["content_hash"]:
+                return paper_id, None
+            twin = client.table("papers").select("id").eq("username", username).eq("content_hash", row["content_hash"]).execute().data
+            if not twin:
+                rev = head[0].get("rev") or 0
+                # The old head goes into paper_revisions first, so a failed
+                # update never loses it; retrying overwrites the same rev.
+                client.table("paper_revisions").upsert(
+                    revision_row(paper_id, username, rev, content, old_content), on_conflict=REVISION_CONFLICT_COLUMNS).execute()
+                client.table("papers").update(dict(row, rev=rev + 1)).eq("id", paper_id).eq("username", username).execute()
+                return paper_id, row
+    res = client.table("papers").upsert(row, on_conflict=PAPER_CONFLICT_COLUMNS).execute()
+    return (res.data[0]["id"], row) if res.data else (None, None)
+
+# ==========================================
+# --- SEARCH ---
+# ==========================================
+class SupabaseHistoryIndex:
+    """Search through the search_papers() function; the index itself is
+    the papers row, so add() and remove() have nothing to do."""
+    def __init__(self, client):
+        self.client = client
+
+    def add(self, paper_id, row):
+        pass
+
+    def remove(self, paper_id, username):
+        pass
+
+    def search(self, username, query, board=None, date_from=None, date_to=None, limit=SEARCH_LIMIT):
+        """[{"id", "subject", "board", "date", "snippet"}], best match first."""
+        params = {"p_username": username, "p_query": query, "p_board": board,
+                  "p_date_from": date_from, "p_date_to": date_to, "p_limit": limit}
+        return self.client.rpc("search_papers", params).execute().data or []
+
+class SQLiteHistoryIndex:
+    """FTS5 stand-in for search_papers(). The app keeps it in step with
+    Cloud History through add() and remove()."""
+    # unicode61 splits Devanagari words at vowel signs unless marks (M*) count as letters.
+    TOKENIZER = "unicode61 remove_diacritics 0 categories 'L* N* Co M*'"
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(f"""CREATE VIRTUAL TABLE IF NOT EXISTS papers_fts USING fts5(
+                paper_id UNINDEXED, username UNINDEXED, date UNINDEXED, subject, board, body,
+                tokenize="{self.TOKENIZER}")""")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def add(self, paper_id, row):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM papers_fts WHERE paper_id = ?", (paper_id,))
+            conn.execute("INSERT INTO papers_fts (paper_id, username, date, subject, board, body) VALUES (?, ?, ?, ?, ?, ?)",
+                         (paper_id, row["username"], row["date"], row["subject"], row["board"], row["search_text"]))
+
+    def remove(self, paper_id, username):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM papers_fts WHERE paper_id = ? AND username = ?", (paper_id, username))
+
+    def backfill(self, client, page_rows=BACKFILL_PAGE_ROWS):
+        """Indexes every paper already in the papers table, if the index is
+        still empty. Returns how many were added. All pages are read before
+        anything is written, so a failed read leaves it empty to retry."""
+        with self._connect() as conn:
+            if conn.execute("SELECT 1 FROM papers_fts LIMIT 1").fetchone():
+                return 0
+        rows, start = [], 0
+        while True:
+            page = client.table("papers").select("id, username, date, subject, board, content").order("id").range(
+                start, start + page_rows - 1).execute().data or []
+            rows.extend(page)
+            if len(page) < page_rows:
+                break
+            start += page_rows
+        with self._connect() as conn:
+            conn.executemany("INSERT INTO papers_fts (paper_id, username, date, subject, board, body) VALUES (?, ?, ?, ?, ?, ?)",
+                             [(r["id"], r["username"], r["date"], r["subject"], r["board"], search_text(unpack_content(r["content"]) or ""))
+                              for r in rows])
+        return len(rows)
+
+    def search(self, username, query, board=None, date_from=None, date_to=None, limit=SEARCH_LIMIT):
+        where, params = ["username = ?"], [username]
+        for clause, value in (("board = ?", board), ("date >= ?", date_from), ("date <= ?", date_to)):
+            if value:
+                where.append(clause)
+                params.append(value)
+        # Every word must match; quoting keeps FTS5 syntax out of user input.
+        match = " ".join('"' + word.replace('"', '""') + '"' for word in (query or "").split())
+        if match:
+            sql = (f"SELECT paper_id AS id, subject, board, date, snippet(papers_fts, -1, '**', '**', '…', 16) AS snippet "
+                   f"FROM papers_fts WHERE papers_fts MATCH ? AND {' AND '.join(where)} ORDER BY rank LIMIT ?")
+            params = [match] + params + [limit]
+        else:
+            sql = (f"SELECT paper_id AS id, subject, board, date, substr(body, 1, {SNIPPET_CHARS}) AS snippet "
+                   f"FROM papers_fts WHERE {' AND '.join(where)} ORDER BY paper_id DESC LIMIT ?")
+            params = params + [limit]
+        with self._connect() as conn:
+            return [dict(r) for r in conn.execute(sql, params)]
@@ -0,0 +1,245 @@
+"""End-to-end throughput harness against the mock Gemini server.
+
+Each simulated session does what a teacher's reruns do in app.py:
+
+    generate   build the prompt, call generate_gemini_content, split blocks,
+               and render the downloads on the rerun that shows the paper
+    edit       change --edits blocks in the editor form (no rerun while
+               typing), then one 'Apply Edits' rerun that re-renders HTML +
+               Word + PDF once
+    export     the download rerun, which reuses those renders (the tab only
+               re-exports when the paper or a header setting changes)
+    save       build the Cloud History row (content hash + compression) and
+               serialize it the way the Supabase client does (no database
+               is touched)
+
+Sessions run on threads, like Streamlit sessions share one server process.
+Reports p50/p95 per stage and per session, plus sessions per minute per core:
+
+    python load_test.py --sessions 40 --concurrency 8 --edits 3 --latency 1.0 --error-rate 0.05
+
+--app drives app.py itself through Streamlit's AppTest instead: it logs in,
+generates a paper, then times in-tab interactions with each one rerunning
+the whole script ("full", as before the tabs were fragments) and only the
+tab's fragment ("fragment", as the browser does now). Script time and
+Supabase calls per rerun come from metrics.py:
+
+    python load_test.py --app --edits 15
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import metrics
+import engine
+from engine import (build_question_prompt, build_paper_prompt, split_blocks, generate_gemini_content,
+                    create_a4_html, create_word_docx, html_to_pdf)
+from history import paper_row
+from mock_gemini import MockConfig, start_mock_server
+
+STAGES = ["generate", "edit", "export", "save"]
+APP_SCOPES = ["full", "fragment"]
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def render_downloads(paper_md, two_col, cache):
+    """Like app.render_downloads(): renders only when the paper differs from
+    the one last rendered for this session."""
+    sig = hashlib.sha1(repr((paper_md, two_col)).encode()).hexdigest()
+    if cache.get("sig") == sig:
+        return
+    header = ("My Success Academy", "NH-22 Education Lane, City", "+91 9310038172", "Mr. Suraj", None, two_col,
+              "Mathematics", "Class 10", "40", "2 Hours", "Trigonometry")
+    html = create_a4_html(paper_md, *header)
+    create_word_docx(paper_md, *header)
+    html_to_pdf(html)
+    cache["sig"] = sig
+
+def run_session(n, args, timings, lock):
+    stage_times, exports = {}, {}
+    session_start = time.perf_counter()
+    try:
+        t0 = time.perf_counter()
+        q_reqs = build_question_prompt(args.questions, "Easy", 1, 0, "Easy", 1, 0, "Easy", 1, 0, "Medium", 2, 0, "Hard", 5,
+                                       True, "English", "Mathematics")
+        prompt = build_paper_prompt(q_reqs, "Mathematics", "Class 10", "Trigonometry")
+        blocks = split_blocks(generate_gemini_content(prompt, "mock-key", "gemini-1.5-flash"))
+        render_downloads("\n\n".join(b['text'] for b in blocks), n % 2 == 0, exports)
+        stage_times["generate"] = time.perf_counter() - t0
+
+        # Typing in the form doesn't rerun; Apply commits every edit at once.
+        t0 = time.perf_counter()
+        for e in range(args.edits):
+            blocks[(e + 1) % len(blocks)]['text'] += " (edited)"
+        render_downloads("\n\n".join(b['text'] for b in blocks), n % 2 == 0, exports)
+        stage_times["edit"] = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        paper_md = "\n\n".join(b['text'] for b in blocks)
+        render_downloads(paper_md, n % 2 == 0, exports)
+        stage_times["export"] = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        row = paper_row(f"load_{n}", datetime.now().strftime("%Y-%m-%d"), "Mathematics", "Standard", paper_md)
+        json.dumps(row).encode("utf-8")
+        stage_times["save"] = time.perf_counter() - t0
+        ok = True
+    except Exception as e:
+        logging.error(f"[Load Test Session {n} Error] {e}")
+        ok = False
+    with lock:
+        for stage, seconds in stage_times.items():
+            timings[stage].append(seconds)
+        if ok:
+            timings["session"].append(time.perf_counter() - session_start)
+        else:
+            timings["failed"] += 1
+
+# ==========================================
+# --- APP MODE (AppTest) ---
+# ==========================================
+def patch_fragment_reruns():
+    """AppTest always reruns the whole script. Returns a one-item list; while
+    it holds a fragment id, AppTest runs are sent scoped to that fragment,
+    as the browser sends a rerun for a widget inside it. Leans on AppTest
+    internals (Streamlit 1.66)."""
+    from streamlit.testing.v1 import local_script_runner
+    from streamlit.runtime.scriptrunner_utils.script_requests import RerunData, ScriptRequests
+    fragment = [None]
+    full_run = local_script_runner.LocalScriptRunner.run
+
+    def run(self, widget_state=None, query_params=None, timeout=3, page_hash=""):
+        if fragment[0] is None:
+            return full_run(self, widget_state, query_params, timeout, page_hash)
+        # The runner is built with a full rerun already queued; replace it.
+        self._requests = ScriptRequests()
+        self.request_rerun(RerunData(widget_states=widget_state, page_script_hash=page_hash, fragment_id_queue=[fragment[0]]))
+        try:
+            if not self._script_thread:
+                self.start()
+            local_script_runner.require_widgets_deltas(self, timeout)
+        finally:
+            self.join()
+        return local_script_runner.parse_tree_from_messages(self.forward_msgs())
+
+    local_script_runner.LocalScriptRunner.run = run
+    return fragment
+
+def fragment_id(at, tab_fn_name):
+    for fid, frag in at._fragment_storage._fragments.items():
+        for cell in frag.__closure__ or ():
+            if getattr(getattr(cell.cell_contents, "__wrapped__", None), "__name__", "") == tab_fn_name:
+                return fid
+    raise RuntimeError(f"No fragment runs {tab_fn_name}().")
+
+def rerun_totals():
+    """{scope: (reruns, script seconds, supabase calls)} so far in this process."""
+    return {scope: (s["total_ms"]["count"], s["total_ms"]["sum"] / 1000, s["calls_per_rerun"]["supabase"]["sum"])
+            for scope, s in metrics.snapshot()["reruns"].items()}
+
+def run_app_benchmark(args, workdir):
+    from streamlit.testing.v1 import AppTest
+    fragment = patch_fragment_reruns()
+    at = AppTest.from_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py"), default_timeout=120)
+    at.secrets.update({"GEMINI_API_KEY": "mock-key", "SUPABASE_URL": "http://127.0.0.1:9", "SUPABASE_KEY": "x" * 40,
+                       "RAZORPAY_KEY_ID": "mock", "RAZORPAY_KEY_SECRET": "mock",
+                       "USAGE_DB_PATH": os.path.join(workdir, "usage.db"),
+                       "MODEL_REGISTRY_PATH": os.path.join(workdir, "models.json"),
+                       "QUESTION_BANK_DB": os.path.join(workdir, "bank.db")})
+    at.session_state["logged_in"] = True
+    at.session_state["username"] = "load_test"
+    at.run()
+    next(t for t in at.text_input if t.label == "Subject").set_value("Mathematics")
+    next(t for t in at.text_input if t.label == "Class").set_value("10")
+    at.run()
+    next(b for b in at.button if b.label == "🚀 Generate Paper").click().run()
+    blocks = at.session_state["blocks"]
+    if at.exception or not blocks:
+        raise RuntimeError(f"Couldn't generate a paper in the app: {at.exception}")
+
+    def apply_edit(i):
+        # Typing stays in the browser until the form is submitted.
+        at.text_area(key=f"block_text_{blocks[1]['id']}").set_value(f"{blocks[1]['text']} (edit {i})")
+        next(b for b in at.button if b.label == "💾 Apply Edits").click().run()
+
+    interactions = [
+        ("create: apply an edit", "render_create_tab", apply_edit),
+        ("bseb: type extra topics", "render_bseb_tab",
+         lambda i: at.text_area(key="bseb_extra_topics").set_value("topic " * (i + 1)).run()),
+    ]
+    print(f"{'interaction':<26} {'scope':<9} {'p50 ms':>9} {'p95 ms':>9} {'script ms':>10} {'supabase':>9} {'n':>4}")
+    for label, tab_fn, interact in interactions:
+        for scope in APP_SCOPES:
+            at.run()  # after a fragment rerun the element tree only holds that fragment
+            before, times = rerun_totals(), []
+            for i in range(args.edits):
+                fragment[0] = fragment_id(at, tab_fn) if scope == "fragment" else None
+                t0 = time.perf_counter()
+                try:
+                    interact(i)
+                finally:
+                    fragment[0] = None
+                times.append(time.perf_counter() - t0)
+                if at.exception:
+                    raise RuntimeError(f"{label} failed: {at.exception}")
+            after = rerun_totals()
+            reruns, script, supabase = (sum(after[s][k] - before.get(s, (0, 0, 0))[k] for s in after) for k in range(3))
+            print(f"{label:<26} {scope:<9} {percentile(times, 50) * 1000:>9.1f} {percentile(times, 95) * 1000:>9.1f} "
+                  f"{script / max(reruns, 1) * 1000:>10.1f} {supabase / max(reruns, 1):>9.1f} {len(times):>4}")
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test generate/edit/export/save against the mock Gemini server.")
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--edits", type=int, default=2, help="Blocks edited per session (--app: interactions timed)")
+    parser.add_argument("--questions", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.5, help="Mock Gemini mean latency (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of mock calls that return 429")
+    parser.add_argument("--base-url", help="Use an already running mock (e.g. http://127.0.0.1:8777/v1beta)")
+    parser.add_argument("--app", action="store_true", help="Time in-app reruns (full vs fragment) through AppTest")
+    args = parser.parse_args(argv)
+
+    logging.getLogger("xhtml2pdf").setLevel(logging.ERROR)
+    if args.base_url:
+        engine.GEMINI_API_BASE = args.base_url
+    else:
+        _, engine.GEMINI_API_BASE, _ = start_mock_server(config=MockConfig(latency=args.latency, error_rate=args.error_rate))
+    if args.app:
+        logging.disable(logging.CRITICAL)  # Supabase isn't reachable here; its calls fail fast and log
+        with tempfile.TemporaryDirectory() as workdir:
+            return run_app_benchmark(args, workdir)
+
+    timings = {stage: [] for stage in STAGES + ["session"]}
+    timings["failed"] = 0
+    lock = threading.Lock()
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for n in range(args.sessions):
+            pool.submit(run_session, n, args, timings, lock)
+    wall = time.perf_counter() - wall_start
+
+    print(f"{'stage':<10} {'p50 ms':>10} {'p95 ms':>10} {'n':>5}")
+    for stage in STAGES + ["session"]:
+        values = timings[stage]
+        print(f"{stage:<10} {percentile(values, 50) * 1000:>10.1f} {percentile(values, 95) * 1000:>10.1f} {len(values):>5}")
+    done = len(timings["session"])
+    cores = os.cpu_count() or 1
+    print(f"\n{done} session(s) ok, {timings['failed']} failed in {wall:.1f}s "
+          f"-> {done / wall * 60:.1f} sessions/min, {done / wall * 60 / cores:.1f} sessions/min/core ({cores} cores)")
+    return 0 if done else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
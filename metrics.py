@@ -0,0 +1,170 @@
+"""Lightweight in-process latency metrics.
+
+Wrap a stage with `timed("supabase.get_user_data")` (context manager) or
+`@traced("render.docx")` (decorator). Each stage name feeds a histogram, and
+the part before the first dot ("supabase", "gemini", "render", ...) is
+counted against the current Streamlit rerun, so per-rerun totals show how
+many Supabase and Gemini round trips an interaction cost. Reruns are kept
+per scope ("app" for a full script run, "fragment:<name>" for an
+st.fragment rerun) so the two can be compared directly.
+
+Everything is aggregated in this process and exposed as a JSON snapshot or
+Prometheus text (see prometheus_text() and start_metrics_server()).
+"""
+import json
+import time
+import threading
+import functools
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, float("inf"))
+RERUN_CALL_KINDS = ("supabase", "gemini")
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Upper bucket bound containing the q-th observation (like histogram_quantile, without interpolation)."""
+        if not self.count:
+            return 0.0
+        target, seen = q * self.count, 0
+        for bound, c in zip(self.buckets, self.counts):
+            seen += c
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+_lock = threading.Lock()
+_stages = defaultdict(Histogram)
+_reruns = defaultdict(lambda: {"total": Histogram(), **{kind: Histogram(COUNT_BUCKETS) for kind in RERUN_CALL_KINDS}})
+_local = threading.local()
+
+def observe(name, seconds):
+    with _lock:
+        _stages[name].observe(seconds)
+    rerun = getattr(_local, "rerun", None)
+    if rerun is not None:
+        rerun["calls"][name.split(".", 1)[0]] += 1
+
+@contextmanager
+def timed(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+def traced(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def begin_rerun(scope="app"):
+    _local.rerun = {"scope": scope, "start": time.perf_counter(), "calls": defaultdict(int)}
+
+def current_rerun_scope():
+    """Scope of the rerun in progress on this thread, or None."""
+    rerun = getattr(_local, "rerun", None)
+    return rerun["scope"] if rerun else None
+
+def end_rerun():
+    """Closes the current rerun. Safe to call more than once per rerun."""
+    rerun = getattr(_local, "rerun", None)
+    if rerun is None:
+        return
+    _local.rerun = None
+    with _lock:
+        hists = _reruns[rerun["scope"]]
+        hists["total"].observe(time.perf_counter() - rerun["start"])
+        for kind in RERUN_CALL_KINDS:
+            hists[kind].observe(rerun["calls"][kind])
+
+def snapshot():
+    def summary(h, scale=1000.0):
+        return {"count": h.count, "sum": round(h.sum * scale, 2), "avg": round(h.sum / h.count * scale, 2) if h.count else 0.0,
+                "p50": round(h.quantile(0.5) * scale, 2), "p95": round(h.quantile(0.95) * scale, 2), "max": round(h.max * scale, 2)}
+    with _lock:
+        return {
+            "stages_ms": {name: summary(h) for name, h in sorted(_stages.items())},
+            "reruns": {scope: {
+                "total_ms": summary(hists["total"]),
+                "calls_per_rerun": {kind: summary(hists[kind], scale=1.0) for kind in RERUN_CALL_KINDS},
+            } for scope, hists in sorted(_reruns.items())},
+        }
+
+def _histogram_lines(metric, labels, h):
+    label_str = ",".join(f'{k}="{v}"' for k, v in labels.items())
+    sep = "," if label_str else ""
+    lines, cumulative = [], 0
+    for bound, c in zip(h.buckets, h.counts):
+        cumulative += c
+        le = "+Inf" if bound == float("inf") else repr(bound)
+        lines.append(f'{metric}_bucket{{{label_str}{sep}le="{le}"}} {cumulative}')
+    wrapped = f"{{{label_str}}}" if label_str else ""
+    lines.append(f"{metric}_sum{wrapped} {h.sum}")
+    lines.append(f"{metric}_count{wrapped} {h.count}")
+    return lines
+
+def prometheus_text():
+    with _lock:
+        lines = ["# HELP paperbanao_stage_seconds Latency of instrumented stages (Supabase helpers, Gemini calls, renderers).",
+                 "# TYPE paperbanao_stage_seconds histogram"]
+        for name, h in sorted(_stages.items()):
+            lines += _histogram_lines("paperbanao_stage_seconds", {"stage": name}, h)
+        lines += ["# HELP paperbanao_rerun_seconds Total script time per Streamlit rerun.",
+                  "# TYPE paperbanao_rerun_seconds histogram"]
+        for scope, hists in sorted(_reruns.items()):
+            lines += _histogram_lines("paperbanao_rerun_seconds", {"scope": scope}, hists["total"])
+        lines += ["# HELP paperbanao_rerun_calls Supabase / Gemini calls made per rerun.",
+                  "# TYPE paperbanao_rerun_calls histogram"]
+        for scope, hists in sorted(_reruns.items()):
+            for kind in RERUN_CALL_KINDS:
+                lines += _histogram_lines("paperbanao_rerun_calls", {"scope": scope, "kind": kind}, hists[kind])
+    return "\n".join(lines) + "\n"
+
+def start_metrics_server(port, host="0.0.0.0"):
+    """Serves GET /metrics (Prometheus text) and /metrics.json from a daemon thread."""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body, ctype = prometheus_text().encode(), "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body, ctype = json.dumps(snapshot()).encode(), "application/json"
+            else:
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
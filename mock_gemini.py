@@ -0,0 +1,234 @@
+"""Local stand-in for the Gemini REST endpoints PaperBanao uses.
+
+Serves the models list, generateContent and streamGenerateContent with
+canned `|||`-delimited papers (or JSON when a responseSchema is sent),
+cachedContents (create, extend, delete; generate calls that reference an
+expired or unknown cache get a 404), configurable latency and injected
+429s, so the app, paper_cli.py and load_test.py can run without burning
+real quota:
+
+    python mock_gemini.py --port 8777 --latency 1.5 --error-rate 0.05
+    GEMINI_API_BASE=http://127.0.0.1:8777/v1beta streamlit run app.py
+"""
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fixtures import make_fixture_response, QUESTION_TEXT
+
+MOCK_MODELS = ["gemini-1.5-flash", "gemini-1.5-pro", "gemini-2.0-flash"]
+GENERATE_PATH_RE = re.compile(r'^/v1beta/models/([^/:]+):(generateContent|streamGenerateContent)$')
+CACHE_PATH_RE = re.compile(r'^/v1beta/(cachedContents(?:/[^/]+)?)$')
+
+class MockConfig:
+    def __init__(self, latency=0.5, jitter=0.2, error_rate=0.0, questions=20, language="English", malformed=0.0):
+        self.latency = latency
+        self.malformed = malformed
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.questions = questions
+        self.language = language
+        self.lock = threading.Lock()
+        self.calls = {"models": 0, "generateContent": 0, "streamGenerateContent": 0, "429": 0, "cachedContents": 0}
+        self.caches = {}         # name -> {"text", "model", "expires_at"}
+
+    def count(self, key):
+        with self.lock:
+            self.calls[key] += 1
+
+def canned_text(prompt, config, images=0):
+    if "@@@PAGE@@@" in prompt:
+        # Scanned-page transcription: one page of book text per image.
+        return "".join(f"Transcribed page {n + 1}: the sine of an angle is opposite over hypotenuse.\n@@@PAGE@@@\n" for n in range(images))
+    if "@@@ANSWER@@@" in prompt:
+        return "**Q3.** Which of these is a prime number?\n(A) 21   (B) 27   (C) 29   (D) 33\n@@@ANSWER@@@\n(C) 29"
+    # Honour the question counts build_question_prompt asked for.
+    counts = [int(c) for c in re.findall(r'^- (\d+) (?:MCQs|FIBs|True/False|Short Qs|Long Qs)', prompt, re.MULTILINE)]
+    return make_fixture_response(config.language, sum(counts) or config.questions, "ANSWER KEY" in prompt)
+
+PROMPT_KIND_RE = re.compile(r'^- (\d+) (MCQs|FIBs|True/False|Short Qs|Long Qs)', re.MULTILINE)
+PROMPT_KINDS = {"MCQs": "mcq", "FIBs": "fib", "True/False": "tf", "Short Qs": "short", "Long Qs": "long"}
+
+def canned_question(kind, n, config, malformed=0.0):
+    stem, options = QUESTION_TEXT[config.language][(n - 1) % len(QUESTION_TEXT[config.language])]
+    if kind == "tf":
+        options = ["True", "False"]
+    elif kind in ("short", "long"):
+        options = []
+    elif not options:
+        options = ["1", "2", "3", "4"]
+    if options and random.random() < malformed:
+        options = options[:-1]  # wrong option count, so the app has to repair it
+    return {"text": stem, "options": options, "marks": 1, "answer": f"(A) {options[0]}" if options else "Step 1: ... Step 2: ... hence proved."}
+
+def canned_json(prompt, config, schema):
+    """JSON-mode reply: a repair array (one item per ITEMS entry) or a paper."""
+    if schema.get("type") == "ARRAY":
+        items = json.loads(prompt.split("ITEMS:", 1)[1]) if "ITEMS:" in prompt else []
+        return json.dumps([canned_question(item.get("kind", "mcq"), i + 1, config) for i, item in enumerate(items)], ensure_ascii=False)
+    sections, n = [], 0
+    for count, label in PROMPT_KIND_RE.findall(prompt) or [(str(config.questions), "MCQs")]:
+        questions = []
+        for _ in range(int(count)):
+            n += 1
+            questions.append(canned_question(PROMPT_KINDS[label], n, config, config.malformed))
+        sections.append({"kind": PROMPT_KINDS[label], "marks_each": 1, "questions": questions})
+    return json.dumps({"sections": sections}, ensure_ascii=False)
+
+def ttl_seconds(ttl):
+    return float(str(ttl or "3600s").rstrip("s"))
+
+def usage_metadata(prompt, text, cached=""):
+    # Roughly 4 characters per token, close enough for accounting tests.
+    # As in the real API, promptTokenCount includes the cached tokens.
+    cached_tokens = len(cached) // 4 + 1 if cached else 0
+    prompt_tokens, output_tokens = len(prompt) // 4 + 1 + cached_tokens, len(text) // 4 + 1
+    meta = {"promptTokenCount": prompt_tokens, "candidatesTokenCount": output_tokens, "totalTokenCount": prompt_tokens + output_tokens}
+    if cached_tokens:
+        meta["cachedContentTokenCount"] = cached_tokens
+    return meta
+
+def make_handler(config):
+    class MockGeminiHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/v1beta/models":
+                self.send_json(404, {"error": {"code": 404, "message": "Not found"}})
+                return
+            config.count("models")
+            self.send_json(200, {"models": [
+                {"name": f"models/{m}", "supportedGenerationMethods": ["generateContent", "countTokens"]} for m in MOCK_MODELS
+            ]})
+
+        def live_cache(self, name):
+            with config.lock:
+                cache = config.caches.get(name)
+                if cache and cache["expires_at"] <= time.time():
+                    del config.caches[name]
+                    cache = None
+            return cache
+
+        def handle_cache(self, method, name):
+            config.count("cachedContents")
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}") if method != "DELETE" else {}
+            if method == "POST" and name == "cachedContents":
+                text = "".join(p.get("text", "") for c in body.get("contents", []) for p in c.get("parts", []))
+                with config.lock:
+                    name = f"cachedContents/mock{len(config.caches) + 1}-{random.randrange(1 << 30):x}"
+                    config.caches[name] = {"text": text, "model": body.get("model", ""),
+                                           "expires_at": time.time() + ttl_seconds(body.get("ttl"))}
+                self.send_json(200, {"name": name, "model": body.get("model", ""), "usageMetadata": {"totalTokenCount": len(text) // 4 + 1}})
+                return
+            cache = self.live_cache(name)
+            if cache is None:
+                self.send_json(404, {"error": {"code": 404, "message": "CachedContent not found (or permission denied)", "status": "NOT_FOUND"}})
+            elif method == "PATCH":
+                cache["expires_at"] = time.time() + ttl_seconds(body.get("ttl"))
+                self.send_json(200, {"name": name, "model": cache["model"]})
+            else:
+                with config.lock:
+                    config.caches.pop(name, None)
+                self.send_json(200, {})
+
+        def do_PATCH(self):
+            m = CACHE_PATH_RE.match(self.path.split("?")[0])
+            if m:
+                self.handle_cache("PATCH", m.group(1))
+            else:
+                self.send_json(404, {"error": {"code": 404, "message": "Not found"}})
+
+        def do_DELETE(self):
+            m = CACHE_PATH_RE.match(self.path.split("?")[0])
+            if m:
+                self.handle_cache("DELETE", m.group(1))
+            else:
+                self.send_json(404, {"error": {"code": 404, "message": "Not found"}})
+
+        def do_POST(self):
+            cm = CACHE_PATH_RE.match(self.path.split("?")[0])
+            if cm:
+                self.handle_cache("POST", cm.group(1))
+                return
+            m = GENERATE_PATH_RE.match(self.path.split("?")[0])
+            if not m:
+                self.send_json(404, {"error": {"code": 404, "message": "Not found"}})
+                return
+            method = m.group(2)
+            config.count(method)
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            time.sleep(max(0.0, random.gauss(config.latency, config.jitter)))
+            if random.random() < config.error_rate:
+                config.count("429")
+                self.send_json(429, {"error": {"code": 429, "message": "Resource has been exhausted (e.g. check quota).", "status": "RESOURCE_EXHAUSTED"}})
+                return
+
+            parts = body.get("contents", [{}])[0].get("parts", [])
+            prompt = "".join(p.get("text", "") for p in parts)
+            cached = ""
+            if body.get("cachedContent"):
+                cache = self.live_cache(body["cachedContent"])
+                if cache is None or cache["model"] != f"models/{m.group(1)}":
+                    self.send_json(404, {"error": {"code": 404, "message": "CachedContent not found (or permission denied)", "status": "NOT_FOUND"}})
+                    return
+                cached = cache["text"]
+            schema = body.get("generationConfig", {}).get("responseSchema")
+            images = sum(1 for p in parts if "inline_data" in p)
+            text = canned_json(prompt, config, schema) if schema else canned_text(prompt, config, images)
+            candidate = {"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP"}
+            if method == "generateContent":
+                self.send_json(200, {"candidates": [candidate], "usageMetadata": usage_metadata(prompt, text, cached), "modelVersion": m.group(1)})
+            else:
+                # Without alt=sse the REST API returns the whole stream as one JSON array.
+                pieces = [text[i:i + 400] for i in range(0, len(text), 400)]
+                chunks = [{"candidates": [{"content": {"parts": [{"text": p}], "role": "model"}}]} for p in pieces]
+                chunks[-1]["usageMetadata"] = usage_metadata(prompt, text, cached)
+                self.send_json(200, chunks)
+
+        def log_message(self, fmt, *args):
+            pass
+
+    return MockGeminiHandler
+
+def start_mock_server(port=0, config=None):
+    """Starts the mock in a daemon thread. Returns (server, base_url, config);
+    pass base_url as GEMINI_API_BASE. port=0 picks a free port."""
+    config = config or MockConfig()
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(config))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1beta", config
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local stand-in for the Gemini API.")
+    parser.add_argument("--port", type=int, default=8777)
+    parser.add_argument("--latency", type=float, default=0.5, help="Mean response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Std-dev of the latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of generate calls answered with 429")
+    parser.add_argument("--questions", type=int, default=20, help="Questions per canned paper when the prompt doesn't say")
+    parser.add_argument("--language", choices=["English", "Hindi", "Bilingual"], default="English")
+    parser.add_argument("--malformed", type=float, default=0.0, help="Fraction of JSON-mode questions sent back with a wrong option count")
+    args = parser.parse_args(argv)
+
+    config = MockConfig(args.latency, args.jitter, args.error_rate, args.questions, args.language, args.malformed)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(config))
+    print(f"Mock Gemini on http://127.0.0.1:{args.port}/v1beta  (set GEMINI_API_BASE to this)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"Calls: {config.calls}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
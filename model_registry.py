@@ -0,0 +1,210 @@
+"""Persisted Gemini model registry.
+
+Remembers which models each API key can use (keys are stored only as a
+short hash) and how every model has behaved: moving averages of call
+latency and of latency per output token, and recent errors, per model and
+key. pick() answers from that memory straight away, so a cold start or a
+brand-new user key never waits on the models listing; a stale or missing
+listing is refreshed on a background thread and the next pick() sees it.
+
+Models are ranked by latency per output token, since a long paper and a
+one-question regeneration take very different times on the same model.
+About one pick in 1/explore_rate tries a model that hasn't been measured
+(or not within STALE_AFTER) instead, so a new or recovered model can win
+without waiting for the favourite to fail.
+
+The registry is a JSON file (PAPERBANAO_MODEL_REGISTRY, default
+.paperbanao_models.json) rewritten at most every SAVE_INTERVAL seconds.
+engine.generate_gemini_content() reports every call through
+observe_model_call().
+"""
+import os
+import json
+import time
+import atexit
+import random
+import hashlib
+import logging
+import tempfile
+import threading
+
+DEFAULT_REGISTRY_PATH = os.environ.get("PAPERBANAO_MODEL_REGISTRY", ".paperbanao_models.json")
+LISTING_TTL = 3600.0
+SAVE_INTERVAL = 30.0
+LATENCY_ALPHA = 0.2          # weight of the newest call in the latency average
+UNHEALTHY_ERROR_RATE = 0.5   # recent error share above which a model is skipped
+ERROR_COOLDOWN = 300.0       # ...for this long after its last error
+EXPLORE_RATE = 0.05          # share of picks that try an unmeasured or stale model
+STALE_AFTER = 86400.0        # a model not measured for this long is worth trying again
+# Families that can't write a question paper even though they support generateContent.
+EXCLUDED_MODEL_WORDS = ("tts", "image", "live", "audio", "embedding", "vision")
+
+def key_fingerprint(api_key):
+    return hashlib.sha256(api_key.encode()).hexdigest()[:12]
+
+def legacy_choice(models):
+    """The old rule: first 1.5-flash model, else the first model."""
+    flash = [m for m in models if "1.5-flash" in m]
+    return flash[0] if flash else models[0]
+
+class ModelRegistry:
+    def __init__(self, lister, path=DEFAULT_REGISTRY_PATH, default_model="gemini-1.5-flash", ttl=LISTING_TTL, explore_rate=EXPLORE_RATE):
+        """lister(api_key) -> [model name, ...]; raises on failure."""
+        self.lister = lister
+        self.path = path
+        self.default_model = default_model
+        self.ttl = ttl
+        self.explore_rate = explore_rate
+        self.lock = threading.Lock()
+        self.refreshing = set()
+        self.dirty = False
+        self.last_save = 0.0
+        self.data = {"listings": {}, "stats": {}}
+        try:
+            with open(path, encoding="utf-8") as f:
+                loaded = json.load(f)
+            self.data["listings"].update(loaded.get("listings", {}))
+            self.data["stats"].update(loaded.get("stats", {}))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.error(f"[Model Registry Load Error] {e}")
+        atexit.register(self.save)
+
+    # --- listings ---
+    def _refresh(self, api_key, fp):
+        try:
+            models = self.lister(api_key)
+            if models:
+                with self.lock:
+                    self.data["listings"][fp] = {"models": models, "listed_at": time.time()}
+                    self.dirty = True
+        except Exception as e:
+            logging.error(f"[Model Registry Refresh Error] {e}")
+        finally:
+            with self.lock:
+                self.refreshing.discard(fp)
+        self.save_if_due()
+
+    def refresh_in_background(self, api_key):
+        fp = key_fingerprint(api_key)
+        with self.lock:
+            if fp in self.refreshing:
+                return
+            self.refreshing.add(fp)
+        threading.Thread(target=self._refresh, args=(api_key, fp), daemon=True).start()
+
+    def refresh(self, api_key):
+        """Lists models now (blocking); for headless callers that prefer to wait."""
+        fp = key_fingerprint(api_key)
+        with self.lock:
+            self.refreshing.add(fp)
+        self._refresh(api_key, fp)
+
+    # --- stats ---
+    def observe(self, api_key, model, latency_s, ok, output_tokens=None):
+        """Records one call; output_tokens (from usageMetadata) lets it count
+        towards latency per token."""
+        stat_key = f"{key_fingerprint(api_key)}:{model}"
+        now = time.time()
+        with self.lock:
+            s = self.data["stats"].setdefault(stat_key, {"latency_ms": None, "calls": 0, "errors": 0, "recent_errors": 0.0, "last_error_at": 0.0})
+            s.setdefault("ms_per_token", None)
+            s.setdefault("measured_at", 0.0)
+            s["calls"] += 1
+            # recent_errors is an exponentially decayed error share, so a
+            # model recovers once it starts answering again.
+            s["recent_errors"] = (1 - LATENCY_ALPHA) * s["recent_errors"] + LATENCY_ALPHA * (0.0 if ok else 1.0)
+            if ok:
+                ms = latency_s * 1000
+                s["latency_ms"] = ms if s["latency_ms"] is None else (1 - LATENCY_ALPHA) * s["latency_ms"] + LATENCY_ALPHA * ms
+                if output_tokens:
+                    per_token = ms / output_tokens
+                    s["ms_per_token"] = per_token if s["ms_per_token"] is None else (1 - LATENCY_ALPHA) * s["ms_per_token"] + LATENCY_ALPHA * per_token
+                    s["measured_at"] = now
+            else:
+                s["errors"] += 1
+                s["last_error_at"] = now
+            self.dirty = True
+        self.save_if_due()
+
+    def _healthy(self, s, now):
+        return not (s["recent_errors"] > UNHEALTHY_ERROR_RATE and now - s["last_error_at"] < ERROR_COOLDOWN)
+
+    def usable(self, api_key, model):
+        """Whether an earlier pick can be kept: the model is healthy and, once
+        the key has a listing, in it."""
+        fp = key_fingerprint(api_key)
+        with self.lock:
+            listing = self.data["listings"].get(fp)
+            s = self.data["stats"].get(f"{fp}:{model}")
+        if listing is not None and model not in listing["models"]:
+            return False
+        return s is None or self._healthy(s, time.time())
+
+    # --- choice ---
+    def pick(self, api_key):
+        """Healthy model this key can use with the lowest latency per output
+        token, without network I/O; now and then an unmeasured or stale one
+        instead. Falls back to the legacy choice when nothing has been
+        measured yet."""
+        fp = key_fingerprint(api_key)
+        now = time.time()
+        with self.lock:
+            listing = self.data["listings"].get(fp)
+            stats = dict(self.data["stats"])
+        if listing is None or now - listing["listed_at"] > self.ttl:
+            self.refresh_in_background(api_key)
+        if listing is None:
+            return self.default_model
+        models = listing["models"]
+        candidates = [m for m in models if "flash" in m and not any(w in m for w in EXCLUDED_MODEL_WORDS)] or models
+        healthy = [m for m in candidates if self._healthy(stats.get(f"{fp}:{m}") or {"recent_errors": 0.0, "last_error_at": 0.0}, now)] or candidates
+        measured, unexplored = [], []
+        for m in healthy:
+            s = stats.get(f"{fp}:{m}") or {}
+            if s.get("ms_per_token") is not None and now - s.get("measured_at", 0.0) < STALE_AFTER:
+                measured.append((s["ms_per_token"], m))
+            else:
+                unexplored.append(m)
+        if not measured:
+            return legacy_choice(healthy)
+        if unexplored and random.random() < self.explore_rate:
+            return random.choice(unexplored)
+        return min(measured)[1]
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps(self.data))
+
+    # --- persistence ---
+    def save_if_due(self):
+        if self.dirty and time.time() - self.last_save >= SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            payload = json.dumps(self.data)
+            self.dirty = False
+            self.last_save = time.time()
+        try:
+            # Write-then-rename so a crash never leaves a half-written file.
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(payload)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logging.error(f"[Model Registry Save Error] {e}")
+
+_registry = None
+
+def configure_model_registry(registry):
+    global _registry
+    _registry = registry
+    return registry
+
+def observe_model_call(api_key, model, latency_s, ok, output_tokens=None):
+    if _registry is not None:
+        _registry.observe(api_key, model, latency_s, ok, output_tokens)
@@ -0,0 +1,170 @@
+"""Headless PaperBanao: generate papers from JSON specs without the Streamlit UI.
+
+    # One-off / scheduled bulk run: a spec file holds one spec or a list of them
+    python paper_cli.py generate specs.json --out papers/ --workers 4
+
+    # Small JSON API: POST a spec to /papers, get blocks + base64 files back
+    # (GET /metrics serves stage latencies as Prometheus text)
+    python paper_cli.py serve --port 8600 --workers 4
+
+The API key comes from GEMINI_API_KEY (or --api-key). Set GEMINI_API_BASE to
+point at a local stand-in instead of the real Gemini API. --usage-db (or
+PAPERBANAO_USAGE_DB) records every Gemini call's tokens to a SQLite file.
+
+Specs that share a "pdf_path" upload the book to Gemini's context cache once
+(--context-ttl seconds, 0 to turn it off) instead of sending it per paper.
+
+"structured": true asks Gemini for JSON (see engine.PAPER_RESPONSE_SCHEMA)
+instead of `|||`-delimited text.
+
+Spec example (everything except subject/class is optional):
+    {"subject": "Mathematics", "class": "Class 10", "topics": "Trigonometry",
+     "language": "Hindi", "include_answer_key": true, "two_column": true,
+     "structured": true,
+     "questions": {"mcq": {"count": 10, "marks": 1, "difficulty": "Easy"}},
+     "institute": {"name": "My Success Academy", "teacher": "Mr. Suraj"},
+     "formats": ["HTML", "Word", "PDF"]}
+"""
+import os
+import sys
+import json
+import base64
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from engine import list_generation_models, generate_paper, GeminiCacheClient
+from model_registry import ModelRegistry, configure_model_registry
+from context_cache import ContextCache, configure_context_cache, DEFAULT_TTL
+from metrics import prometheus_text
+from usage import configure_usage, SQLiteUsageSink
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def run_specs(specs, api_key, out_dir, workers, registry):
+    model_name = registry.pick(api_key)
+    os.makedirs(out_dir, exist_ok=True)
+
+    def run_one(idx_spec):
+        idx, spec = idx_spec
+        spec.setdefault("id", str(idx + 1))
+        try:
+            result = generate_paper(spec, api_key, model_name)
+        except Exception as e:
+            logging.error(f"[CLI Generation Error] spec {idx + 1} ({spec.get('subject')}): {e}")
+            return False
+        for name, data in result["files"]:
+            with open(os.path.join(out_dir, name), "wb") as f:
+                f.write(data)
+        for name in result["missing"]:
+            logging.error(f"[CLI Render Error] couldn't render {name}")
+        logging.info(f"Spec {idx + 1}: wrote {len(result['files'])} file(s) for {spec['subject']}")
+        return True
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        ok = list(pool.map(run_one, enumerate(specs)))
+    return ok.count(True), ok.count(False)
+
+def make_handler(api_key, slots, registry):
+
+    class PaperHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self.send_json(200, {"status": "ok"})
+            elif self.path == "/metrics":
+                payload = prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+            else:
+                self.send_json(404, {"error": "Not found"})
+
+        def do_POST(self):
+            if self.path != "/papers":
+                self.send_json(404, {"error": "Not found"})
+                return
+            try:
+                spec = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            except ValueError:
+                self.send_json(400, {"error": "Body must be a JSON paper spec."})
+                return
+            # The semaphore is the worker pool: at most `workers` generations
+            # run at once, the rest wait for a free slot.
+            with slots:
+                try:
+                    result = generate_paper(spec, api_key, registry.pick(api_key))
+                except ValueError as e:
+                    self.send_json(400, {"error": str(e)})
+                    return
+                except Exception as e:
+                    logging.error(f"[API Generation Error] {e}")
+                    self.send_json(502, {"error": str(e)})
+                    return
+            self.send_json(200, {
+                "blocks": result["blocks"],
+                "content": result["content"],
+                "files": {name: base64.b64encode(data).decode() for name, data in result["files"]},
+                "missing": result["missing"],
+            })
+
+        def log_message(self, fmt, *args):
+            logging.info(f"[API] {self.address_string()} {fmt % args}")
+
+    return PaperHandler
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate PaperBanao papers without the Streamlit UI.")
+    parser.add_argument("--api-key", default=os.environ.get("GEMINI_API_KEY", ""), help="Gemini API key (default: $GEMINI_API_KEY)")
+    parser.add_argument("--workers", type=int, default=4, help="Papers generated concurrently")
+    parser.add_argument("--context-ttl", type=float, default=DEFAULT_TTL, help="Seconds a cached book stays on Gemini (0: don't cache)")
+    parser.add_argument("--usage-db", default=os.environ.get("PAPERBANAO_USAGE_DB", ""), help="SQLite file for per-call token usage (default: off)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    gen = sub.add_parser("generate", help="Generate papers from a JSON spec file")
+    gen.add_argument("spec_file")
+    gen.add_argument("--out", default="papers")
+    srv = sub.add_parser("serve", help="Serve a small JSON API (POST /papers)")
+    srv.add_argument("--host", default="127.0.0.1")
+    srv.add_argument("--port", type=int, default=8600)
+    args = parser.parse_args(argv)
+
+    if not args.api_key:
+        parser.error("No API key: set GEMINI_API_KEY or pass --api-key.")
+    if args.usage_db:
+        configure_usage(SQLiteUsageSink(args.usage_db))
+    # Picks the fastest healthy model from the persisted registry; the
+    # models listing is refreshed in the background when stale.
+    registry = configure_model_registry(ModelRegistry(list_generation_models))
+    if args.context_ttl > 0:
+        configure_context_cache(ContextCache(GeminiCacheClient(), args.context_ttl))
+
+    if args.command == "generate":
+        with open(args.spec_file, encoding="utf-8") as f:
+            specs = json.load(f)
+        if isinstance(specs, dict):
+            specs = [specs]
+        done, failed = run_specs(specs, args.api_key, args.out, args.workers, registry)
+        logging.info(f"Done: {done} paper(s) generated, {failed} failed.")
+        return 1 if failed else 0
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(args.api_key, threading.Semaphore(args.workers), registry))
+    logging.info(f"Serving on http://{args.host}:{args.port} (POST /papers)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
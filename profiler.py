@@ -0,0 +1,104 @@
+"""Opt-in sampling profiler for a single Streamlit rerun.
+
+A background thread samples the script thread's stack every few
+milliseconds. Each sample is prefixed with the section the script is in
+(set via mark_section() at the section markers in app.py), so the output
+shows directly whether the sidebar, one of the tabs or the history loop
+is the hot spot.
+
+The result is in collapsed-stack format ("section;frame;frame count"),
+which flamegraph.pl, speedscope and inferno all read.
+"""
+import os
+import sys
+import time
+import logging
+import tempfile
+import threading
+from collections import Counter
+from datetime import datetime
+
+PROFILE_INTERVAL = 0.005
+PROFILE_DIR = os.environ.get("PAPERBANAO_PROFILE_DIR", tempfile.gettempdir())
+
+_local = threading.local()
+
+class RerunSampler:
+    def __init__(self, root_file, interval=PROFILE_INTERVAL):
+        self.root_file = os.path.abspath(root_file)
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.stacks = Counter()
+        self.section = "startup"
+        self.section_started = time.perf_counter()
+        self.section_times = Counter()
+        self.started = self.section_started
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def frame_label(self, frame):
+        code = frame.f_code
+        name = os.path.basename(code.co_filename)
+        # app.py is one big module, so its frames are labelled by current
+        # line; everything else by function, so samples merge per function.
+        line = frame.f_lineno if code.co_name == "<module>" else code.co_firstlineno
+        return f"{code.co_name} ({name}:{line})"
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self.frame_label(frame))
+                if os.path.abspath(frame.f_code.co_filename) == self.root_file and frame.f_code.co_name == "<module>":
+                    break  # don't include Streamlit's own script-runner frames
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join([self.section] + stack[::-1])] += 1
+
+    def mark(self, section):
+        now = time.perf_counter()
+        self.section_times[self.section] += now - self.section_started
+        self.section, self.section_started = section, now
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.mark("end")
+        self._stop.set()
+        self._thread.join()
+        return {
+            "total_s": time.perf_counter() - self.started,
+            "samples": sum(self.stacks.values()),
+            "section_times": {k: round(v * 1000, 1) for k, v in self.section_times.most_common() if k != "end"},
+            "folded": "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common()),
+        }
+
+def start_profile(root_file, interval=PROFILE_INTERVAL):
+    sampler = RerunSampler(root_file, interval)
+    _local.sampler = sampler
+    sampler.start()
+
+def mark_section(section):
+    """Records which part of the script is running. Costs nothing when not profiling."""
+    sampler = getattr(_local, "sampler", None)
+    if sampler is not None:
+        sampler.mark(section)
+
+def stop_profile():
+    """Stops the current profile (if any), writes the .folded file and returns the result."""
+    sampler = getattr(_local, "sampler", None)
+    if sampler is None:
+        return None
+    _local.sampler = None
+    result = sampler.stop()
+    path = os.path.join(PROFILE_DIR, f"paperbanao_rerun_{datetime.now().strftime('%Y%m%d_%H%M%S')}.folded")
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(result["folded"] + "\n")
+        result["path"] = path
+        logging.info(f"[Profiler] {result['samples']} samples over {result['total_s']:.2f}s written to {path}")
+    except OSError as e:
+        logging.error(f"[Profiler Write Error] {e}")
+    return result
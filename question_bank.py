@@ -0,0 +1,281 @@
+"""Question bank: every saved question, reusable in new papers.
+
+Questions are kept per teacher with their class, subject, chapter, type,
+difficulty and language. A question that is a near-duplicate of one the
+teacher already has (MinHash over character shingles, looked up through
+LSH bands) is not stored again; it is only marked as used again. That
+usage is what assemble() checks, so a paper built from the bank never
+repeats a question from the teacher's papers of the last avoid_days:
+
+    bank = QuestionBank("paperbanao_bank.db")
+    bank.add_paper(username, blocks, {"class": "10", "subject": "Maths", "chapter": "Trigonometry",
+                                      "language": "English", "difficulty": {"mcq": "Easy"}})
+    sections, shortfall = bank.assemble(username, "10", "Maths", {"mcq": (10, 1, "Easy")}, chapter="Trigonometry")
+
+assemble() returns sections in generate_structured_sections()'s shape, so
+they can be merged with freshly generated ones and laid out by
+structured_paper_to_blocks(); shortfall is how many of each type the bank
+couldn't supply. fill_shortfall() has Gemini write those, holding its
+questions to the same rule:
+
+    sections, missing = bank.fill_shortfall(username, sections, shortfall, generate)
+"""
+import re
+import json
+import zlib
+import random
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+from engine import QUESTION_KINDS, ANSWER_ENTRY_START_RE, extract_question_number
+
+SHINGLE_CHARS = 4
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16                 # 16 bands of 4 rows: pairs above ~0.5 Jaccard become candidates
+NEAR_DUPLICATE_JACCARD = 0.8
+AVOID_DAYS = 90
+SHORTFALL_ROUNDS = 2           # Gemini calls fill_shortfall() may make
+
+_PRIME = (1 << 61) - 1
+_rng = random.Random(20240601)  # fixed: signatures are stored, so they must be stable across runs
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(_PRIME)) for _ in range(MINHASH_PERMUTATIONS)]
+
+QUESTION_LABEL_PREFIX_RE = re.compile(r'^\s*\**\s*(?:Q\.?\s*)?\d+\s*[.)]\s*\**\s*', re.IGNORECASE)
+SECTION_MARKS_RE = re.compile(r'\[\s*(\d+)\s*Marks?', re.IGNORECASE)
+# Section title words -> kind, for papers laid out from plain-text responses.
+SECTION_KIND_WORDS = [("multiple choice", "mcq"), ("mcq", "mcq"), ("fill in", "fib"), ("true", "tf"),
+                      ("short", "short"), ("long", "long")]
+
+# ==========================================
+# --- SIGNATURES ---
+# ==========================================
+def normalize_question(text):
+    """Lower-case words of a question without its label or punctuation."""
+    text = QUESTION_LABEL_PREFIX_RE.sub('', text)
+    # \w alone drops Devanagari vowel signs (they aren't alphanumeric).
+    return " ".join(re.sub(r'[^\w\u0900-\u097F]+', ' ', text.lower()).split())
+
+def question_text(q):
+    """A structured question as it reads on the paper, options included, so
+    it signs the same as its banked copy."""
+    options = [str(o).strip() for o in q.get("options") or [] if str(o).strip()]
+    if not options:
+        return q["text"]
+    return q["text"] + "\n" + "   ".join(f"({letter}) {opt}" for letter, opt in zip("ABCDEFGH", options))
+
+def shingles(text):
+    text = normalize_question(text)
+    if len(text) <= SHINGLE_CHARS:
+        return {text}
+    return {text[i:i + SHINGLE_CHARS] for i in range(len(text) - SHINGLE_CHARS + 1)}
+
+def minhash(text):
+    hashes = [zlib.crc32(s.encode("utf-8")) for s in shingles(text)]
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+def estimated_jaccard(sig_a, sig_b):
+    return sum(x == y for x, y in zip(sig_a, sig_b)) / len(sig_a)
+
+def lsh_keys(signature):
+    rows = MINHASH_PERMUTATIONS // LSH_BANDS
+    return [f"{band}:{zlib.crc32(json.dumps(signature[band * rows:(band + 1) * rows]).encode()):08x}" for band in range(LSH_BANDS)]
+
+# ==========================================
+# --- EXTRACTION ---
+# ==========================================
+def section_kind(title):
+    title = title.lower()
+    return next((kind for word, kind in SECTION_KIND_WORDS if word in title), None)
+
+def extract_questions(blocks):
+    """[{"kind", "marks", "text", "answer"}] for the questions in a paper's
+    blocks, with labels stripped. kind is None under unrecognised headers."""
+    questions, by_number = [], {}
+    kind, marks, in_answers = None, None, False
+    for b in blocks:
+        text = b['text'].strip()
+        if "ANSWER KEY" in text.upper():
+            in_answers = True
+            text = text.split('\n', 1)[1] if '\n' in text else ""
+        if in_answers:
+            for entry in ANSWER_ENTRY_START_RE.split(text):
+                number = extract_question_number(entry)
+                if entry.strip() and number in by_number:
+                    by_number[number]["answer"] = QUESTION_LABEL_PREFIX_RE.sub('', entry.strip())
+            continue
+        if text.startswith('#'):
+            header, _, text = text.partition('\n')
+            kind = section_kind(header)
+            m = SECTION_MARKS_RE.search(header)
+            marks = int(m.group(1)) if m else None
+            text = text.strip()
+        number = extract_question_number(text) if text else None
+        if number is None:
+            continue
+        q = {"kind": kind, "marks": marks, "text": QUESTION_LABEL_PREFIX_RE.sub('', text).strip(), "answer": ""}
+        questions.append(q)
+        by_number[number] = q
+    return questions
+
+# ==========================================
+# --- BANK ---
+# ==========================================
+class QuestionBank:
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS bank_questions (
+                id INTEGER PRIMARY KEY, username TEXT, class TEXT, subject TEXT, chapter TEXT, kind TEXT,
+                difficulty TEXT, marks INTEGER, language TEXT, text TEXT, answer TEXT, signature TEXT, created_at TEXT)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS bank_questions_lookup ON bank_questions (username, class, subject, kind)")
+            conn.execute("CREATE TABLE IF NOT EXISTS bank_lsh (username TEXT, key TEXT, question_id INTEGER)")
+            conn.execute("CREATE INDEX IF NOT EXISTS bank_lsh_key ON bank_lsh (username, key)")
+            conn.execute("CREATE TABLE IF NOT EXISTS bank_usage (question_id INTEGER, username TEXT, used_at TEXT)")
+            conn.execute("CREATE INDEX IF NOT EXISTS bank_usage_recent ON bank_usage (username, used_at)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _near_duplicate(self, conn, username, signature, keys, used_since=None):
+        placeholders = ", ".join("?" * len(keys))
+        sql = f"""SELECT q.id, q.signature FROM bank_questions q WHERE q.id IN (
+            SELECT question_id FROM bank_lsh WHERE username = ? AND key IN ({placeholders}))"""
+        params = [username] + keys
+        if used_since:
+            sql += " AND q.id IN (SELECT question_id FROM bank_usage WHERE username = ? AND used_at >= ?)"
+            params += [username, used_since]
+        rows = conn.execute(sql, params)
+        for row in rows:
+            if estimated_jaccard(signature, json.loads(row["signature"])) >= NEAR_DUPLICATE_JACCARD:
+                return row["id"]
+        return None
+
+    def add_paper(self, username, blocks, meta, used_at=None):
+        """Adds a paper's questions (skipping near-duplicates of ones already
+        banked) and marks all of them used. meta: class, subject, chapter,
+        language and {kind: difficulty}. Returns (added, duplicates)."""
+        used_at = used_at or datetime.now(timezone.utc).isoformat()
+        difficulty = meta.get("difficulty") or {}
+        added = duplicates = 0
+        with self._connect() as conn:
+            for q in extract_questions(blocks):
+                signature = minhash(q["text"])
+                keys = lsh_keys(signature)
+                question_id = self._near_duplicate(conn, username, signature, keys)
+                if question_id is None:
+                    question_id = conn.execute(
+                        """INSERT INTO bank_questions (username, class, subject, chapter, kind, difficulty, marks, language,
+                           text, answer, signature, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                        (username, str(meta.get("class", "")).strip().lower(), str(meta.get("subject", "")).strip().lower(),
+                         meta.get("chapter", ""), q["kind"], difficulty.get(q["kind"]), q["marks"], meta.get("language"),
+                         q["text"], q["answer"], json.dumps(signature), used_at)).lastrowid
+                    conn.executemany("INSERT INTO bank_lsh (username, key, question_id) VALUES (?, ?, ?)",
+                                     [(username, key, question_id) for key in keys])
+                    added += 1
+                else:
+                    duplicates += 1
+                conn.execute("INSERT INTO bank_usage (question_id, username, used_at) VALUES (?, ?, ?)", (question_id, username, used_at))
+        return added, duplicates
+
+    def assemble(self, username, grade, subject, wanted, chapter="", language=None, include_answers=True,
+                 avoid_days=AVOID_DAYS, rng=None):
+        """Picks bank questions for a new paper. wanted: {kind: (count, marks,
+        difficulty)}. Only questions of the wanted marks are picked, never one
+        used within avoid_days; matching difficulty and least recently used
+        come first. Returns (sections, shortfall {kind: count still needed})."""
+        rng = rng or random.Random()
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=avoid_days)).isoformat()
+        topics = [t.strip().lower() for t in (chapter or "").split(",") if t.strip()]
+        sections, shortfall, picked = [], {}, []
+        with self._connect() as conn:
+            for kind in QUESTION_KINDS:
+                count, marks, difficulty = wanted.get(kind, (0, None, None))
+                if count <= 0:
+                    continue
+                sql = """SELECT q.*, (SELECT MAX(used_at) FROM bank_usage u WHERE u.question_id = q.id) AS last_used
+                         FROM bank_questions q WHERE q.username = ? AND q.class = ? AND q.subject = ? AND q.kind = ?
+                         AND q.id NOT IN (SELECT question_id FROM bank_usage WHERE username = ? AND used_at >= ?)"""
+                params = [username, str(grade).strip().lower(), str(subject).strip().lower(), kind, username, cutoff]
+                if language:
+                    sql, params = sql + " AND q.language = ?", params + [language]
+                if marks:
+                    sql, params = sql + " AND q.marks = ?", params + [marks]
+                if include_answers:
+                    sql += " AND q.answer <> ''"
+                candidates = [dict(r) for r in conn.execute(sql, params)]
+                if topics:
+                    candidates = [c for c in candidates if any(t in (c["chapter"] or "").lower() for t in topics)]
+                rng.shuffle(candidates)
+                candidates.sort(key=lambda c: (c["difficulty"] != difficulty, c["last_used"] or ""))
+                chosen = []
+                for c in candidates:
+                    if len(chosen) == count:
+                        break
+                    signature = json.loads(c["signature"])
+                    if any(estimated_jaccard(signature, s) >= NEAR_DUPLICATE_JACCARD for s in picked):
+                        continue
+                    picked.append(signature)
+                    chosen.append({"text": c["text"], "options": [], "answer": c["answer"]})
+                if chosen:
+                    sections.append({"kind": kind, "marks_each": marks or 1, "questions": chosen})
+                if len(chosen) < count:
+                    shortfall[kind] = count - len(chosen)
+        return sections, shortfall
+
+    def recently_used(self, username, texts, avoid_days=AVOID_DAYS):
+        """For each text, whether it near-duplicates a question the teacher
+        used within avoid_days."""
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=avoid_days)).isoformat()
+        with self._connect() as conn:
+            flags = []
+            for text in texts:
+                signature = minhash(text)
+                flags.append(self._near_duplicate(conn, username, signature, lsh_keys(signature), used_since=cutoff) is not None)
+            return flags
+
+    def fill_shortfall(self, username, sections, shortfall, generate, avoid_days=AVOID_DAYS, rounds=SHORTFALL_ROUNDS):
+        """Merges generated questions into sections until shortfall {kind:
+        count} is met. generate(need {kind: count}) returns sections;
+        questions used within avoid_days, or repeating the paper so far, are
+        dropped and asked for again, up to rounds calls. Returns (sections,
+        {kind: count still missing})."""
+        need = {kind: n for kind, n in shortfall.items() if n > 0}
+        for _ in range(rounds):
+            if not need:
+                break
+            fresh = []
+            for sec in generate(need):
+                recent = self.recently_used(username, [question_text(q) for q in sec["questions"]], avoid_days)
+                questions = [q for q, used in zip(sec["questions"], recent) if not used][:need.get(sec["kind"], 0)]
+                fresh.append(dict(sec, questions=questions))
+            before = section_counts(sections)
+            sections = merge_sections(sections, fresh)
+            after = section_counts(sections)
+            need = {kind: n - (after.get(kind, 0) - before.get(kind, 0)) for kind, n in need.items()}
+            need = {kind: n for kind, n in need.items() if n > 0}
+        return sections, need
+
+def section_counts(sections):
+    counts = {}
+    for sec in sections:
+        counts[sec["kind"]] = counts.get(sec["kind"], 0) + len(sec["questions"])
+    return counts
+
+def merge_sections(*section_lists):
+    """One section per kind, in QUESTION_KINDS order, questions concatenated.
+    A question that near-duplicates an earlier one (say, a generated question
+    repeating a bank one) is dropped."""
+    merged, seen = {}, []
+    for sections in section_lists:
+        for sec in sections:
+            if sec["kind"] not in merged:
+                merged[sec["kind"]] = {"kind": sec["kind"], "marks_each": sec.get("marks_each", 1), "questions": []}
+            for q in sec["questions"]:
+                signature = minhash(question_text(q))
+                if any(estimated_jaccard(signature, s) >= NEAR_DUPLICATE_JACCARD for s in seen):
+                    continue
+                seen.append(signature)
+                merged[sec["kind"]]["questions"].append(q)
+    return [merged[kind] for kind in QUESTION_KINDS if kind in merged and merged[kind]["questions"]]
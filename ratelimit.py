@@ -0,0 +1,223 @@
+"""Token-bucket rate limiting for Gemini calls made with the shared server key.
+
+Every call takes one token from the caller's bucket and one from a global
+bucket. A call that finds a bucket empty waits for the refill (up to
+max_wait) instead of going out and coming back as a 429, so a burst slows
+everyone down a little rather than failing for whoever is unlucky. With
+fair=True, callers waiting on the global bucket are served round-robin
+per user, so one user firing many requests can't starve the others.
+
+Bucket state lives in a store. MemoryBucketStore is per-process;
+RedisBucketStore shares buckets between processes through one atomic Lua
+script, and FakeRedis stands in for a Redis client locally:
+
+    limiter = RateLimiter(RedisBucketStore(redis.Redis.from_url(url)), ...)
+    limiter = RateLimiter(RedisBucketStore(FakeRedis()), ...)
+
+engine.generate_gemini_content() calls acquire_generation_slot() before
+each request; it only applies to keys passed to configure_rate_limit().
+"""
+import time
+import threading
+from collections import OrderedDict, deque
+
+from metrics import observe
+from usage import current_usage_context
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limited: server key is busy, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+def refill_bucket(tokens, updated, capacity, rate, now):
+    if tokens is None:
+        return capacity
+    return min(capacity, tokens + (now - updated) * rate)
+
+# ==========================================
+# --- STORES ---
+# ==========================================
+class MemoryBucketStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def take(self, key, capacity, rate, cost=1.0):
+        """Takes cost tokens if available. Returns 0.0 on success, else the
+        seconds until enough tokens will have refilled."""
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (None, now))
+            tokens = refill_bucket(tokens, updated, capacity, rate, now)
+            if tokens >= cost:
+                self.buckets[key] = (tokens - cost, now)
+                return 0.0
+            self.buckets[key] = (tokens, now)
+            return (cost - tokens) / rate
+
+    def drain(self, key, capacity, rate, seconds):
+        """Empties the bucket and holds it at zero for `seconds` (e.g. after
+        Gemini itself answered 429)."""
+        with self.lock:
+            self.buckets[key] = (-seconds * rate, time.monotonic())
+
+# KEYS[1] = bucket, ARGV = capacity, rate, cost, now; returns wait in ms.
+TOKEN_BUCKET_LUA = """
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local capacity, rate, cost, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local tokens = tonumber(b[1])
+if tokens == nil then tokens = capacity else tokens = math.min(capacity, tokens + (now - tonumber(b[2])) * rate) end
+local wait = 0
+if tokens >= cost then tokens = tokens - cost else wait = math.ceil((cost - tokens) / rate * 1000) end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 60000)
+return wait
+"""
+
+class RedisBucketStore:
+    """Buckets shared across processes. `client` is a redis.Redis (or FakeRedis)."""
+    def __init__(self, client, prefix="paperbanao:rl:"):
+        self.client = client
+        self.prefix = prefix
+        self.script = client.register_script(TOKEN_BUCKET_LUA)
+
+    def take(self, key, capacity, rate, cost=1.0):
+        return int(self.script(keys=[self.prefix + key], args=[capacity, rate, cost, time.time()])) / 1000.0
+
+    def drain(self, key, capacity, rate, seconds):
+        self.client.hset(self.prefix + key, mapping={"tokens": str(-seconds * rate), "updated": str(time.time())})
+
+class FakeRedis:
+    """In-process stand-in for the few redis.Redis calls RedisBucketStore
+    makes, so the Redis path can be run without a server."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hashes = {}
+
+    def hset(self, key, mapping):
+        with self.lock:
+            self.hashes.setdefault(key, {}).update(mapping)
+
+    def register_script(self, script):
+        if script != TOKEN_BUCKET_LUA:
+            raise NotImplementedError("FakeRedis only runs the token bucket script.")
+        def run(keys, args):
+            capacity, rate, cost, now = (float(a) for a in args)
+            with self.lock:
+                h = self.hashes.setdefault(keys[0], {})
+                tokens = refill_bucket(float(h["tokens"]) if "tokens" in h else None, float(h.get("updated", now)), capacity, rate, now)
+                wait = 0
+                if tokens >= cost:
+                    tokens -= cost
+                else:
+                    wait = -(-(cost - tokens) * 1000 // rate)
+                h.update({"tokens": str(tokens), "updated": str(now)})
+            return int(wait)
+        return run
+
+# ==========================================
+# --- LIMITER ---
+# ==========================================
+class FairQueue:
+    """Round-robin turn-taking between users waiting for the global bucket."""
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.waiting = OrderedDict()  # user -> deque of tickets, in turn order
+
+    def enter(self, user):
+        ticket = object()
+        with self.cond:
+            self.waiting.setdefault(user, deque()).append(ticket)
+        return ticket
+
+    def wait_turn(self, user, ticket, deadline):
+        with self.cond:
+            while True:
+                head_user = next(iter(self.waiting))
+                if head_user == user and self.waiting[user][0] is ticket:
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+
+    def leave(self, user, ticket):
+        with self.cond:
+            queue = self.waiting[user]
+            at_head = next(iter(self.waiting)) == user and queue[0] is ticket
+            queue.remove(ticket)
+            if not queue:
+                del self.waiting[user]
+            elif at_head:
+                self.waiting.move_to_end(user)  # served: go to the back of the line
+            self.cond.notify_all()
+
+class RateLimiter:
+    def __init__(self, store, user_per_min=6, user_burst=3, global_per_min=60, global_burst=10, max_wait=20.0, fair=True):
+        self.store = store
+        self.user_bucket = (float(user_burst), user_per_min / 60.0)
+        self.global_bucket = (float(global_burst), global_per_min / 60.0)
+        self.max_wait = max_wait
+        self.queue = FairQueue() if fair else None
+
+    def _take_within(self, key, bucket, deadline):
+        """Returns 0.0 once a token is taken, or the wait that would have
+        overrun the deadline."""
+        while True:
+            wait = self.store.take(key, *bucket)
+            if wait <= 0:
+                return 0.0
+            if time.monotonic() + wait > deadline:
+                return wait
+            time.sleep(wait)
+
+    def acquire(self, user):
+        """Blocks until user may make one call, or raises RateLimited if that
+        would take longer than max_wait."""
+        start = time.monotonic()
+        deadline = start + self.max_wait
+        user = user or "anonymous"
+        wait = self._take_within(f"user:{user}", self.user_bucket, deadline)
+        if wait:
+            raise RateLimited(wait)
+        ticket = self.queue.enter(user) if self.queue else None
+        granted = False
+        try:
+            if ticket and not self.queue.wait_turn(user, ticket, deadline):
+                raise RateLimited(self.max_wait)
+            wait = self._take_within("global", self.global_bucket, deadline)
+            if wait:
+                raise RateLimited(wait)
+            granted = True
+        finally:
+            if ticket:
+                self.queue.leave(user, ticket)
+            if not granted:
+                self.refund(f"user:{user}", self.user_bucket)
+        observe("ratelimit.wait", time.monotonic() - start)
+
+    def refund(self, key, bucket):
+        """Gives back a token taken for a call that was never made. A negative
+        cost always succeeds; the next take caps the bucket at capacity."""
+        self.store.take(key, *bucket, cost=-1.0)
+
+    def backoff(self, seconds):
+        """Gemini answered 429 anyway: hold every caller off for a while."""
+        self.store.drain("global", *self.global_bucket, seconds)
+
+_limiter = None
+_limited_keys = frozenset()
+
+def configure_rate_limit(limiter, api_keys):
+    """Puts limiter in front of Gemini calls made with any of api_keys
+    (normally just the shared server key). None turns limiting off."""
+    global _limiter, _limited_keys
+    _limiter, _limited_keys = limiter, frozenset(k for k in api_keys if k)
+
+def acquire_generation_slot(api_key):
+    if _limiter is not None and api_key in _limited_keys:
+        _limiter.acquire((current_usage_context() or {}).get("username"))
+
+def report_upstream_429(api_key, seconds=10.0):
+    if _limiter is not None and api_key in _limited_keys:
+        _limiter.backoff(seconds)
@@ -0,0 +1,75 @@
+"""Context cache handles: reuse, extension, expiry and refusals."""
+import pytest
+
+import context_cache
+from context_cache import ContextCache, CacheRefused
+
+BOOK = "The sine of an angle is opposite over hypotenuse. " * 10
+
+class FakeCacheClient:
+    def __init__(self, refuse=None):
+        self.refuse, self.created, self.extended, self.deleted = refuse, [], [], []
+
+    def create(self, api_key, model, text, ttl):
+        if self.refuse:
+            raise CacheRefused(self.refuse, "no")
+        self.created.append(text)
+        return f"cachedContents/{len(self.created)}"
+
+    def extend(self, api_key, name, ttl):
+        self.extended.append(name)
+
+    def delete(self, api_key, name):
+        self.deleted.append(name)
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1.8e9]
+    monkeypatch.setattr(context_cache.time, "time", lambda: now[0])
+    return now
+
+def test_handle_is_reused_then_extended(clock):
+    client = FakeCacheClient()
+    cache = ContextCache(client, ttl=600, min_chars=100)
+    name = cache.handle("key", "model", BOOK)
+    clock[0] += 100
+    assert cache.handle("key", "model", BOOK) == name and client.extended == []
+    clock[0] += 300   # under half the ttl left
+    assert cache.handle("key", "model", BOOK) == name and client.extended == [name]
+    assert len(client.created) == 1
+
+def test_expired_handle_is_uploaded_again(clock):
+    client = FakeCacheClient()
+    cache = ContextCache(client, ttl=600, min_chars=100)
+    first = cache.handle("key", "model", BOOK)
+    clock[0] += 590   # inside EXPIRY_MARGIN: too close to risk
+    assert cache.handle("key", "model", BOOK, create=False) is None
+    second = cache.handle("key", "model", BOOK)
+    assert second != first and len(client.created) == 2
+
+def test_invalidated_handle_is_uploaded_again(clock):
+    client = FakeCacheClient()
+    cache = ContextCache(client, ttl=600, min_chars=100)
+    first = cache.handle("key", "model", BOOK)
+    cache.invalidate("key", "model", BOOK)
+    assert cache.handle("key", "model", BOOK) != first
+
+def test_short_and_refused_texts_go_inline(clock):
+    assert ContextCache(FakeCacheClient(), min_chars=10000).handle("key", "model", BOOK) is None
+    client = FakeCacheClient(refuse="unsupported")
+    cache = ContextCache(client, min_chars=100)
+    assert cache.handle("key", "model", BOOK) is None
+    client.refuse = None
+    # The key and model aren't asked again until RETRY_AFTER has passed.
+    assert cache.handle("key", "model", BOOK + "more") is None
+    clock[0] += context_cache.RETRY_AFTER
+    assert cache.handle("key", "model", BOOK) is not None
+
+def test_close_deletes_live_caches(clock):
+    client = FakeCacheClient()
+    cache = ContextCache(client, ttl=600, min_chars=100)
+    live = cache.handle("key", "model", BOOK)
+    cache.handle("key", "model", BOOK + "expired")
+    cache.entries[cache._entry_key("key", "model", BOOK + "expired")]["expires_at"] = clock[0] - 1
+    cache.close()
+    assert client.deleted == [live]
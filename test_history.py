@@ -0,0 +1,128 @@
+"""Cloud History saving against an in-memory stand-in for the supabase client."""
+import itertools
+
+import os
+import base64
+
+from history import save_paper_to, unpack_content, pack_content, content_hash, SQLiteHistoryIndex, COMPRESSED_PREFIX
+
+class FakeResult:
+    def __init__(self, data):
+        self.data = data
+
+class FakeQuery:
+    """The slice of the supabase query builder save_paper_to() uses. Like
+    the real papers table, (username, content_hash) is unique."""
+    UNIQUE = {"papers": ("username", "content_hash"), "paper_revisions": ("paper_id", "rev")}
+
+    def __init__(self, db, table):
+        self.db, self.table, self.filters, self.op, self.payload = db, table, [], "select", None
+        self.bounds = None
+
+    def select(self, columns):
+        return self
+
+    def order(self, column):
+        return self
+
+    def range(self, start, end):
+        self.bounds = (start, end + 1)
+        return self
+
+    def eq(self, column, value):
+        self.filters.append((column, value))
+        return self
+
+    def update(self, values):
+        self.op, self.payload = "update", values
+        return self
+
+    def upsert(self, row, on_conflict=None):
+        self.op, self.payload = "upsert", row
+        return self
+
+    def _check_unique(self, rows, row, ignore=None):
+        cols = self.UNIQUE[self.table]
+        if any(r is not ignore and all(r.get(c) == row.get(c) for c in cols) for r in rows):
+            raise Exception(f"duplicate key value violates unique constraint on {cols}")
+
+    def execute(self):
+        rows = self.db.setdefault(self.table, [])
+        match = [r for r in rows if all(r.get(c) == v for c, v in self.filters)]
+        if self.op == "select":
+            match = sorted(match, key=lambda r: r["id"])[slice(*self.bounds)] if self.bounds else match
+            return FakeResult([dict(r) for r in match])
+        if self.op == "update":
+            for r in match:
+                self._check_unique(rows, dict(r, **self.payload), ignore=r)
+                r.update(self.payload)
+            return FakeResult([dict(r) for r in match])
+        cols = self.UNIQUE[self.table]
+        existing = next((r for r in rows if all(r.get(c) == self.payload.get(c) for c in cols)), None)
+        if existing is not None:
+            existing.update(self.payload)
+            return FakeResult([dict(existing)])
+        row = dict(self.payload, id=next(self.db["ids"]))
+        rows.append(row)
+        return FakeResult([dict(row)])
+
+class FakeClient:
+    def __init__(self):
+        self.db = {"ids": itertools.count(1)}
+
+    def table(self, name):
+        return FakeQuery(self.db, name)
+
+def save(client, content, paper_id=None):
+    return save_paper_to(client, "teacher", "2026-01-01", "Maths", "CBSE", content, paper_id)[0]
+
+def test_identical_save_reuses_row():
+    client = FakeClient()
+    first = save(client, "Q1. What is 2 + 2?")
+    assert save(client, "Q1. What is 2 + 2?") == first
+    assert len(client.db["papers"]) == 1
+
+def test_edit_becomes_next_revision():
+    client = FakeClient()
+    paper_id = save(client, "Q1. What is 2 + 2?")
+    assert save(client, "Q1. What is 3 + 3?", paper_id) == paper_id
+    head = client.db["papers"][0]
+    assert head["rev"] == 1 and unpack_content(head["content"]) == "Q1. What is 3 + 3?"
+    assert [r["rev"] for r in client.db["paper_revisions"]] == [0]
+
+def test_edit_matching_another_paper_points_at_that_paper():
+    client = FakeClient()
+    other = save(client, "Q1. Define photosynthesis.")
+    paper_id = save(client, "Q1. What is 2 + 2?")
+    # Editing this paper into the exact text of the other one must not
+    # collide on (username, content_hash) or leave a stray revision behind.
+    assert save(client, "Q1. Define photosynthesis.", paper_id) == other
+    assert "paper_revisions" not in client.db
+    assert {unpack_content(r["content"]) for r in client.db["papers"]} == {"Q1. Define photosynthesis.", "Q1. What is 2 + 2?"}
+
+def test_backfill_indexes_saved_papers_once(tmp_path):
+    client = FakeClient()
+    for n in range(5):
+        save(client, f"Q1. What is {n} + {n}?")
+    index = SQLiteHistoryIndex(str(tmp_path / "search.db"))
+    assert index.backfill(client, page_rows=2) == 5
+    assert [r["id"] for r in index.search("teacher", "3")] == [4]
+    save(client, "Q1. Define photosynthesis.")
+    assert index.backfill(client) == 0
+
+def test_content_hash_ignores_line_endings_and_edge_whitespace():
+    assert content_hash("Q1. Add.\r\n\r\nQ2. Subtract.\n") == content_hash("Q1. Add.\n\nQ2. Subtract.")
+    assert content_hash("Q1. Add.") != content_hash("Q1. Subtract.")
+
+def test_pack_compresses_long_papers_and_round_trips():
+    paper = "\n\n".join(f"**Q{n}.** यदि sin θ = 3/5 है, तो cos θ का मान ज्ञात करें।" for n in range(1, 40))
+    packed = pack_content(paper)
+    assert packed.startswith(COMPRESSED_PREFIX) and len(packed) < len(paper.encode("utf-8"))
+    assert unpack_content(packed) == paper
+
+def test_pack_leaves_short_and_incompressible_text_plain():
+    assert pack_content("Q1. What is 2 + 2?") == "Q1. What is 2 + 2?"
+    noise = base64.b64encode(os.urandom(2000)).decode("ascii")
+    assert pack_content(noise) == noise
+    # Rows saved before compression existed are plain text.
+    assert unpack_content(noise) == noise
@@ -0,0 +1,39 @@
+"""Model choice from the persisted registry."""
+from model_registry import ModelRegistry
+
+MODELS = ["gemini-1.5-flash", "gemini-2.0-flash", "gemini-2.5-flash", "gemini-1.5-pro", "gemini-2.0-flash-tts"]
+
+def registry(tmp_path, explore_rate=0.0):
+    r = ModelRegistry(lambda key: MODELS, path=str(tmp_path / "models.json"), explore_rate=explore_rate)
+    r.refresh("key")
+    return r
+
+def test_unlisted_key_gets_the_default_without_waiting(tmp_path):
+    r = ModelRegistry(lambda key: MODELS, path=str(tmp_path / "models.json"), default_model="gemini-1.5-flash")
+    r.refresh_in_background = lambda key: None
+    assert r.pick("new-key") == "gemini-1.5-flash"
+
+def test_nothing_measured_falls_back_to_the_legacy_choice(tmp_path):
+    assert registry(tmp_path).pick("key") == "gemini-1.5-flash"
+
+def test_ranks_by_latency_per_output_token(tmp_path):
+    r = registry(tmp_path)
+    # 2.0-flash answers sooner, but only because it wrote a tenth as much.
+    r.observe("key", "gemini-2.0-flash", 1.0, True, output_tokens=100)
+    r.observe("key", "gemini-2.5-flash", 4.0, True, output_tokens=1000)
+    assert r.pick("key") == "gemini-2.5-flash"
+
+def test_failing_model_is_skipped(tmp_path):
+    r = registry(tmp_path)
+    r.observe("key", "gemini-2.0-flash", 1.0, True, output_tokens=1000)
+    r.observe("key", "gemini-2.5-flash", 4.0, True, output_tokens=1000)
+    for _ in range(5):
+        r.observe("key", "gemini-2.0-flash", 1.0, False)
+    assert r.pick("key") == "gemini-2.5-flash"
+    assert not r.usable("key", "gemini-2.0-flash")
+
+def test_exploration_only_tries_unmeasured_flash_models(tmp_path):
+    r = registry(tmp_path, explore_rate=1.0)
+    r.observe("key", "gemini-2.0-flash", 1.0, True, output_tokens=1000)
+    picks = {r.pick("key") for _ in range(50)}
+    assert picks == {"gemini-1.5-flash", "gemini-2.5-flash"}
@@ -0,0 +1,57 @@
+"""Question bank: near-duplicates, the avoid window and shortfall filling."""
+from datetime import datetime, timedelta, timezone
+
+from question_bank import QuestionBank
+
+META = {"class": "10", "subject": "Biology", "chapter": "Life Processes"}
+QUESTIONS = ["What is photosynthesis in green plants?", "Define osmosis with a clear example.",
+             "Name the pigment that traps sunlight in leaves.", "Why do plants need nitrogen from the soil?"]
+
+def paper(questions, marks=2):
+    return [{"text": f"## Short Answer Questions [{marks} Marks each]"}] + [{"text": f"{n}. {q}"} for n, q in enumerate(questions, 1)]
+
+def days_ago(days):
+    return (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
+
+def texts(sections):
+    return sorted(q["text"] for sec in sections for q in sec["questions"])
+
+def test_near_duplicates_are_banked_once(tmp_path):
+    bank = QuestionBank(str(tmp_path / "bank.db"))
+    assert bank.add_paper("t", paper(QUESTIONS[:2]), META) == (2, 0)
+    assert bank.add_paper("t", paper(["What is photosynthesis in green plants ?", QUESTIONS[2]]), META) == (1, 1)
+    # Another teacher's bank is separate.
+    assert bank.add_paper("other", paper(QUESTIONS[:1]), META) == (1, 0)
+
+def test_assemble_skips_questions_used_within_the_window(tmp_path):
+    bank = QuestionBank(str(tmp_path / "bank.db"))
+    bank.add_paper("t", paper(QUESTIONS[:2]), META, used_at=days_ago(120))
+    bank.add_paper("t", paper(QUESTIONS[2:]), META, used_at=days_ago(30))
+    sections, shortfall = bank.assemble("t", "10", "biology", {"short": (4, 2, None)}, include_answers=False)
+    assert texts(sections) == sorted(QUESTIONS[:2]) and shortfall == {"short": 2}
+    sections, _ = bank.assemble("t", "10", "Biology", {"short": (4, 2, None)}, include_answers=False, avoid_days=7)
+    assert texts(sections) == sorted(QUESTIONS)
+
+def test_assemble_only_picks_the_requested_marks(tmp_path):
+    bank = QuestionBank(str(tmp_path / "bank.db"))
+    bank.add_paper("t", paper(QUESTIONS[:2], marks=2), META, used_at=days_ago(120))
+    bank.add_paper("t", paper(QUESTIONS[2:], marks=5), META, used_at=days_ago(120))
+    sections, shortfall = bank.assemble("t", "10", "Biology", {"short": (3, 5, None)}, include_answers=False)
+    assert texts(sections) == sorted(QUESTIONS[2:]) and shortfall == {"short": 1}
+
+def test_fill_shortfall_drops_recent_and_repeated_questions(tmp_path):
+    bank = QuestionBank(str(tmp_path / "bank.db"))
+    bank.add_paper("t", paper(QUESTIONS[:1]), META, used_at=days_ago(10))
+    have = [{"kind": "short", "marks_each": 2, "questions": [{"text": QUESTIONS[1]}]}]
+    replies = iter([
+        # A recently used question, one already on the paper, and one new one.
+        [{"kind": "short", "questions": [{"text": QUESTIONS[0]}, {"text": QUESTIONS[1] + "."}, {"text": QUESTIONS[2]}]}],
+        [{"kind": "short", "questions": [{"text": QUESTIONS[3]}]}],
+    ])
+    asked = []
+    def generate(need):
+        asked.append(dict(need))
+        return next(replies)
+    sections, missing = bank.fill_shortfall("t", have, {"short": 2}, generate)
+    assert asked == [{"short": 2}, {"short": 1}]
+    assert texts(sections) == sorted(QUESTIONS[1:]) and missing == {}
@@ -0,0 +1,41 @@
+"""Rate limiting for the shared server key."""
+import time
+
+import pytest
+
+from ratelimit import FairQueue, RateLimiter, RateLimited, MemoryBucketStore, RedisBucketStore, FakeRedis
+
+def test_fair_queue_serves_users_round_robin():
+    queue = FairQueue()
+    a1, a2, b1 = queue.enter("a"), queue.enter("a"), queue.enter("b")
+    now = time.monotonic()
+    assert queue.wait_turn("a", a1, now)
+    assert not queue.wait_turn("a", a2, now) and not queue.wait_turn("b", b1, now)
+    queue.leave("a", a1)
+    # a was just served, so b goes before a's second request.
+    assert queue.wait_turn("b", b1, now) and not queue.wait_turn("a", a2, now)
+    queue.leave("b", b1)
+    assert queue.wait_turn("a", a2, now)
+
+@pytest.mark.parametrize("store", [MemoryBucketStore, lambda: RedisBucketStore(FakeRedis())])
+def test_busy_global_bucket_times_out_at_max_wait(store):
+    store = store()
+    limiter = RateLimiter(store, user_per_min=6, user_burst=3, global_per_min=0.01, global_burst=1, max_wait=0.1)
+    limiter.acquire("a")
+    start = time.monotonic()
+    with pytest.raises(RateLimited):
+        limiter.acquire("a")
+    assert time.monotonic() - start < 1.0
+    # The refused call gave its user token back: two of three are left.
+    assert store.take("user:a", *limiter.user_bucket) == 0.0
+    assert store.take("user:a", *limiter.user_bucket) == 0.0
+    assert store.take("user:a", *limiter.user_bucket) > 0
+
+def test_empty_user_bucket_is_refused_without_touching_the_global_one():
+    store = MemoryBucketStore()
+    limiter = RateLimiter(store, user_per_min=0.01, user_burst=1, global_per_min=60, global_burst=2, max_wait=0.1)
+    limiter.acquire("a")
+    with pytest.raises(RateLimited):
+        limiter.acquire("a")
+    limiter.acquire("b")
+    assert store.take("global", *limiter.global_bucket) > 0
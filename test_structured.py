@@ -0,0 +1,46 @@
+"""JSON-mode papers: parsing, targeted repair and layout."""
+import json
+
+import pytest
+
+import engine
+from engine import parse_structured_paper, repair_structured_questions, apply_section_marks, structured_paper_to_blocks
+
+MCQ = {"text": "What is 2 + 3?", "options": ["4", "5", "6", "7"], "marks": 1, "answer": "(B) 5"}
+
+def test_parse_keeps_known_sections_only():
+    reply = json.dumps({"sections": [{"kind": "mcq", "marks_each": 1, "questions": [MCQ]},
+                                     {"kind": "essay", "marks_each": 10, "questions": []},
+                                     {"kind": "tf", "marks_each": 1, "questions": "none"}]})
+    assert [sec["kind"] for sec in parse_structured_paper(reply)] == ["mcq"]
+
+def test_parse_rejects_a_reply_without_sections():
+    with pytest.raises(ValueError):
+        parse_structured_paper(json.dumps([MCQ]))
+
+def test_repair_patches_only_the_fixed_questions(monkeypatch):
+    sections = [{"kind": "mcq", "marks_each": 1, "questions": [MCQ, dict(MCQ, options=["4", "5"]), dict(MCQ, text="")]}]
+    bad = [(0, 1, "needs exactly 4 options, got 2"), (0, 2, "empty question text")]
+    prompts = []
+    def reply(prompt, *args, **kwargs):
+        prompts.append(prompt)
+        return json.dumps([dict(MCQ, text="What is 1 + 4?"), {"text": "", "options": []}])
+    monkeypatch.setattr(engine, "generate_gemini_content", reply)
+    still_bad = repair_structured_questions(sections, bad, "key", "model", "Maths", True)
+    assert sections[0]["questions"][1]["text"] == "What is 1 + 4?"
+    assert still_bad == [(0, 2, "empty question text")]
+    assert len(prompts) == 1 and "needs exactly 4 options" in prompts[0]
+
+def test_repair_keeps_items_the_reply_left_out(monkeypatch):
+    sections = [{"kind": "tf", "marks_each": 1, "questions": [{"text": "Sky is blue."}, {"text": "Fire is cold."}]}]
+    bad = [(0, 0, "needs exactly 2 options, got 0"), (0, 1, "needs exactly 2 options, got 0")]
+    monkeypatch.setattr(engine, "generate_gemini_content",
+                        lambda *a, **k: json.dumps([{"text": "Sky is blue.", "options": ["True", "False"], "marks": 1}]))
+    assert repair_structured_questions(sections, bad, "key", "model", "Science", False) == [bad[1]]
+
+def test_headers_use_the_requested_marks():
+    sections = [{"kind": "mcq", "marks_each": 3, "questions": [MCQ]}, {"kind": "long", "marks_each": 1, "questions": [{"text": "Explain."}]}]
+    blocks = structured_paper_to_blocks(apply_section_marks(sections, {"mcq": 1}), include_answers=True)
+    assert [b["text"] for b in blocks] == ["## Multiple Choice Questions [1 Mark(s) Each]",
+                                           "**Q1.** What is 2 + 3?\n(A) 4   (B) 5   (C) 6   (D) 7",
+                                           "# ANSWER KEY", "**Q1.** (B) 5"]
@@ -0,0 +1,71 @@
+"""Scanned-page transcription: the transcript cache and unread pages."""
+import pytest
+
+import engine
+import transcripts
+from engine import transcribe_cached_pages, read_pdf_pages
+from ratelimit import RateLimited
+from transcripts import MemoryTranscriptCache, SQLiteTranscriptCache
+
+@pytest.fixture
+def sent(monkeypatch):
+    """Stands in for Gemini; records the batches of page images sent."""
+    batches = []
+    def transcribe(images, api_key, model_name, prompt):
+        batches.append(list(images))
+        return [f"text of {img}" for img in images]
+    monkeypatch.setattr(engine, "transcribe_pages", transcribe)
+    monkeypatch.setattr(transcripts, "_cache", MemoryTranscriptCache())
+    return batches
+
+def test_cached_and_repeated_pages_are_not_sent(sent):
+    transcripts.store_transcript("k1", "cached text")
+    loaded = []
+    def load(i):
+        loaded.append(i)
+        return f"page{i}"
+    texts, count, errors = transcribe_cached_pages({0: "k1", 1: "k2", 2: "k2", 3: "k3"}, load, "prompt", "key", "model")
+    assert texts == {0: "cached text", 1: "text of page1", 2: "text of page1", 3: "text of page3"}
+    assert count == 2 and errors == [] and sorted(loaded) == [1, 3]
+    assert sent == [["page1", "page3"]]
+    # Everything is cached now.
+    assert transcribe_cached_pages({0: "k1", 3: "k3"}, load, "prompt", "key", "model")[1] == 0
+
+def test_rate_limited_batch_is_sent_again(sent, monkeypatch):
+    calls = []
+    def transcribe(images, api_key, model_name, prompt):
+        calls.append(images)
+        if len(calls) == 1:
+            raise RateLimited(0.01)
+        return ["page text"] * len(images)
+    monkeypatch.setattr(engine, "transcribe_pages", transcribe)
+    texts, _, errors = transcribe_cached_pages({0: "a"}, lambda i: "img", "prompt", "key", "model")
+    assert texts == {0: "page text"} and errors == [] and len(calls) == 2
+
+def test_failed_batches_are_reported_and_left_out(sent, monkeypatch):
+    def transcribe(images, api_key, model_name, prompt):
+        raise RuntimeError("API Error 500")
+    monkeypatch.setattr(engine, "transcribe_pages", transcribe)
+    texts, count, errors = transcribe_cached_pages({0: "a", 1: "b"}, lambda i: "img", "prompt", "key", "model")
+    assert texts == {} and count == 2 and [str(e) for e in errors] == ["API Error 500"]
+
+def blank_page_pdf():
+    import pymupdf
+    doc = pymupdf.open()
+    doc.new_page().insert_text((72, 72), "Chapter 1: the sine of an angle is opposite over hypotenuse.")
+    doc.new_page()   # no text layer, like a scan
+    doc.new_page()
+    return doc.tobytes()
+
+def test_unread_scanned_pages_are_reported(sent, monkeypatch):
+    data = blank_page_pdf()
+    text, unread = read_pdf_pages(data, 1, 3)
+    assert "Chapter 1" in text and unread == [2, 3]
+    monkeypatch.setattr(engine, "rasterize_page", lambda page: f"scan{page.number}")
+    text, unread = read_pdf_pages(data, 1, 3, api_key="key")
+    assert "text of scan1" in text and "text of scan2" in text and unread == []
+
+def test_sqlite_cache_survives_reopening(tmp_path):
+    path = str(tmp_path / "transcripts.db")
+    SQLiteTranscriptCache(path).put("pdf:abc:1:v1", "page one")
+    assert SQLiteTranscriptCache(path).get_many(["pdf:abc:1:v1", "pdf:abc:2:v1"]) == {"pdf:abc:1:v1": "page one"}
@@ -0,0 +1,42 @@
+"""Shuffled paper sets: option order changes, the answer key follows it."""
+import random
+
+from engine import shuffle_options, remap_answer, generate_paper_variants, split_blocks
+
+QUESTION = "**Q1.** What is 2 + 3?\n(A) 4   (B) 5   (C) 6   (D) 7"
+
+def options(text):
+    return {part[1]: part[4:].strip() for part in text.split("\n")[1].split("   ")}
+
+def test_shuffle_moves_each_option_to_its_mapped_letter():
+    for seed in range(10):
+        text, letter_map = shuffle_options(QUESTION, random.Random(seed))
+        before, after = options(QUESTION), options(text)
+        assert sorted(letter_map) == sorted(letter_map.values()) == list("ABCD")
+        assert all(after[letter_map[old]] == content for old, content in before.items())
+
+def test_fixed_options_are_not_shuffled():
+    text = "**Q2.** Which is even?\n(A) 3   (B) 5   (C) 8   (D) None of the above"
+    assert shuffle_options(text, random.Random(1)) == (text, {})
+    assert shuffle_options("**Q3.** The sun rises in the east.\n(A) True   (B) False", random.Random(1))[1] == {}
+
+def test_remap_answer_follows_the_new_letter():
+    letter_map = {"A": "C", "B": "A", "C": "D", "D": "B"}
+    assert remap_answer("**Q1.** (B) 5", 4, letter_map) == "**Q4.** (A) 5"
+    assert remap_answer("**Q1.** Answer: B", 4, letter_map) == "**Q4.** Answer: A"
+    assert remap_answer("**Q1.** Step 1: add.", 4, {}) == "**Q4.** Step 1: add."
+
+def test_variant_answer_key_points_at_the_same_option():
+    paper = split_blocks("## Multiple Choice Questions [1 Mark(s) Each]\n|||\n" + QUESTION +
+                         "\n|||\n**Q2.** What is 3 + 3?\n(A) 6   (B) 7   (C) 8   (D) 9"
+                         "\n|||\n# ANSWER KEY\n|||\n**Q1.** (B) 5\n|||\n**Q2.** (A) 6")
+    keys = set()
+    for _, blocks in generate_paper_variants(paper, 3, seed=7):
+        texts = [b["text"] for b in blocks]
+        key = texts.index("# ANSWER KEY")
+        questions = {t.split("**")[1]: options(t) for t in texts[:key] if t.startswith("**Q")}
+        for answer in texts[key + 1:]:
+            number, letter, content = answer.split("**")[1], answer.split("(")[1][0], answer.split(") ")[1]
+            assert questions[number][letter] == content
+        keys.add(tuple(texts[key + 1:]))
+    assert len(keys) > 1
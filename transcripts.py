@@ -0,0 +1,73 @@
+"""Cache of page transcriptions made by Gemini.
+
+Transcribing a scanned page is a multimodal Gemini call, so each result is
+kept under a key naming exactly what was transcribed and how (the source's
+digest, the page and the prompt version), and the same page is never sent
+twice. MemoryTranscriptCache is per-process and bounded;
+SQLiteTranscriptCache survives restarts and is shared by every process
+using the same file:
+
+    configure_transcript_cache(SQLiteTranscriptCache("paperbanao_transcripts.db"))
+
+engine.extract_text_from_pdf() (scanned pages) and engine.digitize_pages()
+(Digitize tab photos) read and fill the configured cache.
+"""
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+MEMORY_CACHE_ENTRIES = 2000
+
+class MemoryTranscriptCache:
+    def __init__(self, max_entries=MEMORY_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get_many(self, keys):
+        """{key: text} for the keys that are cached."""
+        with self.lock:
+            found = {k: self.entries[k] for k in keys if k in self.entries}
+            for k in found:
+                self.entries.move_to_end(k)
+            return found
+
+    def put(self, key, text):
+        with self.lock:
+            self.entries[key] = text
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+class SQLiteTranscriptCache:
+    def __init__(self, path):
+        self.path = path
+        with sqlite3.connect(path, timeout=10) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS transcripts (key TEXT PRIMARY KEY, text TEXT, created_at TEXT)")
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        with sqlite3.connect(self.path, timeout=10) as conn:
+            rows = conn.execute(f"SELECT key, text FROM transcripts WHERE key IN ({', '.join('?' * len(keys))})", keys)
+            return dict(rows.fetchall())
+
+    def put(self, key, text):
+        with sqlite3.connect(self.path, timeout=10) as conn:
+            conn.execute("INSERT OR REPLACE INTO transcripts (key, text, created_at) VALUES (?, ?, ?)",
+                         (key, text, datetime.now(timezone.utc).isoformat()))
+
+_cache = MemoryTranscriptCache()
+
+def configure_transcript_cache(cache):
+    global _cache
+    _cache = cache
+    return cache
+
+def cached_transcripts(keys):
+    return _cache.get_many(keys)
+
+def store_transcript(key, text):
+    _cache.put(key, text)
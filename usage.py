@@ -0,0 +1,222 @@
+"""Per-call Gemini token accounting.
+
+engine.generate_gemini_content() hands every call's usageMetadata, latency
+and model to record_call(). Records are buffered in memory and written in
+batches from a background thread, so a generation never waits on the
+usage store. Who made the call and what they asked for comes from
+usage_context(), which the app wraps around each generation:
+
+    with usage_context(username, "create", config={"mcq": 10, "pdf_pages": 5}):
+        generate_gemini_content(...)
+
+Two stores are provided: SQLiteUsageSink (a local file, the default) and
+SupabaseUsageSink. The Supabase table and views it expects:
+
+    create table gemini_usage (
+        id bigserial primary key, created_at timestamptz, day date, username text,
+        feature text, model text, prompt_tokens int, output_tokens int,
+        cached_tokens int, total_tokens int, latency_ms real, prompt_chars int,
+        images int, status text, config text);
+    create view gemini_usage_daily as
+        select day, username, count(*) as calls, sum(prompt_tokens) as prompt_tokens,
+               sum(output_tokens) as output_tokens, sum(total_tokens) as total_tokens,
+               round(avg(latency_ms)::numeric, 1) as avg_latency_ms,
+               count(*) filter (where status <> 'ok') as errors
+        from gemini_usage group by day, username;
+    create view gemini_usage_by_config as
+        select day, feature, config, count(*) as calls,
+               round(avg(prompt_tokens)) as avg_prompt_tokens,
+               round(avg(output_tokens)) as avg_output_tokens, sum(total_tokens) as total_tokens
+        from gemini_usage group by day, feature, config;
+"""
+import json
+import atexit
+import sqlite3
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+USAGE_COLUMNS = ("created_at", "day", "username", "feature", "model", "prompt_tokens", "output_tokens",
+                 "cached_tokens", "total_tokens", "latency_ms", "prompt_chars", "images", "status", "config")
+USAGE_BATCH_SIZE = 20
+USAGE_FLUSH_INTERVAL = 5.0
+
+_local = threading.local()
+
+# ==========================================
+# --- CALL CONTEXT (who / what) ---
+# ==========================================
+@contextmanager
+def usage_context(username, feature, config=None):
+    """Attributes Gemini calls made inside the block on this thread."""
+    previous = getattr(_local, "context", None)
+    _local.context = {"username": username, "feature": feature,
+                      "config": json.dumps(config, sort_keys=True, ensure_ascii=False) if config else None}
+    try:
+        yield
+    finally:
+        _local.context = previous
+
+def current_usage_context():
+    """The {"username", "feature", "config"} set by usage_context(), or None."""
+    return getattr(_local, "context", None)
+
+def carry_usage_context(fn):
+    """Wraps fn so it runs under the caller's usage context, for work
+    handed to a thread pool (thread-locals don't follow the task)."""
+    context = getattr(_local, "context", None)
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, "context", None)
+        _local.context = context
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.context = previous
+    return wrapper
+
+# ==========================================
+# --- STORES ---
+# ==========================================
+class SQLiteUsageSink:
+    """Local stand-in for the Supabase table; also fine for a single server."""
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS gemini_usage (id INTEGER PRIMARY KEY, {', '.join(USAGE_COLUMNS)})")
+            conn.execute("CREATE INDEX IF NOT EXISTS gemini_usage_day ON gemini_usage (day, username)")
+            conn.execute("""CREATE VIEW IF NOT EXISTS gemini_usage_daily AS
+                SELECT day, username, COUNT(*) AS calls, SUM(prompt_tokens) AS prompt_tokens,
+                       SUM(output_tokens) AS output_tokens, SUM(total_tokens) AS total_tokens,
+                       ROUND(AVG(latency_ms), 1) AS avg_latency_ms, SUM(status <> 'ok') AS errors
+                FROM gemini_usage GROUP BY day, username""")
+            conn.execute("""CREATE VIEW IF NOT EXISTS gemini_usage_by_config AS
+                SELECT day, feature, config, COUNT(*) AS calls,
+                       ROUND(AVG(prompt_tokens)) AS avg_prompt_tokens,
+                       ROUND(AVG(output_tokens)) AS avg_output_tokens, SUM(total_tokens) AS total_tokens
+                FROM gemini_usage GROUP BY day, feature, config""")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def write(self, rows):
+        with self._connect() as conn:
+            conn.executemany(
+                f"INSERT INTO gemini_usage ({', '.join(USAGE_COLUMNS)}) VALUES ({', '.join('?' * len(USAGE_COLUMNS))})",
+                [tuple(row[c] for c in USAGE_COLUMNS) for row in rows])
+
+    def query(self, view, since, username=None):
+        sql, params = f"SELECT * FROM {view} WHERE day >= ?", [since]
+        if username:
+            sql, params = sql + " AND username = ?", params + [username]
+        with self._connect() as conn:
+            return [dict(r) for r in conn.execute(sql + " ORDER BY day DESC", params)]
+
+class SupabaseUsageSink:
+    def __init__(self, client, table="gemini_usage"):
+        self.client = client
+        self.table = table
+
+    def write(self, rows):
+        self.client.table(self.table).insert(rows).execute()
+
+    def query(self, view, since, username=None):
+        q = self.client.table(view.replace("gemini_usage", self.table, 1)).select("*").gte("day", since)
+        if username:
+            q = q.eq("username", username)
+        return q.order("day", desc=True).execute().data or []
+
+# ==========================================
+# --- BATCHED RECORDER ---
+# ==========================================
+class UsageRecorder:
+    def __init__(self, sink, batch_size=USAGE_BATCH_SIZE, flush_interval=USAGE_FLUSH_INTERVAL):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.wake = threading.Event()
+        self.stopped = False
+        threading.Thread(target=self._run, daemon=True).start()
+        atexit.register(self.close)
+
+    def add(self, row):
+        with self.lock:
+            self.buffer.append(row)
+            full = len(self.buffer) >= self.batch_size
+        if full:
+            self.wake.set()
+
+    def flush(self):
+        with self.lock:
+            rows, self.buffer = self.buffer, []
+        if not rows:
+            return
+        try:
+            self.sink.write(rows)
+        except Exception as e:
+            # Usage data is best-effort: never let it break generation.
+            logging.error(f"[Usage Write Error] dropped {len(rows)} record(s): {e}")
+
+    def _run(self):
+        while not self.stopped:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def close(self):
+        self.stopped = True
+        self.wake.set()
+        self.flush()
+
+_recorder = None
+
+def configure_usage(sink, batch_size=USAGE_BATCH_SIZE, flush_interval=USAGE_FLUSH_INTERVAL):
+    """Starts recording to sink. Until this is called, calls aren't recorded."""
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+    _recorder = UsageRecorder(sink, batch_size, flush_interval)
+    return _recorder
+
+def record_call(model, usage_metadata, latency_s, prompt_chars, images=0, status="ok"):
+    if _recorder is None:
+        return
+    meta = usage_metadata or {}
+    context = getattr(_local, "context", None) or {}
+    now = datetime.now(timezone.utc)
+    _recorder.add({
+        "created_at": now.isoformat(), "day": now.date().isoformat(),
+        "username": context.get("username"), "feature": context.get("feature"), "model": model,
+        "prompt_tokens": meta.get("promptTokenCount", 0), "output_tokens": meta.get("candidatesTokenCount", 0),
+        "cached_tokens": meta.get("cachedContentTokenCount", 0), "total_tokens": meta.get("totalTokenCount", 0),
+        "latency_ms": round(latency_s * 1000, 1), "prompt_chars": prompt_chars, "images": images,
+        "status": status, "config": context.get("config"),
+    })
+
+# ==========================================
+# --- AGGREGATES ---
+# ==========================================
+def _since(days):
+    return (datetime.now(timezone.utc).date() - timedelta(days=days - 1)).isoformat()
+
+def daily_usage(days=7, username=None):
+    """Per-user, per-day totals (calls, tokens, latency, errors), newest first."""
+    if _recorder is None:
+        return []
+    _recorder.flush()
+    return _recorder.sink.query("gemini_usage_daily", _since(days), username)
+
+def usage_by_config(days=7):
+    """Average tokens per call for each feature + paper configuration, so
+    expensive setups (e.g. long PDF context) stand out."""
+    if _recorder is None:
+        return []
+    _recorder.flush()
+    rows = _recorder.sink.query("gemini_usage_by_config", _since(days))
+    return sorted(rows, key=lambda r: r.get("avg_prompt_tokens") or 0, reverse=True)